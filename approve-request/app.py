@@ -23,19 +23,28 @@ import logging
 import os
 from datetime import datetime
 
-import boto3
-import requests
+from accruals import accrual_update, budget_check, request_update, transact
+from clients import dynamodb_client, http_session
+from keys import (blocked_cost_attribute, blocked_entity_attribute, budget_partition, budget_partition_key, entity_status_attribute,
+                  request_partition, request_partition_key)
+from lifecycle import expiry_attributes
+from metrics import Metrics
+from money import from_item
+from snapshots import SnapshotCache
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get('LogLevel', 'INFO'))
+metrics = Metrics('approve-request')
 region = os.environ['AWS_REGION']
 budgets_table_name = os.environ['BudgetsTable']
-dynamodb = boto3.resource('dynamodb', region_name=region)
-budgets_table = dynamodb.Table(budgets_table_name)
-request_partition = 'REQUEST'
-budget_partition = 'BUDGET'
+actionable_statuses = ['PENDING', 'BLOCKED']
+decisions = ['Approve', 'Reject']
+max_attempts = 3
+request_snapshots = SnapshotCache(int(os.environ.get('RequestSnapshotMaxEntries', '256')))
+budget_snapshots = SnapshotCache(int(os.environ.get('BudgetSnapshotMaxEntries', '64')))
 
 
+@metrics.handler
 def lambda_handler(event, context):
     logger.info(json.dumps(event))
     success_response_data = {
@@ -48,39 +57,43 @@ def lambda_handler(event, context):
         request_id = event['queryStringParameters']['requestId']
         request_status = event['queryStringParameters']['requestStatus']
         success_response_data['UniqueId'] = request_id
-        request = get_request_item(request_id)
-        requested_amt = request['pricingInfoAtRequest']['EstCurrMonthPrice']
-        business_entity_id = request['businessEntityId']
-        budget = get_budgets_for_request(business_entity_id)
-        accrued_blocked = budget['accruedBlockedSpend']
-        accrued_forecast = budget['accruedForecastedSpend']
-        accrued_approved = budget['accruedApprovedSpend']
-        requested_amt_monthly = request['pricingInfoAtRequest']['31DayPrice']
-        wait_url = request['stackWaitUrl']
+        if request_status not in decisions:
+            metrics.add('UnknownDecisions')
+            logger.error("Unknown requestStatus {} for request {}, expected Approve or Reject".format(request_status, request_id))
+            response = {"error": 'Unknown requestStatus {}, expected Approve or Reject'.format(request_status)}
+            return {'statusCode': '400', 'body': json.dumps(response)}
+        if request_status == "Reject":
+            success_response_data['Status'] = "FAILURE"
+            success_response_data['Reason'] = "Rejected"
+            success_response_data['Data'] = "Admin rejected the stack"
         try:
-            logger.info("Accruals before processing the request Blocked: {}, Forecasted: {}, Approved: {}".format(accrued_blocked, accrued_forecast, accrued_approved))
-            if request['requestStatus'] in ['PENDING', 'BLOCKED']:
-                if request_status == "Approve":
-                    success_response_data['Status'] = "SUCCESS"
-                    update_approval_request_status(request_id)
-                    # Recalculate the accruals and move the requested amt to forecasted from blocked
-                    accrued_blocked = accrued_blocked - requested_amt_monthly
-                    accrued_forecast = accrued_forecast + requested_amt
-                    accrued_approved = accrued_approved + (requested_amt_monthly - requested_amt)
-                    update_accrued_amt(business_entity_id, accrued_forecast, accrued_blocked, accrued_approved)
-                elif request_status == "Reject":
-                    success_response_data['Status'] = "FAILURE"
-                    success_response_data['Reason'] = "Rejected"
-                    success_response_data['Data'] = "Admin rejected the stack"
-                    update_rejection_request_status(request_id)
-                    # Remove the blocked amount since request is rejected
-                    accrued_blocked = accrued_blocked - requested_amt_monthly
-                    update_accrued_amt(business_entity_id, accrued_forecast, accrued_blocked, accrued_approved)
-
-                response = requests.put(wait_url, data=json.dumps(success_response_data))
-                logger.info("Successfully responded for wait handle with response: {}".format(response))
+            # the request and its budget are read from the snapshots, a failed condition means one of
+            # them changed since, both are read again
+            for attempt in range(max_attempts):
+                with metrics.timer('FetchRequest'):
+                    request = get_request_snapshot(request_id)
+                if request['requestStatus'] not in actionable_statuses:
+                    logger.info('Request {} is {}, only blocked or pending requests can be approved/rejected'.format(
+                        request_id, request['requestStatus']))
+                    break
+                with metrics.timer('FetchBudget'):
+                    budget = get_budget_snapshot(request)
+                with metrics.timer('Write'):
+                    processed = transact(dynamodb_client(), decision_actions(request, request_status, budget))
+                if processed:
+                    # the request is final now, later clicks are answered from the snapshot
+                    request_snapshots.put(request_id, dict(request, requestStatus=processed_status(request_status)))
+                    with metrics.timer('Callback'):
+                        response = http_session().put(request['stackWaitUrl'], data=json.dumps(success_response_data))
+                    logger.info("Successfully responded for wait handle with response: {}".format(response))
+                    break
+                metrics.add('ConditionCheckFailures')
+                request_snapshots.invalidate(request_id)
+                budget_snapshots.invalidate(budget['rangeKey'])
+                logger.info('Request {} or its budget changed since it was read, attempt {} of {}'.format(
+                    request_id, attempt + 1, max_attempts))
             else:
-                logger.info('Request can abe approved/rejected only when it is in blocked or pending state')
+                logger.error('Request {} or its budget kept changing, giving up'.format(request_id))
         except Exception as e:
             logger.error("Failed approving the request: {}".format(e))
         response = {"data": 'Successfully Processed the request'}
@@ -90,71 +103,108 @@ def lambda_handler(event, context):
         return {'statusCode': '200', 'body': json.dumps(response)}
 
 
-# updates the rejection status in database
-def update_rejection_request_status(request_id):
-    logger.info('Received request to terminate a stack with request id: {}'.format(request_id))
-    response = budgets_table.update_item(
-        Key={'partitionKey': request_partition, 'rangeKey': request_id},
-        UpdateExpression="set requestStatus = :s, requestRejectionTime=:a, resourceStatus=:r",
-        ExpressionAttributeValues={
-            ':s': 'REJECTED_ADMIN',
-            ':a': str(datetime.utcnow()),
-            ':r': 'REJECTED'
-        },
-        ReturnValues="UPDATED_NEW"
-    )
-    logger.debug("UpdateItem succeeded:")
-    logger.debug(json.dumps(response))
-
-
-# Update the status of the request in dynamo-db
-def update_approval_request_status(request_id):
-    response = budgets_table.update_item(
-        Key={'partitionKey': request_partition, 'rangeKey': request_id},
-        UpdateExpression="set requestStatus = :s, requestApprovalTime=:a, resourceStatus=:r",
-        ExpressionAttributeValues={
-            ':s': 'APPROVED_ADMIN',
-            ':a': str(datetime.utcnow()),
-            ':r': 'ACTIVE'
-        },
-        ReturnValues="UPDATED_NEW"
-    )
-    logger.debug("UpdateItem succeeded:")
-    logger.debug(json.dumps(response))
-
-
-# Get the request item for a given request id
-def get_request_item(request_id):
-    response = budgets_table.get_item(
-        Key={'partitionKey': request_partition, 'rangeKey': request_id},
-        ProjectionExpression='stackWaitUrl, requestStatus, businessEntityId, pricingInfoAtRequest'
-    )
-    return response['Item']
-
-
-# Update the Accruals in database
-def update_accrued_amt(business_entity_id, accrued_forecasted_spend, accrued_blocked_spend, accrued_approved_spend):
-    logger.info("Update the Budget with new accrued amounts Blocked: {}, Forecasted: {}, Approved: {}".format(accrued_blocked_spend, accrued_forecasted_spend, accrued_approved_spend))
-    update_expression = "set accruedForecastedSpend=:a, accruedBlockedSpend=:b, accruedApprovedSpend=:c"
-    expression_attributes = {
-        ':a': accrued_forecasted_spend,
-        ':b': accrued_blocked_spend,
-        ':c': accrued_approved_spend
+# Build the actions applying the admin decision to a request. Approving moves the requested amt from blocked
+# to forecasted, rejecting removes the blocked amount, together with the status change. The accruals are
+# only added while the budget is at the version of its snapshot
+def decision_actions(request, request_status, budget):
+    requested_amt = request['pricingInfoAtRequest']['EstCurrMonthPrice']
+    requested_amt_monthly = request['pricingInfoAtRequest']['31DayPrice']
+    check = budget_check(budgets_table_name, budget['partitionKey'], budget['rangeKey'], budget.get('budgetVersion', 0))
+    if request_status == "Approve":
+        return [
+            update_approval_request_status(request),
+            check,
+            accrual_update(budgets_table_name, budget['partitionKey'], budget['rangeKey'],
+                           forecasted=requested_amt,
+                           blocked=-requested_amt_monthly,
+                           approved=requested_amt_monthly - requested_amt)
+        ]
+    return [
+        update_rejection_request_status(request),
+        check,
+        accrual_update(budgets_table_name, budget['partitionKey'], budget['rangeKey'], blocked=-requested_amt_monthly)
+    ]
+
+
+# Build the rejection status update, applied only while the request is still pending or blocked
+def update_rejection_request_status(request):
+    logger.info('Received request to terminate a stack with request id: {}'.format(request['rangeKey']))
+    attributes = {
+        'requestStatus': 'REJECTED_ADMIN',
+        'requestRejectionTime': str(datetime.utcnow()),
+        'resourceStatus': 'REJECTED',
+        entity_status_attribute: None,
+        blocked_entity_attribute: None,
+        blocked_cost_attribute: None
     }
-    response = budgets_table.update_item(
-        Key={'partitionKey': budget_partition, 'rangeKey': business_entity_id},
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_attributes,
-        ReturnValues="UPDATED_NEW"
-    )
-    logger.info('Successfully Updated accrued Amt for Key: {} with response {}'.format(business_entity_id, response))
-    return True
-
-
-# Gets the Budget information for a given business entity Id
-def get_budgets_for_request(business_entity_id):
-    response = budgets_table.get_item(
-        Key={'partitionKey': budget_partition, 'rangeKey': business_entity_id},
-        ProjectionExpression='accruedForecastedSpend, accruedBlockedSpend, accruedApprovedSpend'
-    )
-    return response['Item']
+    # rejected requests are final, they expire after the retention window
+    attributes.update(expiry_attributes('REJECTED_ADMIN'))
+    return request_update(budgets_table_name, request['partitionKey'], request['rangeKey'], attributes, actionable_statuses)
+
+
+# Build the approval status update, applied only while the request is still pending or blocked
+def update_approval_request_status(request):
+    return request_update(budgets_table_name, request['partitionKey'], request['rangeKey'], {
+        'requestStatus': 'APPROVED_ADMIN',
+        'requestApprovalTime': str(datetime.utcnow()),
+        'resourceStatus': 'ACTIVE',
+        entity_status_attribute: None,
+        blocked_entity_attribute: None,
+        blocked_cost_attribute: None
+    }, actionable_statuses)
+
+
+# Status a request ends up in once the admin decision is applied
+def processed_status(request_status):
+    return 'APPROVED_ADMIN' if request_status == "Approve" else 'REJECTED_ADMIN'
+
+
+# Get the request from the snapshot cache, or read it. Snapshots are kept for actionable requests,
+# whose other attributes no longer change, and for requests the admin decision was already applied to
+def get_request_snapshot(request_id):
+    request = request_snapshots.get(request_id)
+    if request is None:
+        request = get_request_item(request_id)
+        if request['requestStatus'] in actionable_statuses:
+            request_snapshots.put(request_id, request)
+    return request
+
+
+# Get the partition key and version of the budget of a request from the snapshot cache, or read them.
+# A snapshot is checked by the accrual update that follows it
+def get_budget_snapshot(request):
+    budget_range_key = request['businessEntityId']
+    budget = budget_snapshots.get(budget_range_key)
+    if budget is None:
+        # requests evaluated before the budgets were sharded point at the unsharded budget
+        budget = get_budget_item(request.get('budgetPartitionKey', budget_partition), budget_range_key)
+        budget_snapshots.put(budget_range_key, budget)
+    return budget
+
+
+# Get the partition key and version of a budget row, from the partition key the request points at
+# or from the shard of the budget if the key migration moved it since
+def get_budget_item(partition_key, budget_range_key):
+    for key in dict.fromkeys((partition_key, budget_partition_key(budget_range_key))):
+        response = dynamodb_client().get_item(
+            TableName=budgets_table_name,
+            Key={'partitionKey': {'S': key}, 'rangeKey': {'S': budget_range_key}},
+            ProjectionExpression='partitionKey, rangeKey, budgetVersion'
+        )
+        if 'Item' in response:
+            return from_item(response['Item'])
+    raise KeyError('Budget {} not found'.format(budget_range_key))
+
+
+# Get the request item for a given request id from the shard of the request, requests saved
+# before the shards existed are read from the unsharded partition until they are migrated
+def get_request_item(request_id):
+    for partition_key in (request_partition_key(request_id), request_partition):
+        response = dynamodb_client().get_item(
+            TableName=budgets_table_name,
+            Key={'partitionKey': {'S': partition_key}, 'rangeKey': {'S': request_id}},
+            ProjectionExpression='partitionKey, rangeKey, stackWaitUrl, requestStatus, businessEntityId, budgetPartitionKey, pricingInfoAtRequest'
+        )
+        if 'Item' in response:
+            return from_item(response['Item'])
+    raise KeyError('Request {} not found'.format(request_id))
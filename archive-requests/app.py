@@ -0,0 +1,73 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+import gzip
+import logging
+import os
+import uuid
+from collections import defaultdict
+
+import simplejson as json
+
+from clients import from_item, get_client
+from metrics import Metrics
+
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LogLevel', 'INFO'))
+metrics = Metrics('archive-requests')
+archive_bucket = os.environ['ArchiveBucket']
+archive_prefix = os.environ.get('ArchivePrefix', 'request-archive')
+
+
+# Triggered by the table stream with the requests deleted by the table TTL, the old images are
+# written to the archive bucket as gzipped JSON lines partitioned by the day of the request
+@metrics.handler
+def lambda_handler(event, context):
+    partitions = defaultdict(list)
+    for record in event['Records']:
+        old_image = record.get('dynamodb', {}).get('OldImage')
+        if not old_image:
+            continue
+        request = from_item(old_image)
+        partitions[archive_partition(request)].append(request)
+    for partition, requests in partitions.items():
+        key = '{}/{}/{}.jsonl.gz'.format(archive_prefix, partition, uuid.uuid4())
+        with metrics.timer('Write'):
+            write_archive(key, requests)
+        metrics.add('ArchivedRequests', len(requests))
+        logger.info("Archived {} requests to s3://{}/{}".format(len(requests), archive_bucket, key))
+    return {'archived': sum(len(requests) for requests in partitions.values())}
+
+
+# Hive style year=/month=/day= partition of a request, taken from its requestTime
+def archive_partition(request):
+    request_date = request.get('requestTime', '')[:10]
+    year, month, day = request_date.split('-') if len(request_date) == 10 else ('unknown', 'unknown', 'unknown')
+    return 'year={}/month={}/day={}'.format(year, month, day)
+
+
+def write_archive(key, requests):
+    body = '\n'.join(json.dumps(request, use_decimal=True, sort_keys=True) for request in requests) + '\n'
+    get_client('s3').put_object(
+        Bucket=archive_bucket,
+        Key=key,
+        Body=gzip.compress(body.encode('utf-8')),
+        ContentType='application/gzip'
+    )
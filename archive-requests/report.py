@@ -0,0 +1,82 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Monthly reporting over the request archive. Reads the gzipped JSON lines that
+# archive-requests writes under <prefix>/year=/month=/day=/ and aggregates them
+# per business entity. The layout is Hive style, so the same files can also be
+# queried from Athena by partitioning a table on year, month and day.
+#
+# Usage: python archive-requests/report.py --bucket <cur-bucket> --year 2020 --month 7
+import argparse
+import gzip
+from collections import defaultdict
+from decimal import Decimal
+
+import simplejson as json
+
+approved_statuses = ('APPROVED_SYSTEM', 'APPROVED_ADMIN')
+
+
+# Yield the archived requests of a month, optionally of a single day
+def iter_archived_requests(s3, bucket, year, month, day=None, prefix='request-archive'):
+    partition = '{}/year={:04d}/month={:02d}/'.format(prefix, int(year), int(month))
+    if day is not None:
+        partition = partition + 'day={:02d}/'.format(int(day))
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=partition):
+        for archive in page.get('Contents', []):
+            body = s3.get_object(Bucket=bucket, Key=archive['Key'])['Body'].read()
+            for line in gzip.decompress(body).decode('utf-8').splitlines():
+                if line:
+                    yield json.loads(line, use_decimal=True)
+
+
+# Aggregate requests per business entity: requests by final status, the requested
+# 31 day price and the estimated current month price of the approved requests
+def monthly_report(requests):
+    report = defaultdict(lambda: {'requests': 0, 'statuses': defaultdict(int), 'requested31DayPrice': Decimal(0),
+                                  'approvedEstCurrMonthPrice': Decimal(0)})
+    for request in requests:
+        entity = report[request.get('businessEntity', 'unknown')]
+        status = request.get('requestStatus', 'unknown')
+        pricing = request.get('pricingInfoAtRequest', {})
+        entity['requests'] += 1
+        entity['statuses'][status] += 1
+        entity['requested31DayPrice'] += Decimal(pricing.get('31DayPrice', 0))
+        # approved requests keep their status with a _TERMINATED suffix once the stack is deleted
+        if status.replace('_TERMINATED', '') in approved_statuses:
+            entity['approvedEstCurrMonthPrice'] += Decimal(pricing.get('EstCurrMonthPrice', 0))
+    return {name: dict(values, statuses=dict(values['statuses'])) for name, values in report.items()}
+
+
+if __name__ == '__main__':
+    import boto3
+
+    parser = argparse.ArgumentParser(description='Report on the archived requests of a month')
+    parser.add_argument('--bucket', required=True, help='bucket the requests are archived to')
+    parser.add_argument('--year', type=int, required=True)
+    parser.add_argument('--month', type=int, required=True)
+    parser.add_argument('--day', type=int, help='limit the report to a single day')
+    parser.add_argument('--prefix', default='request-archive', help='prefix the archive is written under')
+    parser.add_argument('--region', help='region of the bucket')
+    args = parser.parse_args()
+    s3 = boto3.client('s3', region_name=args.region)
+    requests = iter_archived_requests(s3, args.bucket, args.year, args.month, args.day, args.prefix)
+    print(json.dumps(monthly_report(requests), use_decimal=True, indent=2, sort_keys=True))
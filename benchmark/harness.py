@@ -0,0 +1,390 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Offline load simulation for the approval pipeline. Runs the real handlers of
+# save-request, process-requests, approve-request and rebase-budgets in process
+# against moto (DynamoDB, SNS, Budgets) and an in-process HTTP stand-in for the
+# CloudFormation wait handles, then reports per handler latency percentiles,
+# throughput, DynamoDB call counts and consumed capacity.
+#
+# Usage: python benchmark/harness.py --entities 50 --requests 2000 --sweeps 3
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root_dir, 'common-layer'))
+from keys import budget_partition_key  # noqa: E402
+
+region = 'us-east-1'
+account_id = '123456789012'
+table_name = 'benchmark-budgets'
+approval_url = 'https://approvals.example.com/Prod/approveRequest'
+
+
+# DynamoDB calls, consumed capacity and latencies, attributed to the handler being run
+class Recorder:
+
+    def __init__(self):
+        self.current_handler = None
+        self.latencies = defaultdict(list)
+        self.calls = defaultdict(lambda: defaultdict(int))
+        self.capacity = defaultdict(float)
+        self.http_calls = defaultdict(int)
+
+    def add_consumed_capacity(self, params, model, **kwargs):
+        if 'ReturnConsumedCapacity' in model.input_shape.members:
+            params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+    def record_call(self, http_response, parsed, model, **kwargs):
+        handler = self.current_handler or 'setup'
+        self.calls[handler][model.name] += 1
+        consumed = parsed.get('ConsumedCapacity', [])
+        for entry in consumed if isinstance(consumed, list) else [consumed]:
+            self.capacity[handler] += entry.get('CapacityUnits', 0)
+
+    def timed(self, handler, fn, *args):
+        self.current_handler = handler
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.latencies[handler].append(time.perf_counter() - start)
+            self.current_handler = None
+
+
+class FakeContext:
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.log_stream_name = '2020/01/01/[$LATEST]benchmark'
+        self.aws_request_id = str(uuid.uuid4())
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+class FakeResponse:
+    status_code = 200
+    ok = True
+
+    def raise_for_status(self):
+        return None
+
+    def __repr__(self):
+        return '<Response [200]>'
+
+
+# moto snapshots the whole table for every transaction and is not thread safe, transactions flushed by
+# parallel writers are run one at a time as DynamoDB would isolate them
+def serialize_moto_transactions():
+    from moto.dynamodb.models import DynamoDBBackend
+    transact_write_items = DynamoDBBackend.transact_write_items
+    lock = threading.Lock()
+
+    def serialized(self, *args, **kwargs):
+        with lock:
+            return transact_write_items(self, *args, **kwargs)
+    DynamoDBBackend.transact_write_items = serialized
+
+
+# Replace every HTTP call made through requests (CFN responses and wait handles) with a recorded no-op
+def install_http_stand_in(recorder):
+    import requests
+
+    def request(session, method, url, **kwargs):
+        recorder.http_calls[recorder.current_handler or 'setup'] += 1
+        return FakeResponse()
+
+    requests.sessions.Session.request = request
+
+
+emf_documents = []
+
+
+# Load the app module of a function directory under a unique module name
+def load_handler(function_dir):
+    function_path = os.path.join(root_dir, function_dir)
+    for path in (os.path.join(root_dir, 'common-layer'), function_path):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(function_dir.replace('-', '_') + '_app', os.path.join(function_path, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # the EMF documents of the handlers are kept instead of printed between the report lines
+    if hasattr(module, 'metrics'):
+        module.metrics.sink = emf_documents.append
+    return module
+
+
+# Create the budgets table with the same keys and indexes as template.yaml
+def create_table(dynamodb_client):
+    dynamodb_client.create_table(
+        TableName=table_name,
+        BillingMode='PAY_PER_REQUEST',
+        AttributeDefinitions=[
+            {'AttributeName': 'partitionKey', 'AttributeType': 'S'},
+            {'AttributeName': 'rangeKey', 'AttributeType': 'S'},
+            {'AttributeName': 'requestTime', 'AttributeType': 'S'},
+            {'AttributeName': 'entityStatus', 'AttributeType': 'S'},
+            {'AttributeName': 'blockedEntity', 'AttributeType': 'S'},
+            {'AttributeName': 'blockedCost', 'AttributeType': 'N'},
+        ],
+        KeySchema=[
+            {'AttributeName': 'partitionKey', 'KeyType': 'HASH'},
+            {'AttributeName': 'rangeKey', 'KeyType': 'RANGE'},
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': 'query-by-entity-status',
+                'KeySchema': [
+                    {'AttributeName': 'entityStatus', 'KeyType': 'HASH'},
+                    {'AttributeName': 'requestTime', 'KeyType': 'RANGE'},
+                ],
+                'Projection': {
+                    'ProjectionType': 'INCLUDE',
+                    'NonKeyAttributes': ['requestStatus', 'businessEntity', 'pricingInfoAtRequest', 'stackWaitUrl', 'requestorEmail',
+                                         'requestApprovalUrl', 'requestRejectionUrl', 'instanceType'],
+                },
+            },
+            {
+                'IndexName': 'query-by-blocked-cost',
+                'KeySchema': [
+                    {'AttributeName': 'blockedEntity', 'KeyType': 'HASH'},
+                    {'AttributeName': 'blockedCost', 'KeyType': 'RANGE'},
+                ],
+                'Projection': {
+                    'ProjectionType': 'INCLUDE',
+                    'NonKeyAttributes': ['requestTime', 'requestStatus', 'businessEntity', 'pricingInfoAtRequest', 'stackWaitUrl',
+                                         'requestorEmail', 'requestApprovalUrl', 'requestRejectionUrl', 'instanceType'],
+                },
+            },
+        ],
+    )
+
+
+# Seed N business entities with a budget row, an SNS topic and an AWS Budgets budget
+def seed_business_entities(boto3, entity_count, rng):
+    table = boto3.resource('dynamodb', region_name=region).Table(table_name)
+    sns = boto3.client('sns', region_name=region)
+    budgets = boto3.client('budgets', region_name=region)
+    entities = []
+    for index in range(entity_count):
+        business_entity = 'business_entity_{}'.format(index)
+        budget_name = 'bu{}-monthly-budget'.format(index)
+        limit = Decimal(rng.choice([100, 250, 500, 1000, 5000]))
+        topic_arn = sns.create_topic(Name='approval-notification-{}'.format(index))['TopicArn']
+        budgets.create_budget(AccountId=account_id, Budget={
+            'BudgetName': budget_name,
+            'BudgetLimit': {'Amount': str(limit), 'Unit': 'USD'},
+            'TimeUnit': 'MONTHLY',
+            'BudgetType': 'COST',
+            'CalculatedSpend': {
+                'ActualSpend': {'Amount': str(limit * Decimal('0.3')), 'Unit': 'USD'},
+                'ForecastedSpend': {'Amount': str(limit * Decimal('0.6')), 'Unit': 'USD'},
+            },
+        })
+        range_key = str(uuid.uuid4())
+        table.put_item(Item={
+            'partitionKey': budget_partition_key(range_key),
+            'rangeKey': range_key,
+            'budgetName': budget_name,
+            'budgetLimit': limit,
+            'actualSpend': 0,
+            'forecastedSpend': 0,
+            'approverEmail': 'admin{}@email.com'.format(index),
+            'notifySNSTopic': topic_arn,
+            'accruedForecastedSpend': 0,
+            'accruedBlockedSpend': 0,
+            'accruedApprovedSpend': 0,
+            'businessEntity': business_entity,
+            'budgetForecastProcessed': False,
+            'budgetUpdatedAt': '2020-01-01 00:00:00',
+        })
+        entities.append(business_entity)
+    return entities
+
+
+# CloudFormation custom resource event as sent to save-request for a new stack
+def save_request_event(business_entity, rng):
+    stack_id = 'arn:aws:cloudformation:{}:{}:stack/benchmark/{}'.format(region, account_id, uuid.uuid4())
+    unit_price = Decimal(rng.choice(['0.0058', '0.0116', '0.0232', '0.0464', '0.1', '0.2', '0.4', '1.6']))
+    hours_left = rng.randint(1, 744)
+    return {
+        'RequestType': 'Create',
+        'StackId': stack_id,
+        'RequestId': str(uuid.uuid4()),
+        'LogicalResourceId': 'SaveRequestFunction',
+        'ResponseURL': 'https://cloudformation-custom-resource-response.example.com/{}'.format(uuid.uuid4()),
+        'ResourceProperties': {
+            'WaitUrl': 'https://cloudformation-waitcondition.example.com/{}'.format(uuid.uuid4()),
+            'EmailID': 'user@email.com',
+            'ImageId': 'ami-12345678',
+            'InstanceType': 't2.micro',
+            'ProductName': 'EC2-LINUX',
+            'BusinessEntity': business_entity,
+            'StackName': 'benchmark',
+            'EC2Pricing': {
+                'OperatingSystem': 'Linux',
+                'TermType': 'OnDemand',
+                'InstanceType': 't2.micro',
+                'UnitPrice': str(unit_price),
+                'EstCurrMonthPrice': str(unit_price * hours_left),
+                '31DayPrice': str(unit_price * 744),
+                'NextMonthPrice': str(unit_price * 720),
+                'HoursLeftInCurrMonth': hours_left,
+            },
+        },
+    }
+
+
+def cur_manifest_event():
+    return {'Records': [{'s3': {
+        'bucket': {'name': 'benchmark-cur'},
+        'object': {'key': 'cur/benchmark/20200101-20200201/benchmark-Manifest.json'}
+    }}]}
+
+
+def approval_event(request_id, decision):
+    return {'queryStringParameters': {'requestId': request_id, 'requestStatus': decision}}
+
+
+# Requests currently waiting on an admin, read per business entity from the entity status index
+def get_pending_request_ids(boto3, entities):
+    table = boto3.resource('dynamodb', region_name=region).Table(table_name)
+    request_ids = []
+    for business_entity in entities:
+        query_args = {
+            'IndexName': 'query-by-entity-status',
+            'KeyConditionExpression': 'entityStatus = :s',
+            'ExpressionAttributeValues': {':s': '{}#PENDING'.format(business_entity)},
+            'ProjectionExpression': 'rangeKey'
+        }
+        while True:
+            response = table.query(**query_args)
+            request_ids.extend(item['rangeKey'] for item in response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return request_ids
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def report(recorder, wall_time, request_count):
+    result = {'wallTimeSeconds': wall_time, 'requestsPerSecond': request_count / wall_time if wall_time else 0, 'handlers': {}}
+    for handler, latencies in sorted(recorder.latencies.items()):
+        result['handlers'][handler] = {
+            'invocations': len(latencies),
+            'p50Ms': percentile(latencies, 0.5) * 1000,
+            'p99Ms': percentile(latencies, 0.99) * 1000,
+            'totalSeconds': sum(latencies),
+            'dynamodbCalls': dict(recorder.calls[handler]),
+            'consumedCapacityUnits': recorder.capacity[handler],
+            'httpCalls': recorder.http_calls[handler],
+        }
+    return result
+
+
+def print_report(result):
+    print('Wall time {:.2f}s, {:.1f} requests/s'.format(result['wallTimeSeconds'], result['requestsPerSecond']))
+    print('{:<20} {:>7} {:>10} {:>10} {:>10} {:>8}  {}'.format('handler', 'calls', 'p50 ms', 'p99 ms', 'capacity', 'http', 'dynamodb calls'))
+    for handler, stats in result['handlers'].items():
+        print('{:<20} {:>7} {:>10.2f} {:>10.2f} {:>10.1f} {:>8}  {}'.format(
+            handler, stats['invocations'], stats['p50Ms'], stats['p99Ms'], stats['consumedCapacityUnits'],
+            stats['httpCalls'], ', '.join('{}={}'.format(name, count) for name, count in sorted(stats['dynamodbCalls'].items()))))
+
+
+def run(args):
+    os.environ.update({
+        'AWS_REGION': region,
+        'AWS_DEFAULT_REGION': region,
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'BudgetsTable': table_name,
+        'ApprovalUrl': approval_url,
+        'AccountId': account_id,
+    })
+    import boto3
+    from moto import mock_aws
+
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    with mock_aws():
+        boto3.setup_default_session(region_name=region)
+        boto3.DEFAULT_SESSION.events.register('provide-client-params.dynamodb', recorder.add_consumed_capacity)
+        boto3.DEFAULT_SESSION.events.register('after-call.dynamodb', recorder.record_call)
+        install_http_stand_in(recorder)
+        serialize_moto_transactions()
+        create_table(boto3.client('dynamodb', region_name=region))
+        entities = seed_business_entities(boto3, args.entities, rng)
+
+        save_request = load_handler('save-request')
+        process_requests = load_handler('process-requests')
+        approve_request = load_handler('approve-request')
+        rebase_budgets = load_handler('rebase-budgets')
+        # the handlers set their own log level on import
+        logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+        start = time.perf_counter()
+        recorder.timed('rebase-budgets', rebase_budgets.lambda_handler, cur_manifest_event(), FakeContext('rebase-budgets'))
+        requests_per_sweep = max(1, args.requests // args.sweeps)
+        saved = 0
+        for sweep in range(args.sweeps):
+            for _ in range(min(requests_per_sweep, args.requests - saved)):
+                event = save_request_event(rng.choice(entities), rng)
+                recorder.timed('save-request', save_request.lambda_handler, event, FakeContext('save-request'))
+                saved = saved + 1
+            recorder.timed('process-requests', process_requests.lambda_handler, {'source': 'aws.events'}, FakeContext('process-requests'))
+            for request_id in get_pending_request_ids(boto3, entities):
+                decision = 'Approve' if rng.random() < args.approve_ratio else 'Reject'
+                recorder.timed('approve-request', approve_request.lambda_handler, approval_event(request_id, decision), FakeContext('approve-request'))
+        recorder.timed('process-requests', process_requests.lambda_handler, {'source': 'aws.events'}, FakeContext('process-requests'))
+        wall_time = time.perf_counter() - start
+    return report(recorder, wall_time, saved)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay synthetic launch requests through the approval pipeline')
+    parser.add_argument('--entities', type=int, default=20, help='number of business entities')
+    parser.add_argument('--requests', type=int, default=500, help='number of launch requests')
+    parser.add_argument('--sweeps', type=int, default=5, help='number of process-requests sweeps the requests are spread over')
+    parser.add_argument('--approve-ratio', type=float, default=0.5, help='share of pending requests the admin approves')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic workload')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='keep the handler logs')
+    args = parser.parse_args()
+    result = run(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(result, report_file, indent=2)
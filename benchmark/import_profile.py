@@ -0,0 +1,126 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Cold start import profile of the workflow functions. Imports the app module of
+# every function in a fresh interpreter with -X importtime, the same way the
+# Lambda runtime does on a cold start, and reports the total import time and the
+# heaviest modules. With --baseline the functions of another git revision are
+# profiled too, so a change can be compared against the tree it started from.
+#
+# Usage: python benchmark/import_profile.py --runs 5 --baseline HEAD~1
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+functions = ['get-ec2-pricing', 'save-request', 'approve-request', 'process-requests', 'rebase-budgets']
+# module level code of the functions reads these, the values are never used to call AWS
+function_environment = {
+    'AWS_REGION': 'us-east-1',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'BudgetsTable': 'import-profile',
+    'ApprovalUrl': 'https://example.com/Prod/approveRequest',
+    'AccountId': '123456789012',
+}
+
+
+# Import the app module of a function once in a fresh interpreter, returns the
+# cumulative import time in microseconds of every top level module it loaded
+def profile_import(tree_dir, function_dir):
+    function_path = os.path.join(tree_dir, function_dir)
+    layer_path = os.path.join(tree_dir, 'common-layer')
+    env = dict(os.environ, **function_environment)
+    env['PYTHONPATH'] = os.pathsep.join([function_path, layer_path])
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=function_path, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError('Importing {} failed: {}'.format(function_dir, result.stderr.strip().splitlines()[-1]))
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        # nested imports are indented below the module that imported them
+        if name.startswith('  '):
+            if name.strip().split('.')[0] in ('boto3', 'botocore'):
+                modules.setdefault('boto3', 0)
+            continue
+        modules[name.strip()] = int(cumulative_us)
+    return modules
+
+
+# Profile every function of a tree, the median over the runs is reported
+def profile_tree(tree_dir, runs, top):
+    results = {}
+    for function_dir in functions:
+        if not os.path.exists(os.path.join(tree_dir, function_dir, 'app.py')):
+            continue
+        samples = [profile_import(tree_dir, function_dir) for _ in range(runs)]
+        top_level = {name: statistics.median(sample.get(name, 0) for sample in samples) for name in samples[0]}
+        results[function_dir] = {
+            'importMs': round(top_level.get('app', 0) / 1000.0, 1),
+            'heaviest': [{'module': name, 'ms': round(us / 1000.0, 1)}
+                         for name, us in sorted(top_level.items(), key=lambda x: -x[1])[:top] if name != 'app'],
+            'loadsBoto3': any('boto3' in sample for sample in samples),
+        }
+    return results
+
+
+# Extract the tree of a git revision to a temporary directory
+def extract_revision(revision, target_dir):
+    archive_path = os.path.join(target_dir, 'tree.tar')
+    with open(archive_path, 'wb') as archive:
+        subprocess.run(['git', 'archive', revision], cwd=root_dir, stdout=archive, check=True)
+    with tarfile.open(archive_path) as archive:
+        archive.extractall(os.path.join(target_dir, 'tree'))
+    return os.path.join(target_dir, 'tree')
+
+
+def print_report(result):
+    for label, tree in result.items():
+        print('== {}'.format(label))
+        for function_dir, stats in tree.items():
+            print('{:<20} {:>8.1f} ms  boto3 at import: {}'.format(function_dir, stats['importMs'], stats['loadsBoto3']))
+            for module in stats['heaviest']:
+                print('    {:<40} {:>8.1f} ms'.format(module['module'], module['ms']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profile the cold start imports of the workflow functions')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per function, the median is reported')
+    parser.add_argument('--top', type=int, default=5, help='number of heaviest top level modules to list')
+    parser.add_argument('--baseline', help='git revision to profile for comparison, e.g. HEAD~1')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+    result = {'working tree': profile_tree(root_dir, args.runs, args.top)}
+    if args.baseline:
+        with tempfile.TemporaryDirectory() as baseline_dir:
+            result[args.baseline] = profile_tree(extract_revision(args.baseline, baseline_dir), args.runs, args.top)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(result, report_file, indent=2)
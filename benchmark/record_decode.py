@@ -0,0 +1,145 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Micro-benchmark of the request decoding in the process-requests hot loop. A
+# page of synthetic request items in the DynamoDB wire format, shaped like the
+# items of the entity status index, is decoded and read the way process_request
+# reads an evaluated request, once through from_item into dicts and once into the
+# lazily decoded records of process-requests/records.py. Reports the time per
+# request of both paths, and the memory per request while a page of decoded
+# requests is held, which for records includes the wire item they keep.
+#
+# Usage: python benchmark/record_decode.py --requests 10000 --runs 5
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root_dir, 'process-requests'))
+sys.path.insert(0, os.path.join(root_dir, 'common-layer'))
+from money import from_item, to_micros, to_number  # noqa: E402
+from records import Request  # noqa: E402
+
+
+# Request items as the low-level client returns them from the entity status index, amounts are stored
+# rounded to the micro-dollar
+def synthetic_items(count, rng):
+    for index in range(count):
+        unit_price = to_micros(rng.choice(['0.0058', '0.0116', '0.0232', '0.0464', '0.1', '0.2', '0.4', '1.6']))
+        hours_left = rng.randint(1, 744)
+        request_id = 'stack-{:08d}'.format(index)
+        yield {
+            'partitionKey': {'S': 'REQUEST#{}'.format(index % 8)},
+            'rangeKey': {'S': request_id},
+            'entityStatus': {'S': 'business_entity_{}#SAVED'.format(index % 50)},
+            'requestTime': {'S': '2020-01-01 00:00:{:06d}'.format(index)},
+            'requestStatus': {'S': 'SAVED'},
+            'businessEntity': {'S': 'business_entity_{}'.format(index % 50)},
+            'stackWaitUrl': {'S': 'https://cloudformation-waitcondition.s3.amazonaws.com/{}'.format(request_id)},
+            'requestorEmail': {'S': 'user{}@example.com'.format(index)},
+            'requestApprovalUrl': {'S': 'https://example.com/Prod/approveRequest?requestStatus=Approve&requestId=' + request_id},
+            'requestRejectionUrl': {'S': 'https://example.com/Prod/approveRequest?requestStatus=Reject&requestId=' + request_id},
+            'instanceType': {'S': 't2.micro'},
+            'pricingInfoAtRequest': {'M': {
+                'OperatingSystem': {'S': 'Linux'},
+                'TermType': {'S': 'OnDemand'},
+                'InstanceType': {'S': 't2.micro'},
+                'Count': {'N': '1'},
+                'UnitPrice': {'N': to_number(unit_price)},
+                'EstCurrMonthPrice': {'N': to_number(unit_price * hours_left)},
+                '31DayPrice': {'N': to_number(unit_price * 744)},
+                'NextMonthPrice': {'N': to_number(unit_price * 720)},
+                'HoursLeftInCurrMonth': {'N': str(hours_left)},
+                'ResponseTime': {'S': '2020-01-01 00:00:00.000000'},
+            }},
+        }
+
+
+# The attributes process_request reads from a request it evaluates and stages an update for
+def evaluate_dicts(items):
+    total = 0
+    for item in items:
+        request = from_item(item)
+        request['rangeKey'], request['businessEntity'], request['requestStatus'], request['partitionKey']
+        total += request['pricingInfoAtRequest']['31DayPrice'] - request['pricingInfoAtRequest']['EstCurrMonthPrice']
+    return total
+
+
+def evaluate_records(items):
+    total = 0
+    for item in items:
+        request = Request(item)
+        request.rangeKey, request.businessEntity, request.requestStatus, request.partitionKey
+        total += request.requestedMonthlyAmount - request.requestedAmount
+    return total
+
+
+# Best and median time per request over the runs, in microseconds
+def time_path(evaluate, items, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        evaluate(items)
+        timings.append((time.perf_counter() - start) / len(items) * 1e6)
+    return min(timings), statistics.median(timings)
+
+
+# Bytes held per request while the decoded requests are kept, as a sweep keeps the blocked requests
+# it evaluates. The wire items are built while tracing, as the pages of a query are, and a dict path
+# request only keeps its decoded copy
+def held_memory(decode, count, seed):
+    tracemalloc.start()
+    decoded = [decode(item) for item in synthetic_items(count, random.Random(seed))]
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del decoded
+    return held / count
+
+
+def held_dict(item):
+    request = from_item(item)
+    request['pricingInfoAtRequest']['31DayPrice']
+    return request
+
+
+def held_record(item):
+    request = Request(item)
+    request.requestedMonthlyAmount
+    return request
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the dict and the record decoding of requests')
+    parser.add_argument('--requests', type=int, default=10000, help='number of request items per run')
+    parser.add_argument('--runs', type=int, default=5, help='number of timed runs of each path')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic items')
+    args = parser.parse_args()
+    items = list(synthetic_items(args.requests, random.Random(args.seed)))
+    if evaluate_dicts(items) != evaluate_records(items):
+        raise SystemExit('The dict and the record path disagree')
+    print('{:<10} {:>12} {:>12} {:>14}'.format('path', 'best us', 'median us', 'held B/req'))
+    for name, evaluate, decode in (('dict', evaluate_dicts, held_dict), ('record', evaluate_records, held_record)):
+        best, median = time_path(evaluate, items, args.runs)
+        held = held_memory(decode, args.requests, args.seed)
+        print('{:<10} {:>12.2f} {:>12.2f} {:>14.0f}'.format(name, best, median, held))
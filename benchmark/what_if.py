@@ -0,0 +1,310 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# What-if simulator for the admission rule of process-requests. Loads a snapshot
+# of the budgets and the active requests and evaluates the SAVED -> PENDING /
+# BLOCKED / APPROVED_SYSTEM state machine for a grid of scenarios at once, such
+# as a budget limit change or a forecast shift. Amounts are converted to integer
+# micro-dollars with the money helpers of the Lambda, so the NumPy evaluation is
+# exact. The simulation evaluates every blocked request. --check evaluates every
+# scenario again with the rule the Lambda runs (process-requests/admission.py), on
+# the same micro-dollars and with the blocked requests read the way the sweep
+# reads them, and fails on any difference.
+#
+# Usage: python benchmark/what_if.py --snapshot snapshot.json --limit-changes=-0.1,0,0.1 --forecast-shifts 0,250 --check
+#        python benchmark/what_if.py --synthetic-entities 50 --synthetic-requests 5000 --check
+import argparse
+import copy
+import itertools
+import json
+import os
+import random
+import sys
+from collections import defaultdict
+from decimal import Decimal
+from types import SimpleNamespace
+
+import numpy as np
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root_dir, 'process-requests'))
+sys.path.insert(0, os.path.join(root_dir, 'common-layer'))
+import admission  # noqa: E402
+from accruals import fold_accrual_counters  # noqa: E402
+from keys import budget_partition_keys  # noqa: E402
+from money import to_micros  # noqa: E402
+
+# outcome codes of a request in a scenario
+outcome_names = {0: 'unchanged', 1: admission.pending_req_status, 2: admission.blocked_req_status, 3: admission.approved_req_status}
+outcome_codes = {None: 0, admission.pending_req_status: 1, admission.blocked_req_status: 2, admission.approved_req_status: 3}
+amount_attributes = ('budgetLimit', 'forecastedSpend', 'accruedForecastedSpend', 'accruedBlockedSpend', 'accruedApprovedSpend')
+# the evaluation order of process-requests
+status_order = (admission.pending_req_status, admission.blocked_req_status, admission.saved_req_status)
+
+
+# Snapshot file: {"budgets": [budget rows], "requests": [request items]}, as exported by --export
+def load_snapshot(path):
+    with open(path) as snapshot_file:
+        snapshot = json.load(snapshot_file, parse_float=Decimal, parse_int=Decimal)
+    return snapshot['budgets'], snapshot['requests']
+
+
+# Export the budgets and the active requests of a deployed table to a snapshot file
+def export_snapshot(table_name, region_name, path):
+    import boto3
+    from boto3.dynamodb.conditions import Key
+
+    table = boto3.resource('dynamodb', region_name=region_name).Table(table_name)
+    items = []
+    for partition_key in budget_partition_keys():
+        items.extend(query_all(table, KeyConditionExpression=Key('partitionKey').eq(partition_key)))
+    # the accruals of the accrual counters are summed into their budgets
+    budgets = fold_accrual_counters(items)
+    for budget in budgets:
+        del budget['accrualCounters']
+    requests = []
+    for budget in budgets:
+        for request_status in status_order:
+            requests.extend(query_all(
+                table, IndexName='query-by-entity-status',
+                KeyConditionExpression=Key('entityStatus').eq('{}#{}'.format(budget['businessEntity'], request_status))))
+    with open(path, 'w') as snapshot_file:
+        json.dump({'budgets': budgets, 'requests': requests}, snapshot_file, indent=2, default=str)
+    print('Exported {} budgets and {} requests to {}'.format(len(budgets), len(requests), path))
+
+
+def query_all(table, **query_args):
+    items = []
+    while True:
+        response = table.query(**query_args)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Random budgets and requests with the price shapes of the benchmark harness
+def synthetic_snapshot(entity_count, request_count, seed):
+    rng = random.Random(seed)
+    budgets = []
+    for index in range(entity_count):
+        limit = Decimal(rng.choice([100, 250, 500, 1000, 5000]))
+        budgets.append({
+            'businessEntity': 'business_entity_{}'.format(index),
+            'budgetLimit': limit,
+            'forecastedSpend': limit * Decimal(rng.choice(['0.2', '0.4', '0.6', '0.8'])),
+            'accruedForecastedSpend': Decimal(0),
+            'accruedBlockedSpend': Decimal(0),
+            'accruedApprovedSpend': Decimal(0),
+            'budgetForecastProcessed': rng.random() < 0.5,
+        })
+    requests = []
+    for index in range(request_count):
+        unit_price = Decimal(rng.choice(['0.0058', '0.0116', '0.0232', '0.0464', '0.1', '0.2', '0.4', '1.6']))
+        requests.append({
+            'rangeKey': 'request_{}'.format(index),
+            'businessEntity': rng.choice(budgets)['businessEntity'],
+            'requestStatus': rng.choices(status_order, weights=[1, 4, 15])[0],
+            'requestTime': '2020-01-01 00:00:{:06d}'.format(index),
+            'pricingInfoAtRequest': {'EstCurrMonthPrice': unit_price * rng.randint(1, 744), '31DayPrice': unit_price * 744},
+        })
+    return budgets, requests
+
+
+# Budget of a business entity in a scenario, the limit scaled and the forecast shifted. The amounts
+# are rounded to micro-dollars as the Lambda stores them
+def apply_scenario(budget, scenario):
+    budget = copy.deepcopy(budget)
+    limit_change, forecast_shift = scenario
+    budget['budgetLimit'] = budget['budgetLimit'] * (1 + limit_change)
+    budget['forecastedSpend'] = budget['forecastedSpend'] + forecast_shift
+    if budget['accruedForecastedSpend'] > 0:
+        budget['accruedForecastedSpend'] = budget['accruedForecastedSpend'] + forecast_shift
+    for name in amount_attributes:
+        budget[name] = to_micros(budget[name])
+    return budget
+
+
+# Active requests per business entity in the order process-requests evaluates them, every blocked
+# request in requestTime order. Requests are read like the records of process-requests, with their
+# amounts in micro-dollars
+def entity_queues(requests):
+    queues = defaultdict(list)
+    for request_status in status_order:
+        for request in sorted((r for r in requests if r['requestStatus'] == request_status),
+                              key=lambda r: (r['requestTime'], r['rangeKey'])):
+            queues[request['businessEntity']].append(SimpleNamespace(
+                rangeKey=request['rangeKey'],
+                requestStatus=request_status,
+                requestTime=request['requestTime'],
+                requestedAmount=to_micros(request['pricingInfoAtRequest']['EstCurrMonthPrice']),
+                requestedMonthlyAmount=to_micros(request['pricingInfoAtRequest']['31DayPrice'])))
+    return queues
+
+
+# Refuse amounts whose sums could leave int64
+def check_bounds(budgets_by_scenario, queues):
+    amounts = [budget[name] for budgets in budgets_by_scenario for budget in budgets.values() for name in amount_attributes]
+    for queue in queues.values():
+        for request in queue:
+            amounts.extend((request.requestedAmount, request.requestedMonthlyAmount))
+    longest_queue = max([len(queue) for queue in queues.values()] + [1])
+    if max(abs(amount) for amount in amounts) * (2 * longest_queue + len(amount_attributes)) >= 2 ** 62:
+        raise ValueError('The amounts of the snapshot do not fit int64 micro-dollars')
+
+
+# Evaluate the queue of a business entity for every scenario at once. Requests depend on the
+# accruals left by the ones before them, so the queue is walked in order with one vector
+# entry per scenario. Returns the outcome code of every request per scenario and the final accruals
+def simulate_entity(budgets, queue):
+    state = {name: np.array([budget[name] for budget in budgets], dtype=np.int64) for name in amount_attributes}
+    forecast_processed = budgets[0]['budgetForecastProcessed']
+    if not forecast_processed:
+        state['accruedForecastedSpend'] = state['forecastedSpend'].copy()
+    pending_exists = np.full(len(budgets), any(r.requestStatus == admission.pending_req_status for r in queue))
+    outcomes = np.zeros((len(budgets), len(queue)), dtype=np.int8)
+    for index, request in enumerate(queue):
+        status = request.requestStatus
+        requested_amt = request.requestedAmount
+        requested_amt_monthly = request.requestedMonthlyAmount
+        blocked = state['accruedBlockedSpend']
+        approved = state['accruedApprovedSpend']
+        forecast_spend = np.where(state['accruedForecastedSpend'] > 0, state['accruedForecastedSpend'], state['forecastedSpend'])
+        fits = state['budgetLimit'] - forecast_spend - requested_amt_monthly - blocked - approved >= 0
+        notify = ~fits & (~pending_exists | (not forecast_processed and status == admission.pending_req_status))
+        outcome = np.where(fits, 3, np.where(notify, 1, 0))
+        new_blocked = blocked
+        if status == admission.saved_req_status:
+            new_blocked = np.where(fits, blocked, blocked + requested_amt_monthly)
+            outcome = np.where(~fits & ~notify, 2, outcome)
+        if status in (admission.pending_req_status, admission.blocked_req_status):
+            new_blocked = np.where(fits, blocked - requested_amt_monthly, blocked)
+            pending_exists = np.where(fits, False, pending_exists)
+        pending_exists = pending_exists | notify
+        state['accruedForecastedSpend'] = np.where(fits, forecast_spend + requested_amt, state['accruedForecastedSpend'])
+        state['accruedApprovedSpend'] = np.where(fits, approved + (requested_amt_monthly - requested_amt), approved)
+        state['accruedBlockedSpend'] = new_blocked
+        outcomes[:, index] = outcome
+    return outcomes, state
+
+
+# The same evaluation with the rule of the Lambda, one scenario at a time. Pending and saved requests are
+# evaluated in order, the blocked requests with evaluate_blocked_requests as process_blocked_requests
+# does, from the requests the blocked cost and entity status indexes would return
+def reference_entity(budget, queue):
+    budget = admission.start_sweep(dict(budget),
+                                   pending_request_exists=any(r.requestStatus == admission.pending_req_status for r in queue))
+    outcomes = {}
+
+    def evaluate(request):
+        outcomes[request.rangeKey] = outcome_codes[admission.admit(
+            budget, request.requestStatus, request.requestedAmount, request.requestedMonthlyAmount)]
+
+    def next_unfitting_request(after_request_time, fitting_ids):
+        return next((request for request in blocked_requests if request.rangeKey not in fitting_ids and
+                     (after_request_time is None or request.requestTime > after_request_time)), None)
+
+    for request in queue:
+        if request.requestStatus == admission.pending_req_status:
+            evaluate(request)
+    blocked_requests = [request for request in queue if request.requestStatus == admission.blocked_req_status]
+    budget_headroom = admission.headroom(budget)
+    fitting_requests = [request for request in blocked_requests
+                        if budget_headroom >= 0 and request.requestedMonthlyAmount <= budget_headroom]
+    admission.evaluate_blocked_requests(budget, fitting_requests, next_unfitting_request, evaluate)
+    for request in queue:
+        if request.requestStatus == admission.saved_req_status:
+            evaluate(request)
+    return [outcomes.get(request.rangeKey, 0) for request in queue], budget
+
+
+def simulate(budgets, requests, scenarios, check=False):
+    queues = entity_queues(requests)
+    budgets_by_scenario = [{budget['businessEntity']: apply_scenario(budget, scenario) for budget in budgets} for scenario in scenarios]
+    check_bounds(budgets_by_scenario, queues)
+    totals = np.zeros((len(scenarios), len(outcome_names)), dtype=np.int64)
+    mismatches = []
+    for budget in budgets:
+        entity = budget['businessEntity']
+        queue = queues.get(entity, [])
+        if not queue:
+            continue
+        scenario_budgets = [scenario_budgets[entity] for scenario_budgets in budgets_by_scenario]
+        outcomes, state = simulate_entity(scenario_budgets, queue)
+        for code in outcome_names:
+            totals[:, code] += (outcomes == code).sum(axis=1)
+        if check:
+            for index, scenario_budget in enumerate(scenario_budgets):
+                expected_outcomes, expected_budget = reference_entity(scenario_budget, queue)
+                expected_state = [expected_budget[name] for name in amount_attributes]
+                actual_state = [int(state[name][index]) for name in amount_attributes]
+                if list(outcomes[index]) != expected_outcomes or actual_state != expected_state:
+                    mismatches.append({'businessEntity': entity, 'scenario': scenarios[index]})
+    result = []
+    for index, (limit_change, forecast_shift) in enumerate(scenarios):
+        row = {'budgetLimitChange': str(limit_change), 'forecastShift': str(forecast_shift)}
+        row.update({outcome_names[code]: int(totals[index, code]) for code in outcome_names})
+        result.append(row)
+    return result, mismatches
+
+
+def parse_decimals(values):
+    return [Decimal(value) for value in values.split(',') if value]
+
+
+def print_report(result):
+    columns = ['budgetLimitChange', 'forecastShift'] + [outcome_names[code] for code in sorted(outcome_names)]
+    print(' '.join('{:>18}'.format(column) for column in columns))
+    for row in result:
+        print(' '.join('{:>18}'.format(row[column]) for column in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate the admission rule of process-requests for a grid of scenarios')
+    parser.add_argument('--snapshot', help='snapshot file with budgets and requests')
+    parser.add_argument('--export', help='export the budgets and active requests of --table to this snapshot file and exit')
+    parser.add_argument('--table', help='budgets table to export')
+    parser.add_argument('--region', help='region of the budgets table')
+    parser.add_argument('--synthetic-entities', type=int, default=20, help='business entities of a synthetic snapshot')
+    parser.add_argument('--synthetic-requests', type=int, default=1000, help='requests of a synthetic snapshot')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic snapshot')
+    parser.add_argument('--limit-changes', default='-0.2,-0.1,0,0.1,0.2', help='relative budget limit changes, comma separated')
+    parser.add_argument('--forecast-shifts', default='0,100,500', help='absolute forecast shifts, comma separated')
+    parser.add_argument('--check', action='store_true', help='compare every scenario with the rule of the Lambda')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+    if args.export:
+        export_snapshot(args.table, args.region, args.export)
+        sys.exit(0)
+    if args.snapshot:
+        budgets, requests = load_snapshot(args.snapshot)
+    else:
+        budgets, requests = synthetic_snapshot(args.synthetic_entities, args.synthetic_requests, args.seed)
+    scenarios = list(itertools.product(parse_decimals(args.limit_changes), parse_decimals(args.forecast_shifts)))
+    result, mismatches = simulate(budgets, requests, scenarios, args.check)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(result, report_file, indent=2)
+    if args.check:
+        print('Differential check: {} mismatching business entity scenarios'.format(len(mismatches)))
+        for mismatch in mismatches[:20]:
+            print('  {} {}'.format(mismatch['businessEntity'], [str(value) for value in mismatch['scenario']]))
+        sys.exit(1 if mismatches else 0)
@@ -0,0 +1,286 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Accrual updates shared by the workflow functions. Accruals are only ever
+# changed with ADD expressions so that concurrent approvals, terminations and
+# sweeps never overwrite each other. The accruals of a budget are its row plus
+# AccrualShards counter items next to it. Approvals, terminations and sweeps add
+# their deltas to a counter picked at random, so concurrent writers rarely
+# contend for the same item, and readers sum the counters into the budget.
+# Updates of the budget row are guarded by a condition so that a missing row
+# is never created by accident, and every change of the row also increments its
+# budgetVersion, so readers can tell whether a snapshot of the row is current.
+# Every accrual update is staged with a check of the row, at the version it was
+# computed against when the deltas depend on the budget, see budget_check, so
+# counters never outlive their budget.
+# The monthly reset of rebase-budgets compacts the counters into the row.
+# The headroom a sweep leaves, lastHeadroom, is kept on the first counter, so
+# that sweeps do not write the row on every accrual change.
+# Accruals and other amounts are given in micro-dollars, see money.py.
+import logging
+import os
+import random
+from collections import defaultdict
+
+from clients import to_item
+from keys import accrual_counter_key, split_accrual_counter_key
+from money import money_attributes, to_item as to_money_item
+
+logger = logging.getLogger()
+accrual_attributes = ('accruedForecastedSpend', 'accruedBlockedSpend', 'accruedApprovedSpend')
+budget_version_attribute = 'budgetVersion'
+accrual_shards = int(os.environ.get('AccrualShards', '4'))
+
+
+# Build the TransactWriteItems action that adds the given deltas to an accrual counter of a budget,
+# stored under the partition key of the budget. The counter is created by the first delta added
+# to it. Attributes in set_attributes are set on the counter as they are. Returns None when there
+# is nothing to change
+def accrual_update(table_name, budget_partition_key, budget_range_key, forecasted=0, blocked=0, approved=0, shard=None,
+                   set_attributes=None):
+    names = {}
+    values = {}
+    money_values = set()
+    add_expressions = []
+    for name, delta in zip(accrual_attributes, (forecasted, blocked, approved)):
+        if delta == 0:
+            continue
+        index = len(names)
+        names['#a{}'.format(index)] = name
+        values[':a{}'.format(index)] = delta
+        money_values.add(':a{}'.format(index))
+        add_expressions.append('#a{0} :a{0}'.format(index))
+    set_expressions = []
+    for name, value in (set_attributes or {}).items():
+        index = len(names)
+        names['#a{}'.format(index)] = name
+        values[':a{}'.format(index)] = value
+        if name in money_attributes:
+            money_values.add(':a{}'.format(index))
+        set_expressions.append('#a{0}=:a{0}'.format(index))
+    if not add_expressions and not set_expressions:
+        return None
+    if shard is None:
+        shard = random.randrange(accrual_shards)
+    update_expression = ' '.join(
+        clause for clause in (
+            'set ' + ', '.join(set_expressions) if set_expressions else '',
+            'add ' + ', '.join(add_expressions) if add_expressions else ''
+        ) if clause
+    )
+    return {'Update': {
+        'TableName': table_name,
+        'Key': to_item({'partitionKey': budget_partition_key, 'rangeKey': accrual_counter_key(budget_range_key, shard)}),
+        'UpdateExpression': update_expression,
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': to_money_item(values, money_values)
+    }}
+
+
+# Build the TransactWriteItems action that adds the given deltas to the accruals on the row of a budget,
+# keyed by the partition key the budget was read from. Attributes in set_attributes are set
+# on the row as they are and expected_attributes must match the stored values for the update to succeed
+def budget_update(table_name, budget_partition_key, budget_range_key, forecasted=0, blocked=0, approved=0,
+                  set_attributes=None, expected_attributes=None):
+    names = {}
+    values = {}
+    money_values = set()
+    add_expressions = []
+    for name, delta in zip(accrual_attributes, (forecasted, blocked, approved)):
+        if delta == 0 or (set_attributes and name in set_attributes):
+            continue
+        index = len(names)
+        names['#a{}'.format(index)] = name
+        values[':a{}'.format(index)] = delta
+        money_values.add(':a{}'.format(index))
+        add_expressions.append('#a{0} :a{0}'.format(index))
+    set_expressions = []
+    for name, value in (set_attributes or {}).items():
+        index = len(names)
+        names['#a{}'.format(index)] = name
+        values[':a{}'.format(index)] = value
+        if name in money_attributes:
+            money_values.add(':a{}'.format(index))
+        set_expressions.append('#a{0}=:a{0}'.format(index))
+    conditions = ['attribute_exists(rangeKey)']
+    for name, value in (expected_attributes or {}).items():
+        index = len(names)
+        names['#a{}'.format(index)] = name
+        values[':a{}'.format(index)] = value
+        if name in money_attributes:
+            money_values.add(':a{}'.format(index))
+        conditions.append('#a{0}=:a{0}'.format(index))
+    if add_expressions or set_expressions:
+        names['#v'] = budget_version_attribute
+        values[':v'] = 1
+        add_expressions.append('#v :v')
+    update_expression = ' '.join(
+        clause for clause in (
+            'set ' + ', '.join(set_expressions) if set_expressions else '',
+            'add ' + ', '.join(add_expressions) if add_expressions else ''
+        ) if clause
+    )
+    update = {
+        'TableName': table_name,
+        'Key': to_item({'partitionKey': budget_partition_key, 'rangeKey': budget_range_key}),
+        'ConditionExpression': ' and '.join(conditions)
+    }
+    if names:
+        update['ExpressionAttributeNames'] = names
+    if values:
+        update['ExpressionAttributeValues'] = to_money_item(values, money_values)
+    # nothing to change, the budget row is only checked
+    if not update_expression:
+        return {'ConditionCheck': update}
+    update['UpdateExpression'] = update_expression
+    return {'Update': update}
+
+
+# Build the TransactWriteItems action that checks that the row of a budget exists at the given budgetVersion,
+# version 0 stands for rows written before the version existed. Staged with an accrual update, the
+# deltas are only added while the budget is the one they were computed for. Without a version only
+# the existence of the row is checked, for deltas that do not depend on the state of the budget
+def budget_check(table_name, budget_partition_key, budget_range_key, version=None):
+    check = {
+        'TableName': table_name,
+        'Key': to_item({'partitionKey': budget_partition_key, 'rangeKey': budget_range_key})
+    }
+    if version is None:
+        check['ConditionExpression'] = 'attribute_exists(rangeKey)'
+        return {'ConditionCheck': check}
+    check['ExpressionAttributeNames'] = {'#v': budget_version_attribute}
+    if version:
+        check['ConditionExpression'] = 'attribute_exists(rangeKey) and #v = :v'
+        check['ExpressionAttributeValues'] = to_item({':v': version})
+    else:
+        check['ConditionExpression'] = 'attribute_exists(rangeKey) and attribute_not_exists(#v)'
+    return {'ConditionCheck': check}
+
+
+# Build the TransactWriteItems action that sets the given accruals of a counter, or deletes the counter
+# when attributes is None. It only applies while the counter still holds the accruals it was read with
+def counter_update(table_name, counter, attributes=None):
+    names = {}
+    values = {}
+    conditions = []
+    set_expressions = []
+    for name in accrual_attributes:
+        index = len(names)
+        names['#a{}'.format(index)] = name
+        if name in counter:
+            values[':e{}'.format(index)] = counter[name]
+            conditions.append('#a{0}=:e{0}'.format(index))
+        else:
+            conditions.append('attribute_not_exists(#a{})'.format(index))
+        if attributes and name in attributes:
+            values[':a{}'.format(index)] = attributes[name]
+            set_expressions.append('#a{0}=:a{0}'.format(index))
+    action = {
+        'TableName': table_name,
+        'Key': to_item({'partitionKey': counter['partitionKey'], 'rangeKey': counter['rangeKey']}),
+        'ConditionExpression': 'attribute_exists(rangeKey) and ' + ' and '.join(conditions),
+        'ExpressionAttributeNames': names
+    }
+    if values:
+        action['ExpressionAttributeValues'] = to_money_item(values, values.keys())
+    if attributes is None:
+        return {'Delete': action}
+    action['UpdateExpression'] = 'set ' + ', '.join(set_expressions)
+    return {'Update': action}
+
+
+# Fold the accrual counters read together with their budgets into the budgets. The accruals of a budget
+# become the sum of its row and its counters, the counters as read are kept in accrualCounters.
+# Counters are matched by budget range key, wherever they are stored
+def fold_accrual_counters(items):
+    budgets = []
+    counters = defaultdict(list)
+    for item in items:
+        budget_range_key, shard = split_accrual_counter_key(item['rangeKey'])
+        if shard is None:
+            budgets.append(item)
+        else:
+            counters[budget_range_key].append(item)
+    for budget in budgets:
+        budget['accrualCounters'] = counters.get(budget['rangeKey'], [])
+        for name in accrual_attributes:
+            budget[name] = budget.get(name, 0) + sum(counter.get(name, 0) for counter in budget['accrualCounters'])
+    return budgets
+
+
+# The headroom the last sweep left on the counters of a budget, None when no sweep recorded one.
+# A lastHeadroom on the budget row was written by an earlier version and is stale
+def last_headroom(budget):
+    for counter in budget['accrualCounters']:
+        if 'lastHeadroom' in counter:
+            return counter['lastHeadroom']
+    return None
+
+
+# Build the TransactWriteItems action that sets attributes on a request, only while the
+# request is still in one of the expected states. Attributes set to None are removed
+def request_update(table_name, request_partition_key, request_id, attributes, expected_statuses=None):
+    names = {}
+    values = {}
+    set_expressions = []
+    remove_expressions = []
+    money_values = set()
+    for name, value in attributes.items():
+        index = len(names)
+        names['#a{}'.format(index)] = name
+        if value is None:
+            remove_expressions.append('#a{}'.format(index))
+            continue
+        values[':a{}'.format(index)] = value
+        if name in money_attributes:
+            money_values.add(':a{}'.format(index))
+        set_expressions.append('#a{0}=:a{0}'.format(index))
+    update_expression = 'set ' + ', '.join(set_expressions)
+    if remove_expressions:
+        update_expression = update_expression + ' remove ' + ', '.join(remove_expressions)
+    update = {
+        'TableName': table_name,
+        'Key': to_item({'partitionKey': request_partition_key, 'rangeKey': request_id}),
+        'UpdateExpression': update_expression,
+        'ExpressionAttributeNames': names
+    }
+    if expected_statuses:
+        names['#status'] = 'requestStatus'
+        placeholders = []
+        for index, status in enumerate(expected_statuses):
+            values[':s{}'.format(index)] = status
+            placeholders.append(':s{}'.format(index))
+        update['ConditionExpression'] = '#status in ({})'.format(', '.join(placeholders))
+    if values:
+        update['ExpressionAttributeValues'] = to_money_item(values, money_values)
+    return {'Update': update}
+
+
+# Commit a list of actions atomically, returns False when a condition check failed
+def transact(client, actions):
+    try:
+        client.transact_write_items(TransactItems=actions)
+        return True
+    except client.exceptions.TransactionCanceledException as e:
+        reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+        if 'ConditionalCheckFailed' in reasons:
+            logger.info("Transaction cancelled by a condition check: {}".format(reasons))
+            return False
+        raise
@@ -0,0 +1,135 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Lazily constructed, cached AWS clients shared by the workflow functions.
+# boto3 and requests are only imported when a function first needs them and
+# the low-level clients are used instead of resources, which skips loading
+# the resource models during a cold start. Items are (de)serialized to the
+# DynamoDB wire format with the helpers below.
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_clients = {}
+_lock = threading.Lock()
+_serializer = None
+_deserializer = None
+_http_session = None
+_client_hooks = []
+
+
+# Get the cached client of a service, created on first use
+def get_client(service_name, region_name=None, max_pool_connections=None):
+    region_name = region_name or os.environ.get('AWS_REGION')
+    key = (service_name, region_name, max_pool_connections)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                config = Config(max_pool_connections=max_pool_connections) if max_pool_connections else None
+                client = boto3.client(service_name, region_name=region_name, config=config)
+                for hook in _client_hooks:
+                    hook(service_name, client)
+                _clients[key] = client
+    return client
+
+
+# Call hook(service_name, client) for every client created from now on, used to instrument clients
+def on_client_created(hook):
+    _client_hooks.append(hook)
+
+
+def dynamodb_client(max_pool_connections=None):
+    return get_client('dynamodb', max_pool_connections=max_pool_connections)
+
+
+def sns_client(max_pool_connections=None):
+    return get_client('sns', max_pool_connections=max_pool_connections)
+
+
+def budgets_client():
+    return get_client('budgets')
+
+
+def pricing_client():
+    # the Pricing API is only served from a few regions
+    return get_client('pricing', region_name='us-east-1')
+
+
+# Get the shared requests session, the connection pool is sized on first use
+def http_session(pool_size=10):
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+                _http_session = session
+    return _http_session
+
+
+# Convert a python value to a DynamoDB attribute value
+def to_attribute_value(value):
+    global _serializer
+    if _serializer is None:
+        from boto3.dynamodb.types import TypeSerializer
+        _serializer = TypeSerializer()
+    return _serializer.serialize(value)
+
+
+# Convert a dict of python values to DynamoDB attribute values, used for items, keys and expression values
+def to_item(values):
+    return {name: to_attribute_value(value) for name, value in values.items()}
+
+
+# Convert a DynamoDB item to python values, numbers become Decimal as with the resource API
+def from_item(item):
+    global _deserializer
+    if _deserializer is None:
+        from boto3.dynamodb.types import TypeDeserializer
+        _deserializer = TypeDeserializer()
+    return {name: _deserializer.deserialize(value) for name, value in item.items()}
+
+
+# Query every page lazily and yield the items deserialized with decode_item
+def query_items(decode_item=from_item, **query_args):
+    paginator = dynamodb_client().get_paginator('query')
+    for page in paginator.paginate(**query_args):
+        for item in page['Items']:
+            yield decode_item(item)
+
+
+# Query the items of several partition keys in parallel, e.g. the shards of the budgets.
+# Every partition is read to the end and the items are returned partition by partition
+def query_partitions(partition_keys, max_workers=8, decode_item=from_item, **query_args):
+    def query_partition(partition_key):
+        return list(query_items(
+            decode_item,
+            KeyConditionExpression='partitionKey = :p',
+            ExpressionAttributeValues={':p': {'S': partition_key}},
+            **query_args
+        ))
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(partition_keys)), thread_name_prefix='shard') as executor:
+        return [item for items in executor.map(query_partition, partition_keys) for item in items]
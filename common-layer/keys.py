@@ -0,0 +1,106 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Key attributes of the budgets table shared by the workflow functions. Requests
+# that still wait on a decision carry an entityStatus attribute made of their
+# business entity and status, which keys the sparse query-by-entity-status
+# index. The attribute is removed once a request leaves those states, so the
+# index only ever holds the active queue of every business entity.
+# Blocked requests also carry blockedEntity and blockedCost (their 31 day
+# price), which key the sparse query-by-blocked-cost index that orders the
+# blocked requests of a business entity by price.
+#
+# Requests and budgets are spread over write shards so that a launch storm does
+# not land on a single partition. The partition key of an item is its kind and
+# a shard derived from its range key, e.g. REQUEST#3 for a stack id. Items
+# written before the shards existed keep the bare kind as partition key until
+# migrations/shard_keys.py moves them, readers look in both places.
+#
+# The accruals of a budget are also spread over counter items stored next to the
+# budget row, under the range key <budget range key>#ACCRUAL#<n>.
+import os
+import zlib
+
+request_partition = 'REQUEST'
+budget_partition = 'BUDGET'
+request_shards = int(os.environ.get('RequestShards', '8'))
+budget_shards = int(os.environ.get('BudgetShards', '4'))
+accrual_counter_separator = '#ACCRUAL#'
+entity_status_index = 'query-by-entity-status'
+entity_status_attribute = 'entityStatus'
+indexed_request_statuses = ('SAVED', 'PENDING', 'BLOCKED')
+# entityStatus of a system approved request until its stack got the approval callback
+callback_pending_status = 'CALLBACK_PENDING'
+blocked_cost_index = 'query-by-blocked-cost'
+blocked_entity_attribute = 'blockedEntity'
+blocked_cost_attribute = 'blockedCost'
+
+
+def entity_status_key(business_entity, request_status):
+    return '{}#{}'.format(business_entity, request_status)
+
+
+# Attributes that keep the sparse index in step with a status change, None removes the attribute
+def entity_status_attributes(business_entity, request_status):
+    if request_status in indexed_request_statuses:
+        return {entity_status_attribute: entity_status_key(business_entity, request_status)}
+    return {entity_status_attribute: None}
+
+
+# Attributes that keep the blocked cost index in step with a status change, None removes the attributes
+def blocked_cost_attributes(business_entity, request_status, requested_amt_monthly):
+    if request_status == 'BLOCKED':
+        return {blocked_entity_attribute: business_entity, blocked_cost_attribute: requested_amt_monthly}
+    return {blocked_entity_attribute: None, blocked_cost_attribute: None}
+
+
+def shard_key(partition, range_key, shard_count):
+    return '{}#{}'.format(partition, zlib.crc32(range_key.encode('utf-8')) % shard_count)
+
+
+def request_partition_key(request_id):
+    return shard_key(request_partition, request_id, request_shards)
+
+
+def budget_partition_key(budget_range_key):
+    return shard_key(budget_partition, budget_range_key, budget_shards)
+
+
+# Every partition key items of a kind can be stored under, the unsharded legacy key first
+def partition_keys(partition, shard_count):
+    return [partition] + ['{}#{}'.format(partition, shard) for shard in range(shard_count)]
+
+
+def request_partition_keys():
+    return partition_keys(request_partition, request_shards)
+
+
+def budget_partition_keys():
+    return partition_keys(budget_partition, budget_shards)
+
+
+def accrual_counter_key(budget_range_key, shard):
+    return '{}{}{}'.format(budget_range_key, accrual_counter_separator, shard)
+
+
+# Split a budget range key into the range key of its budget and its counter shard, None for the budget row
+def split_accrual_counter_key(range_key):
+    budget_range_key, _, shard = range_key.partition(accrual_counter_separator)
+    return budget_range_key, int(shard) if shard else None
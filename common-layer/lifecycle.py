@@ -0,0 +1,42 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Lifecycle of requests in the budgets table. Requests that reached a terminal
+# state get an expiresAt, the table TTL then deletes them and archive-requests
+# moves the deleted items from the table stream to S3. The live pipeline only
+# ever keeps the requests it may still act on plus a short retention window.
+import os
+import time
+
+request_retention_days = int(os.environ.get('RequestRetentionDays', '90'))
+expiry_attribute = 'expiresAt'
+
+
+# Terminal states are rejections and anything whose resource was terminated,
+# approved requests stay until their stack is deleted
+def is_terminal_status(request_status):
+    return request_status in ('REJECTED_ADMIN', 'REJECTED_SYSTEM') or request_status.endswith('_TERMINATED')
+
+
+# Attributes that start the retention window of a request entering a terminal state
+def expiry_attributes(request_status):
+    if not is_terminal_status(request_status):
+        return {}
+    return {expiry_attribute: int(time.time()) + request_retention_days * 24 * 3600}
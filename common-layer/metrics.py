@@ -0,0 +1,148 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Lightweight instrumentation of the workflow functions. Phases are timed and
+# counters accumulated during an invocation, then written as one CloudWatch
+# Embedded Metric Format (EMF) document when the handler returns. Lambda ships
+# stdout to CloudWatch Logs, which extracts the metrics; tests and offline runs
+# swap the sink for a list. DynamoDB clients created through clients.py are
+# instrumented with botocore hooks for consumed capacity, call and retry counts.
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import clients
+
+namespace = os.environ.get('MetricsNamespace', 'BudgetApprovalWorkflow')
+
+
+# Default sink, one JSON document per line on stdout
+def stdout_sink(document):
+    print(json.dumps(document))
+
+
+# Sink that keeps the documents, for tests and offline runs
+class ListSink:
+
+    def __init__(self):
+        self.documents = []
+
+    def __call__(self, document):
+        self.documents.append(document)
+
+
+class Metrics:
+
+    def __init__(self, function_name, sink=stdout_sink):
+        self.function_name = function_name
+        self.sink = sink
+        self._values = OrderedDict()
+        self._properties = {}
+        self._lock = threading.Lock()
+        clients.on_client_created(self.instrument_client)
+
+    # Add to a metric, values of the same metric are summed over the invocation
+    def add(self, name, value=1, unit='Count'):
+        with self._lock:
+            current = self._values.get(name)
+            self._values[name] = (current[0] + value if current else value, unit)
+
+    # Attach a value to the document that is searchable in the logs but is not a metric
+    def set_property(self, name, value):
+        with self._lock:
+            self._properties[name] = value
+
+    # Time a phase, phases that run several times or in several threads are summed
+    @contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase + 'Time', (time.perf_counter() - start) * 1000, 'Milliseconds')
+
+    # Time the fetching of the items of a lazy iterable, the time spent on the items is not counted
+    def timed_iter(self, phase, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.timer(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    # Write the metrics of the invocation to the sink and start over
+    def flush(self):
+        with self._lock:
+            values = self._values
+            properties = self._properties
+            self._values = OrderedDict()
+            self._properties = {}
+        if not values:
+            return None
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in values.items()]
+                }]
+            },
+            'FunctionName': self.function_name,
+        }
+        document.update(properties)
+        document.update({name: value for name, (value, _) in values.items()})
+        self.sink(document)
+        return document
+
+    # Decorator for a Lambda handler, times the invocation and flushes the metrics when it returns
+    def handler(self, function):
+        @functools.wraps(function)
+        def wrapper(event, context):
+            try:
+                with self.timer('Handler'):
+                    return function(event, context)
+            finally:
+                self.flush()
+        return wrapper
+
+    # Count the calls, retries and consumed capacity of a DynamoDB client
+    def instrument_client(self, service_name, client):
+        if service_name != 'dynamodb':
+            return
+        client.meta.events.register('provide-client-params.dynamodb', self._request_consumed_capacity)
+        client.meta.events.register('after-call.dynamodb', self._record_call)
+
+    def _request_consumed_capacity(self, params, model, **kwargs):
+        if 'ReturnConsumedCapacity' in model.input_shape.members and 'ReturnConsumedCapacity' not in params:
+            params['ReturnConsumedCapacity'] = 'TOTAL'
+
+    def _record_call(self, parsed, model, **kwargs):
+        self.add('DynamoDB' + model.name + 'Calls')
+        self.add('DynamoDBRetries', parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+        consumed = parsed.get('ConsumedCapacity', [])
+        for capacity in consumed if isinstance(consumed, list) else [consumed]:
+            self.add('DynamoDBConsumedCapacity', capacity.get('CapacityUnits', 0), 'Count')
@@ -0,0 +1,119 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Fixed-point money shared by the workflow functions. Amounts are handled as
+# integer micro-dollars, so accrual arithmetic is exact and is plain integer
+# arithmetic. The table and the custom resource data keep amounts as dollar
+# numbers rounded to the micro-dollar, which are parsed from and formatted to
+# their wire strings directly without going through Decimal.
+import re
+from decimal import ROUND_HALF_EVEN, Decimal, InvalidOperation
+
+from clients import from_item as from_wire_item, to_item as to_wire_item
+
+money_places = 6
+micros_per_dollar = 10 ** money_places
+# amounts stored on budgets, accrual counters and requests, pricing amounts live in pricingInfoAtRequest
+budget_money_attributes = frozenset((
+    'budgetLimit', 'actualSpend', 'forecastedSpend', 'accruedForecastedSpend', 'accruedBlockedSpend',
+    'accruedApprovedSpend', 'lastHeadroom', 'curActualSpend'))
+pricing_money_attributes = frozenset(('UnitPrice', 'EstCurrMonthPrice', '31DayPrice', 'NextMonthPrice'))
+money_attributes = budget_money_attributes | pricing_money_attributes | frozenset(('blockedCost',))
+_micro = Decimal(1).scaleb(-money_places)
+# sign, whole and fraction digits of a plain number as stored in the table, e.g. -12.5
+_plain_number = re.compile(r'([+-]?)(\d*)(?:\.(\d*))?')
+
+
+# Convert an amount in dollars to micro-dollars. Numbers with up to six decimals, as stored in the table,
+# are parsed without Decimal, anything more precise is rounded half to even. Raises ValueError for
+# anything that is not a finite number, such as an empty string
+def to_micros(value):
+    if isinstance(value, int):
+        return value * micros_per_dollar
+    if isinstance(value, str):
+        match = _plain_number.fullmatch(value)
+        if match:
+            sign, whole, fraction = match.groups('')
+            if (whole or fraction) and len(fraction) <= money_places:
+                micros = int(whole or '0') * micros_per_dollar
+                if fraction:
+                    micros = micros + int(fraction.ljust(money_places, '0'))
+                return -micros if sign == '-' else micros
+    elif isinstance(value, float):
+        value = repr(value)
+    try:
+        return int(Decimal(value).quantize(_micro, rounding=ROUND_HALF_EVEN).scaleb(money_places))
+    except (InvalidOperation, TypeError):
+        raise ValueError('Not an amount in dollars: {!r}'.format(value))
+
+
+# Format micro-dollars as a dollar number, e.g. 7440000 as 7.44
+def to_number(micros):
+    whole, fraction = divmod(abs(micros), micros_per_dollar)
+    sign = '-' if micros < 0 else ''
+    if not fraction:
+        return '{}{}'.format(sign, whole)
+    return '{}{}.{}'.format(sign, whole, '{:06d}'.format(fraction).rstrip('0'))
+
+
+def to_decimal(micros):
+    return Decimal(to_number(micros))
+
+
+# DynamoDB attribute value of an amount in micro-dollars
+def to_attribute_value(micros):
+    return {'N': to_number(micros)}
+
+
+# Convert a dict of python values to DynamoDB attribute values like clients.to_item, the values
+# named in money_names are amounts in micro-dollars. Pricing maps such as pricingInfoAtRequest are
+# converted the same way
+def to_item(values, money_names=money_attributes):
+    item = {}
+    for name, value in values.items():
+        if name in money_names and isinstance(value, int):
+            item[name] = to_attribute_value(value)
+        elif isinstance(value, dict) and not money_attributes.isdisjoint(value):
+            item[name] = {'M': to_item(value)}
+        else:
+            item[name] = to_wire_item({name: value})[name]
+    return item
+
+
+# Convert a DynamoDB item to python values like clients.from_item, amounts become micro-dollars.
+# Pricing maps such as pricingInfoAtRequest are decoded the same way
+def from_item(item):
+    values = from_wire_item(item)
+    for name, value in item.items():
+        if name in money_attributes and 'N' in value:
+            values[name] = to_micros(value['N'])
+        elif 'M' in value and not money_attributes.isdisjoint(value['M']):
+            values[name] = from_item(value['M'])
+    return values
+
+
+# Convert the amounts of a dict of custom resource data, numbers or strings in dollars, to micro-dollars
+def from_data(values):
+    return {name: to_micros(value) if name in money_attributes else value for name, value in values.items()}
+
+
+# Convert the amounts in micro-dollars of a dict to dollars for custom resource data
+def to_data(values):
+    return {name: to_decimal(value) if name in money_attributes else value for name, value in values.items()}
@@ -21,19 +21,39 @@
 # Reference - https://s3.amazonaws.com/cloudformation-examples/lambda/amilookup.zip
 import calendar
 import datetime
+import functools
 import logging
 import os
-from decimal import Decimal
 
-import boto3
-import requests
 import simplejson as json
 
+from clients import dynamodb_client, http_session, pricing_client
+from metrics import Metrics
+from money import to_data, to_micros, to_number
+from price_cache import DynamoPriceBackend, InMemoryPriceBackend, PriceCache, price_cache_key
+from price_index import default_index_path, load_price_index, parse_unit_price, region_lookup
+
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get('LogLevel', 'INFO'))
+metrics = Metrics('get-ec2-pricing')
 region = os.environ['AWS_REGION']
+# budgets table is optional, without it the shared tier falls back to an in-memory stand-in
+if os.environ.get('BudgetsTable'):
+    price_backend = DynamoPriceBackend(dynamodb_client, os.environ['BudgetsTable'])
+else:
+    price_backend = InMemoryPriceBackend()
+# the custom resource response is limited to 4 KB, a priced instance takes about 250 bytes of it
+max_instances_per_request = int(os.environ.get('MaxInstancesPerRequest', '10'))
+hours_in_31_days = 31 * 24
+price_index = load_price_index(os.environ.get('PriceIndexPath', default_index_path))
+price_cache = PriceCache(
+    price_backend,
+    max_entries=int(os.environ.get('PriceCacheMaxEntries', '512')),
+    ttl_seconds=int(os.environ.get('PriceCacheTtlSeconds', '86400'))
+)
 
 
+@metrics.handler
 def lambda_handler(event, context):
     # Do not do anything for CFN Update and Delete
     if 'RequestType' in event and event['RequestType'] != 'Create':
@@ -41,79 +61,136 @@ def lambda_handler(event, context):
         return
 
     logger.info(json.dumps(event))
-    event_payload = event["ResourceProperties"]
-    instance_type = event_payload['InstanceType']
-    term_type = event_payload['TermType']
-    operating_system = event_payload['OperatingSystem']
+    instances = get_requested_instances(event["ResourceProperties"])
+    if len(instances) > max_instances_per_request:
+        logger.error("{} instances requested, at most {} can be priced at once".format(len(instances), max_instances_per_request))
+        send_response(event, context, 'FAILED', {})
+        return
     hours_left = hours_left_for_current_month()
     next_month_hrs = hours_for_next_month()
     logger.info("# of Hrs left for this month {}".format(hours_left))
-    unit_price = get_price_from_api(operating_system, instance_type, region, term_type)
-    logger.info("Unit Price {}".format(unit_price))
-    monthly_price = hours_left * unit_price
-    monthly_avg = 31 * 24 * unit_price
-    next_month_price = next_month_hrs * unit_price
-    logger.info("Monthly Price: {}".format(monthly_price))
+    # every distinct instance is priced once, duplicates share the unit price. Prices are
+    # computed in micro-dollars from the unit price rounded to the micro-dollar
+    unit_prices = {}
+    with metrics.timer('Lookup'):
+        for instance in instances:
+            key = (instance['OperatingSystem'], instance['InstanceType'], instance['TermType'])
+            if key not in unit_prices:
+                unit_prices[key] = to_micros(get_unit_price(key[0], key[1], region, key[2]))
+    logger.info("Unit Prices {}".format({key: to_number(price) for key, price in unit_prices.items()}))
+    logger.info("Price cache stats {}".format(price_cache.stats))
+    for name, value in price_cache.stats.items():
+        metrics.set_property('PriceCache' + name[0].upper() + name[1:], value)
+    pricing_matrix = get_pricing_matrix(instances, unit_prices, hours_left, next_month_hrs)
+    # Pricing keeps the shape of a single instance request for the templates that read it, PricingMatrix
+    # has the pricing of every instance. Requests with an Instances list also get the totals of their
+    # instances, saved as one request, see get_fleet_pricings
     result = {
-        'Pricing': {
-            'OperatingSystem': operating_system,
-            'TermType': term_type,
-            'InstanceType': instance_type,
-            'UnitPrice': unit_price,
-            'EstCurrMonthPrice': monthly_price,
-            '31DayPrice': monthly_avg,
-            'NextMonthPrice': next_month_price,
-            'HoursLeftInCurrMonth': hours_left,
-            'ResponseTime': str(datetime.datetime.utcnow()),
-        }
+        'Pricing': to_data(get_instance_pricing(pricing_matrix[0])),
+        'PricingMatrix': [to_data(row) for row in pricing_matrix]
     }
+    if 'Instances' in event["ResourceProperties"]:
+        result.update({name: to_data(pricing) for name, pricing in get_fleet_pricings(pricing_matrix).items()})
     send_response(event, context, 'SUCCESS', result)
     return result
     # instCost = Decimal(str(round(Decimal(getHoursLeft()*instCost),2)))
 
 
+# Instances to price, either the Instances list or the single InstanceType, OperatingSystem and TermType.
+# An entry may launch several instances of its type with Count
+def get_requested_instances(event_payload):
+    if 'Instances' in event_payload:
+        return [{
+            'InstanceType': instance['InstanceType'],
+            'OperatingSystem': instance['OperatingSystem'],
+            'TermType': instance['TermType'],
+            'Count': int(instance.get('Count', 1))
+        } for instance in event_payload['Instances']]
+    return [{
+        'InstanceType': event_payload['InstanceType'],
+        'OperatingSystem': event_payload['OperatingSystem'],
+        'TermType': event_payload['TermType'],
+        'Count': 1
+    }]
+
+
+# Current month, 31 day and next month projections of every instance in micro-dollars, the hours are the same for all of them
+def get_pricing_matrix(instances, unit_prices, hours_left, next_month_hrs):
+    response_time = str(datetime.datetime.utcnow())
+    pricing_matrix = []
+    for instance in instances:
+        unit_price = unit_prices[(instance['OperatingSystem'], instance['InstanceType'], instance['TermType'])]
+        pricing_matrix.append({
+            'OperatingSystem': instance['OperatingSystem'],
+            'TermType': instance['TermType'],
+            'InstanceType': instance['InstanceType'],
+            'Count': instance['Count'],
+            'UnitPrice': unit_price,
+            'EstCurrMonthPrice': hours_left * unit_price,
+            '31DayPrice': hours_in_31_days * unit_price,
+            'NextMonthPrice': next_month_hrs * unit_price,
+            'HoursLeftInCurrMonth': hours_left,
+            'ResponseTime': response_time,
+        })
+        logger.info("Monthly Price of {}: {}".format(instance['InstanceType'], to_number(pricing_matrix[-1]['EstCurrMonthPrice'])))
+    return pricing_matrix
+
+
+# Pricing of a single row of a pricing matrix, without the instance count
+def get_instance_pricing(row):
+    return {name: value for name, value in row.items() if name != 'Count'}
+
+
+# Totals of a pricing matrix by term type, the prices of different term types are alternatives for the
+# instances and are never added up. A single term type gives FleetPricing, several give FleetPricing<TermType>
+# for each of them, e.g. FleetPricingOnDemand and FleetPricingReserved
+def get_fleet_pricings(pricing_matrix):
+    term_types = sorted({row['TermType'] for row in pricing_matrix})
+    if len(term_types) == 1:
+        return {'FleetPricing': get_fleet_pricing(pricing_matrix)}
+    return {
+        'FleetPricing' + term_type: get_fleet_pricing([row for row in pricing_matrix if row['TermType'] == term_type])
+        for term_type in term_types
+    }
+
+
+# Totals of a pricing matrix, every row counted as many times as instances it launches
+def get_fleet_pricing(pricing_matrix):
+    def total(name):
+        return sum(row[name] * row['Count'] for row in pricing_matrix)
+    return {
+        'OperatingSystem': ', '.join(sorted({row['OperatingSystem'] for row in pricing_matrix})),
+        'TermType': ', '.join(sorted({row['TermType'] for row in pricing_matrix})),
+        'InstanceType': ', '.join('{} x {}'.format(row['Count'], row['InstanceType']) for row in pricing_matrix),
+        'InstanceCount': sum(row['Count'] for row in pricing_matrix),
+        'UnitPrice': total('UnitPrice'),
+        'EstCurrMonthPrice': total('EstCurrMonthPrice'),
+        '31DayPrice': total('31DayPrice'),
+        'NextMonthPrice': total('NextMonthPrice'),
+        'HoursLeftInCurrMonth': pricing_matrix[0]['HoursLeftInCurrMonth'],
+        'ResponseTime': pricing_matrix[0]['ResponseTime'],
+    }
+
+
+# Get total # of hrs in a month, months never change so they are computed once per container
+@functools.lru_cache(maxsize=None)
+def hours_in_month(year, month):
+    return calendar.monthrange(year, month)[1] * 24
+
+
 # Get total # of hrs for next month
 def hours_for_next_month():
     now = datetime.datetime.utcnow()
-    month = now.month
-    year = now.year
-    next_month = month + 1
-    if month == 12:
-        year = year + 1
-    if next_month > 12:
-        next_month = next_month % 12
-    return calendar.monthrange(year, next_month)[1] * 24
+    if now.month == 12:
+        return hours_in_month(now.year + 1, 1)
+    return hours_in_month(now.year, now.month + 1)
 
 
 # Get total # of hrs left in current month
 def hours_left_for_current_month():
     now = datetime.datetime.utcnow()
-    total_hours_in_cur_month = calendar.monthrange(now.year, now.month)[1] * 24
     hours_consumed_in_cur_month = ((now.day - 1) * 24) + now.hour
-    hours_left = total_hours_in_cur_month - hours_consumed_in_cur_month
-    return hours_left
-
-
-# Get region code
-def region_lookup(region_name):
-    lookup = {
-        'us-west-1': "US West (N. California)",
-        'us-west-2': "US West (Oregon)",
-        'us-east-1': "US East (N. Virginia)",
-        'us-east-2': "US East (Ohio)",
-        'ca-central-1': "Canada (Central)",
-        'ap-south-1': "Asia Pacific (Mumbai)",
-        'ap-northeast-2': "Asia Pacific (Seoul)",
-        'ap-southeast-1': "Asia Pacific (Singapore)",
-        'ap-southeast-2': "Asia Pacific (Sydney)",
-        'ap-northeast-1': "Asia Pacific (Tokyo)",
-        'eu-central-1': "EU (Frankfurt)",
-        'eu-west-1': "EU (Ireland)",
-        'eu-west-2': "EU (London)",
-        'sa-east-1': "South America (Sao Paulo)",
-        'us-gov-west-1': "GovCloud (US)",
-    }
-    return lookup.get(region_name.lower(), "Region Not Found")
+    return hours_in_month(now.year, now.month) - hours_consumed_in_cur_month
 
 
 # Send response back to CFN hook about the status of the function
@@ -128,17 +205,37 @@ def send_response(event, context, response_status, response_data):
         'Data': response_data,
     }
     try:
-        response = requests.put(event['ResponseURL'], data=json.dumps(response_body, use_decimal=True))
+        with metrics.timer('Callback'):
+            response = http_session().put(event['ResponseURL'], data=json.dumps(response_body, use_decimal=True))
         return True
     except Exception as e:
         logger.info("Failed executing HTTP request: {}".format(e))
     return False
 
 
-# Function to get the price of the EC2 Instance
+# Get the price of the EC2 Instance, served from the price index or the price cache whenever possible
+def get_unit_price(oper_sys, instance_type, region_name, term_type):
+    price = lookup_price_index(oper_sys, instance_type, region_name, term_type)
+    if price is not None:
+        return price
+    key = price_cache_key(oper_sys, instance_type, region_name, term_type)
+    return price_cache.get_or_load(key, lambda: get_price_from_api(oper_sys, instance_type, region_name, term_type))
+
+
+# Get the price from the packaged price index, None when the index does not know it
+def lookup_price_index(oper_sys, instance_type, region_name, term_type):
+    if price_index is None or price_index.region != region_name:
+        return None
+    price = price_index.lookup(instance_type, oper_sys, term_type)
+    if price is None:
+        logger.info("Price for {} {} {} not found in price index".format(oper_sys, instance_type, term_type))
+    return price
+
+
+# Function to get the price of the EC2 Instance from the Pricing API, called for the
+# prices the packaged price index does not know
 def get_price_from_api(oper_sys, instance_type, region_name, term_type):
     try:
-        pricing = boto3.client('pricing', region_name='us-east-1')
         logger.info("instance: {}".format(instance_type))
         search_filters = [
             {
@@ -176,11 +273,11 @@ def get_price_from_api(oper_sys, instance_type, region_name, term_type):
         # windows adds an extra license filter
         if 'Windows' in oper_sys:
             search_filters.append({"Type": "TERM_MATCH", "Field": "licenseModel", "Value": "No License required"})
-        response = pricing.get_products(
+        metrics.add('PricingApiCalls')
+        response = pricing_client().get_products(
             ServiceCode='AmazonEC2',  # required
             Filters=search_filters,
             FormatVersion='aws_v1',  # optional
-            NextToken='',  # optional
             MaxResults=20  # optional
         )
         if len(response['PriceList']) > 1:
@@ -188,13 +285,7 @@ def get_price_from_api(oper_sys, instance_type, region_name, term_type):
         elif len(response['PriceList']) == 0:
             logger.info("Couldn't query pricing with given filters")
         resp_json = json.loads(response['PriceList'][0])
-        price = 0
-        for key, value in resp_json['terms'][term_type].items():
-            logger.info("Reading Price for termType {}, key {}".format(term_type, key))
-            for dim_key, dim_value in value['priceDimensions'].items():
-                logger.info("Reading Price for dimension key {}".format(dim_key))
-                price = dim_value['pricePerUnit']['USD']
-        return Decimal(price)
+        return parse_unit_price(resp_json, term_type)
     except Exception as e:
         print(e)
         raise e
@@ -0,0 +1,154 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Two tier cache for EC2 unit prices. The first tier is an in-memory LRU that
+# survives across warm invocations of the Lambda, the second tier is shared by
+# all containers and lives in the budgets table under the PRICE partition.
+import logging
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+logger = logging.getLogger()
+price_partition_key = 'PRICE'
+
+
+# Builds the cache key used by both tiers
+def price_cache_key(oper_sys, instance_type, region_name, term_type):
+    return '#'.join([oper_sys, instance_type, region_name, term_type])
+
+
+# In-memory LRU with a per entry expiry, kept at module level so that it lives
+# as long as the Lambda container
+class LRUPriceCache:
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            price, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return price
+
+    def put(self, key, price):
+        with self._lock:
+            self._entries[key] = (price, time.time() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared tier backed by the budgets table, expired rows are removed by the
+# table TTL on expiresAt. TTL deletes lag behind, so expiry is checked on read too.
+# The client is only created on first use, lookups served by the price index never build it
+class DynamoPriceBackend:
+
+    def __init__(self, get_client, table_name):
+        self.get_client = get_client
+        self.table_name = table_name
+
+    def get(self, key):
+        response = self.get_client().get_item(
+            TableName=self.table_name,
+            Key={'partitionKey': {'S': price_partition_key}, 'rangeKey': {'S': key}},
+            ProjectionExpression='unitPrice, expiresAt'
+        )
+        item = response.get('Item')
+        if item is None or int(item['expiresAt']['N']) <= int(time.time()):
+            return None
+        return Decimal(item['unitPrice']['N'])
+
+    def put(self, key, price, ttl_seconds):
+        self.get_client().put_item(TableName=self.table_name, Item={
+            'partitionKey': {'S': price_partition_key},
+            'rangeKey': {'S': key},
+            'unitPrice': {'N': str(Decimal(price))},
+            'expiresAt': {'N': str(int(time.time()) + ttl_seconds)},
+        })
+
+
+# Stand-in for the shared tier, used when no table is configured and for offline runs
+class InMemoryPriceBackend:
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None or item[1] <= int(time.time()):
+            return None
+        return item[0]
+
+    def put(self, key, price, ttl_seconds):
+        self.items[key] = (Decimal(price), int(time.time()) + ttl_seconds)
+
+
+# Looks up the local tier, then the shared tier and finally calls the loader,
+# back filling the tiers that missed
+class PriceCache:
+
+    def __init__(self, backend, max_entries=512, ttl_seconds=86400):
+        self.local = LRUPriceCache(max_entries, ttl_seconds)
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.stats = {'localHits': 0, 'sharedHits': 0, 'misses': 0, 'sharedErrors': 0}
+
+    def get_or_load(self, key, loader):
+        price = self.local.get(key)
+        if price is not None:
+            self.stats['localHits'] += 1
+            return price
+        try:
+            price = self.backend.get(key)
+        except Exception as e:
+            # the shared tier is an optimisation, never fail the pricing lookup because of it
+            logger.info("Failed reading price cache for key {}: {}".format(key, e))
+            self.stats['sharedErrors'] += 1
+        if price is not None:
+            self.stats['sharedHits'] += 1
+            self.local.put(key, price)
+            return price
+        self.stats['misses'] += 1
+        price = loader()
+        self.local.put(key, price)
+        try:
+            self.backend.put(key, price, self.ttl_seconds)
+        except Exception as e:
+            logger.info("Failed writing price cache for key {}: {}".format(key, e))
+            self.stats['sharedErrors'] += 1
+        return price
@@ -0,0 +1,167 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Offline preloader for the EC2 price list. Pages through every AmazonEC2
+# product of a region once, resolves the unit price for each term type and
+# writes a compact sqlite index that ships with the Lambda package, so that
+# a price lookup during a launch is a single primary key read.
+#
+# Usage: python price_index.py --region us-east-1 [--output price_index.db]
+import argparse
+import datetime
+import logging
+import os
+import sqlite3
+from decimal import Decimal
+
+import simplejson as json
+
+logger = logging.getLogger()
+default_index_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'price_index.db')
+
+
+# Get region code
+def region_lookup(region_name):
+    lookup = {
+        'us-west-1': "US West (N. California)",
+        'us-west-2': "US West (Oregon)",
+        'us-east-1': "US East (N. Virginia)",
+        'us-east-2': "US East (Ohio)",
+        'ca-central-1': "Canada (Central)",
+        'ap-south-1': "Asia Pacific (Mumbai)",
+        'ap-northeast-2': "Asia Pacific (Seoul)",
+        'ap-southeast-1': "Asia Pacific (Singapore)",
+        'ap-southeast-2': "Asia Pacific (Sydney)",
+        'ap-northeast-1': "Asia Pacific (Tokyo)",
+        'eu-central-1': "EU (Frankfurt)",
+        'eu-west-1': "EU (Ireland)",
+        'eu-west-2': "EU (London)",
+        'sa-east-1': "South America (Sao Paulo)",
+        'us-gov-west-1': "GovCloud (US)",
+    }
+    return lookup.get(region_name.lower(), "Region Not Found")
+
+
+# Read the unit price of a term type from a parsed price list entry, the last
+# price dimension wins as it always has for the live lookup
+def parse_unit_price(price_item, term_type):
+    price = 0
+    for key, value in price_item['terms'][term_type].items():
+        logger.debug("Reading Price for termType {}, key {}".format(term_type, key))
+        for dim_key, dim_value in value['priceDimensions'].items():
+            logger.debug("Reading Price for dimension key {}".format(dim_key))
+            price = dim_value['pricePerUnit']['USD']
+    return Decimal(price)
+
+
+# Read only view over a price index built by build_price_index
+class PriceIndex:
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True, check_same_thread=False)
+        self.region = self.connection.execute("select value from metadata where name = 'region'").fetchone()[0]
+
+    def lookup(self, instance_type, oper_sys, term_type, tenancy='Shared'):
+        row = self.connection.execute(
+            'select unitPrice from prices where instanceType = ? and operatingSystem = ? and termType = ? and tenancy = ?',
+            (instance_type, oper_sys, term_type, tenancy)
+        ).fetchone()
+        return Decimal(row[0]) if row else None
+
+
+# Open the price index if one was packaged with the function
+def load_price_index(path=default_index_path):
+    if not os.path.exists(path):
+        logger.info("No price index found at {}, prices are looked up from the Pricing API".format(path))
+        return None
+    try:
+        return PriceIndex(path)
+    except sqlite3.Error as e:
+        logger.info("Failed opening price index at {}: {}".format(path, e))
+        return None
+
+
+# Pages through the AmazonEC2 price list of a region following NextToken
+def get_region_price_list(pricing, region_name):
+    search_filters = [
+        {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': region_lookup(region_name)},
+        {'Type': 'TERM_MATCH', 'Field': 'preInstalledSw', 'Value': 'NA'},
+        {'Type': 'TERM_MATCH', 'Field': 'capacityStatus', 'Value': 'Used'},
+    ]
+    paginator = pricing.get_paginator('get_products')
+    for page in paginator.paginate(ServiceCode='AmazonEC2', Filters=search_filters, FormatVersion='aws_v1',
+                                   PaginationConfig={'PageSize': 100}):
+        for price_item in page['PriceList']:
+            yield json.loads(price_item)
+
+
+# Builds the index rows, the first product wins when several match the same key
+def index_rows(price_list):
+    seen = set()
+    for price_item in price_list:
+        attributes = price_item['product']['attributes']
+        if 'instanceType' not in attributes or 'operatingSystem' not in attributes:
+            continue
+        # windows prices are only considered without a license, same as the live lookup
+        if 'Windows' in attributes['operatingSystem'] and attributes.get('licenseModel') != 'No License required':
+            continue
+        for term_type in price_item.get('terms', {}):
+            key = (attributes['instanceType'], attributes['operatingSystem'], term_type, attributes.get('tenancy', 'Shared'))
+            if key in seen:
+                continue
+            seen.add(key)
+            yield key + (str(parse_unit_price(price_item, term_type)),)
+
+
+# Write the price index for a region, rows are inserted in primary key order
+def build_price_index(pricing, region_name, path=default_index_path):
+    rows = sorted(index_rows(get_region_price_list(pricing, region_name)))
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    with connection:
+        connection.execute('create table metadata (name text primary key, value text) without rowid')
+        connection.execute(
+            'create table prices (instanceType text, operatingSystem text, termType text, tenancy text, unitPrice text, '
+            'primary key (instanceType, operatingSystem, termType, tenancy)) without rowid'
+        )
+        connection.executemany('insert into prices values (?, ?, ?, ?, ?)', rows)
+        connection.executemany('insert into metadata values (?, ?)', [
+            ('region', region_name),
+            ('builtAt', str(datetime.datetime.utcnow())),
+            ('rowCount', str(len(rows))),
+        ])
+    connection.execute('vacuum')
+    connection.close()
+    os.replace(tmp_path, path)
+    logger.info("Wrote {} prices for {} to {}".format(len(rows), region_name, path))
+    return len(rows)
+
+
+if __name__ == '__main__':
+    import boto3
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Build the EC2 price index shipped with get-ec2-pricing')
+    parser.add_argument('--region', required=True, help='region where the stack is deployed')
+    parser.add_argument('--output', default=default_index_path, help='path of the sqlite index to write')
+    args = parser.parse_args()
+    build_price_index(boto3.client('pricing', region_name='us-east-1'), args.region, args.output)
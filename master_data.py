@@ -1,13 +1,20 @@
 import boto3
 import uuid
 import datetime
+import zlib
 
 dynamodb = boto3.resource('dynamodb', region_name='<AWS_REGION>') # TODO:: Update with aws-region where thes stack is deployed
 table = dynamodb.Table('aws-samples-budgets') # TODO:: Once stack is deployed, update the DynamoDB Table Name
 
+budget_shards = 4 # TODO:: Update with BudgetShards of the deployed stack
+
 def insert_data(db_item):
     table.put_item(Item=db_item)
 
+# budgets are spread over write shards, the shard of a budget is derived from its rangeKey
+def budget_partition_key(range_key):
+    return "BUDGET#{}".format(zlib.crc32(range_key.encode('utf-8')) % budget_shards)
+
 budgets = [
     {
         "partitionKey": "BUDGET",
@@ -76,4 +83,5 @@ budgets = [
 ]
 
 for item in budgets:
+    item["partitionKey"] = budget_partition_key(item["rangeKey"])
     insert_data(item)
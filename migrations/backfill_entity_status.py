@@ -0,0 +1,79 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# One off backfill of the sparse query-by-entity-status index. Requests saved
+# before the index existed have no entityStatus, this sets it (together with the
+# top level instanceType the index projects) on every request that is still
+# waiting on a decision. Run it once after deploying the index, before the next
+# process-requests sweep. The requests are found with a scan of the table.
+# Updates are conditional on the status that was read, requests that moved on
+# meanwhile are skipped and the script can be rerun.
+#
+# Usage: python migrations/backfill_entity_status.py --table <budgets-table> --region <region> [--dry-run]
+import argparse
+
+import boto3
+
+indexed_request_statuses = ('SAVED', 'PENDING', 'BLOCKED')
+
+
+def backfill(table, dry_run=False):
+    updated = 0
+    skipped = 0
+    scan_args = {
+        'FilterExpression': 'requestStatus IN (:s0, :s1, :s2) AND attribute_not_exists(entityStatus)',
+        'ExpressionAttributeValues': {':s{}'.format(index): status for index, status in enumerate(indexed_request_statuses)},
+        'ProjectionExpression': 'partitionKey, rangeKey, requestStatus, businessEntity, requestPayload',
+    }
+    while True:
+        response = table.scan(**scan_args)
+        for item in response['Items']:
+            request_status = item['requestStatus']
+            entity_status = '{}#{}'.format(item['businessEntity'], request_status)
+            print('{} {} -> {}'.format(item['rangeKey'], request_status, entity_status))
+            if dry_run:
+                continue
+            try:
+                table.update_item(
+                    Key={'partitionKey': item['partitionKey'], 'rangeKey': item['rangeKey']},
+                    UpdateExpression='set entityStatus=:e, instanceType=:i',
+                    ConditionExpression='requestStatus = :s',
+                    ExpressionAttributeValues={
+                        ':e': entity_status,
+                        ':i': item['requestPayload']['InstanceType'],
+                        ':s': request_status,
+                    }
+                )
+                updated = updated + 1
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                skipped = skipped + 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    print('Updated {} requests, skipped {} requests that changed state'.format(updated, skipped))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backfill entityStatus on requests waiting on a decision')
+    parser.add_argument('--table', required=True, help='name of the budgets table')
+    parser.add_argument('--region', required=True, help='region the stack is deployed to')
+    parser.add_argument('--dry-run', action='store_true', help='only print the requests that would be updated')
+    args = parser.parse_args()
+    backfill(boto3.resource('dynamodb', region_name=args.region).Table(args.table), args.dry_run)
@@ -0,0 +1,134 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Online migration of the stored amounts to micro-dollar precision. The functions
+# handle amounts as integer micro-dollars and write them rounded to the
+# micro-dollar, amounts written before may carry more decimals. Such an amount
+# reads as its rounded value, so a condition on it never matches (e.g. the
+# forecast replacement of process-requests and the compaction of the accrual
+# counters) and deltas added to it never cancel exactly. This rounds every amount
+# of the budgets, their accrual counters and the requests, pricing included, half
+# to even as the functions do. Updates are conditional on the amounts being
+# unchanged, items changed meanwhile are skipped and the script can be rerun.
+# Run it right after deploying the functions that read micro-dollars.
+#
+# Usage: python migrations/round_money.py --table <budgets-table> --region <region>
+#            [--request-shards 8] [--budget-shards 4] [--dry-run]
+import argparse
+import os
+import sys
+
+import boto3
+from boto3.dynamodb.conditions import Key
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common-layer'))
+from keys import budget_partition, partition_keys, request_partition, split_accrual_counter_key  # noqa: E402
+from money import money_attributes, pricing_money_attributes, to_decimal, to_micros  # noqa: E402
+
+pricing_attribute = 'pricingInfoAtRequest'
+
+
+def query_all(table, **query_args):
+    while True:
+        response = table.query(**query_args)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Amounts of an item that are more precise than a micro-dollar, as (path, stored, rounded)
+# where path is the attribute name or the pricing entry name
+def unrounded_amounts(item):
+    amounts = []
+    for name, value in item.items():
+        if name in money_attributes:
+            amounts.append(((name,), value))
+    for name, value in item.get(pricing_attribute, {}).items():
+        if name in pricing_money_attributes:
+            amounts.append(((pricing_attribute, name), value))
+    amounts = [(path, value, to_decimal(to_micros(value))) for path, value in amounts]
+    return [(path, stored, rounded) for path, stored, rounded in amounts if rounded != stored]
+
+
+# Round the amounts of an item in place, as long as they are unchanged. The version of a budget row is incremented
+def round_item(table, item, amounts, is_budget):
+    names = {}
+    values = {}
+    set_expressions = []
+    conditions = []
+    for index, (path, stored, rounded) in enumerate(amounts):
+        placeholders = []
+        for part_index, part in enumerate(path):
+            names['#a{}_{}'.format(index, part_index)] = part
+            placeholders.append('#a{}_{}'.format(index, part_index))
+        values[':o{}'.format(index)] = stored
+        values[':n{}'.format(index)] = rounded
+        set_expressions.append('{}=:n{}'.format('.'.join(placeholders), index))
+        conditions.append('{}=:o{}'.format('.'.join(placeholders), index))
+    update_expression = 'set ' + ', '.join(set_expressions)
+    if is_budget:
+        names['#v'] = 'budgetVersion'
+        values[':v'] = 1
+        update_expression = update_expression + ' add #v :v'
+    try:
+        table.update_item(
+            Key={'partitionKey': item['partitionKey'], 'rangeKey': item['rangeKey']},
+            UpdateExpression=update_expression,
+            ConditionExpression=' and '.join(conditions),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+        return True
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def migrate(table, partition, shard_count, dry_run=False):
+    rounded = 0
+    skipped = 0
+    for partition_key in partition_keys(partition, shard_count):
+        for item in query_all(table, KeyConditionExpression=Key('partitionKey').eq(partition_key)):
+            amounts = unrounded_amounts(item)
+            if not amounts:
+                continue
+            print('{} {}: {}'.format(partition_key, item['rangeKey'], ', '.join(
+                '{} {} -> {}'.format('.'.join(path), stored, new) for path, stored, new in amounts)))
+            if dry_run:
+                continue
+            is_budget = partition == budget_partition and split_accrual_counter_key(item['rangeKey'])[1] is None
+            if round_item(table, item, amounts, is_budget):
+                rounded = rounded + 1
+            else:
+                skipped = skipped + 1
+    print('Rounded {} {} items, skipped {} items that changed'.format(rounded, partition, skipped))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Round the stored amounts to micro-dollar precision')
+    parser.add_argument('--table', required=True, help='name of the budgets table')
+    parser.add_argument('--region', required=True, help='region the stack is deployed to')
+    parser.add_argument('--request-shards', type=int, default=8, help='RequestShards of the deployed stack')
+    parser.add_argument('--budget-shards', type=int, default=4, help='BudgetShards of the deployed stack')
+    parser.add_argument('--dry-run', action='store_true', help='only print the amounts that would be rounded')
+    args = parser.parse_args()
+    table = boto3.resource('dynamodb', region_name=args.region).Table(args.table)
+    migrate(table, budget_partition, args.budget_shards, args.dry_run)
+    migrate(table, request_partition, args.request_shards, args.dry_run)
@@ -0,0 +1,204 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Online migration of requests and budgets to the sharded partition keys. Every
+# item still stored under the unsharded REQUEST or BUDGET partition key is copied
+# to its shard and deleted in one transaction, which only commits while the item
+# is unchanged.
+# The functions read both places, so the workflow keeps serving requests while the
+# migration runs. Items written meanwhile are skipped and picked up by a rerun.
+#
+# Budgets are moved first. The requests waiting on a budget point at it with
+# budgetPartitionKey, they are repointed in the transaction that moves the budget.
+# The accrual counters of a budget are summed by budget wherever they are stored,
+# they move to the shard of their budget on their own.
+# Run it with the shard counts the stack is deployed with (RequestShards and
+# BudgetShards), after the functions that read the shards are deployed.
+#
+# Usage: python migrations/shard_keys.py --table <budgets-table> --region <region>
+#            [--request-shards 8] [--budget-shards 4] [--dry-run]
+import argparse
+import os
+import sys
+
+import boto3
+from boto3.dynamodb.conditions import Key
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common-layer'))
+from keys import budget_partition, request_partition, shard_key, split_accrual_counter_key  # noqa: E402
+
+accrual_attributes = ('accruedForecastedSpend', 'accruedBlockedSpend', 'accruedApprovedSpend')
+# TransactWriteItems accepts up to 100 actions, the budget move takes two
+max_repointed_requests = 98
+
+
+def query_all(table, **query_args):
+    while True:
+        response = table.query(**query_args)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Items of a kind that are still stored under the unsharded partition key, with their shard.
+# Accrual counters go to the shard of their budget
+def unsharded_items(table, partition, shard_count):
+    for item in query_all(table, KeyConditionExpression=Key('partitionKey').eq(partition)):
+        yield item, shard_key(partition, split_accrual_counter_key(item['rangeKey'])[0], shard_count)
+
+
+# Actions that copy an item to its shard and delete the original, as long as the original
+# still matches the condition on the attributes that every write to it changes
+def move_actions(table_name, item, target, condition, values=None):
+    delete = {
+        'TableName': table_name,
+        'Key': {'partitionKey': item['partitionKey'], 'rangeKey': item['rangeKey']},
+        'ConditionExpression': condition
+    }
+    if values:
+        delete['ExpressionAttributeValues'] = values
+    put = {
+        'TableName': table_name,
+        'Item': dict(item, partitionKey=target),
+        'ConditionExpression': 'attribute_not_exists(rangeKey)'
+    }
+    return [{'Put': put}, {'Delete': delete}]
+
+
+# Every write to a budget increments budgetVersion, rows written before the version existed have none
+def budget_move_actions(table_name, budget, target):
+    if 'budgetVersion' in budget:
+        return move_actions(table_name, budget, target, 'budgetVersion = :v', {':v': budget['budgetVersion']})
+    return move_actions(table_name, budget, target, 'attribute_not_exists(budgetVersion) and attribute_exists(rangeKey)')
+
+
+# Every write to an accrual counter changes one of its accruals
+def counter_move_actions(table_name, counter, target):
+    conditions = []
+    values = {}
+    for index, name in enumerate(accrual_attributes):
+        if name in counter:
+            values[':a{}'.format(index)] = counter[name]
+            conditions.append('{0} = :a{1}'.format(name, index))
+        else:
+            conditions.append('attribute_not_exists({})'.format(name))
+    return move_actions(table_name, counter, target, 'attribute_exists(rangeKey) and ' + ' and '.join(conditions), values)
+
+
+# Writes to a request change its requestStatus, except for the termination of a request rejected by
+# the admin (resourceStatus), the removal of the callback mark of an approved request (entityStatus)
+# and the repointing of the budget it waits on (budgetPartitionKey)
+request_guard_attributes = ('requestStatus', 'resourceStatus', 'entityStatus', 'budgetPartitionKey')
+
+
+def request_move_actions(table_name, request, target):
+    conditions = ['attribute_exists(rangeKey)']
+    values = {}
+    for index, name in enumerate(request_guard_attributes):
+        if name in request:
+            values[':g{}'.format(index)] = request[name]
+            conditions.append('{0} = :g{1}'.format(name, index))
+        else:
+            conditions.append('attribute_not_exists({})'.format(name))
+    return move_actions(table_name, request, target, ' and '.join(conditions), values)
+
+
+# Point the requests waiting on a budget at the shard the budget moves to
+def repoint_actions(table, budget, target):
+    actions = []
+    for request_status in ('PENDING', 'BLOCKED'):
+        for request in query_all(table, IndexName='query-by-entity-status',
+                                 KeyConditionExpression=Key('entityStatus').eq('{}#{}'.format(budget['businessEntity'], request_status))):
+            actions.append({'Update': {
+                'TableName': table.name,
+                'Key': {'partitionKey': request['partitionKey'], 'rangeKey': request['rangeKey']},
+                'UpdateExpression': 'set budgetPartitionKey=:b',
+                'ConditionExpression': 'requestStatus = :s',
+                'ExpressionAttributeValues': {':b': target, ':s': request_status}
+            }})
+    return actions
+
+
+def transact(table, actions):
+    client = table.meta.client
+    try:
+        client.transact_write_items(TransactItems=actions)
+        return True
+    except client.exceptions.TransactionCanceledException as e:
+        print('  skipped, {}'.format(e.response.get('CancellationReasons', e)))
+        return False
+
+
+def migrate_budgets(table, shard_count, dry_run=False):
+    moved = 0
+    skipped = 0
+    for budget, target in list(unsharded_items(table, budget_partition, shard_count)):
+        if split_accrual_counter_key(budget['rangeKey'])[1] is not None:
+            print('accrual counter {} {} -> {}'.format(budget['rangeKey'], budget['partitionKey'], target))
+            if dry_run:
+                continue
+            if transact(table, counter_move_actions(table.name, budget, target)):
+                moved = moved + 1
+            else:
+                skipped = skipped + 1
+            continue
+        repoints = repoint_actions(table, budget, target)
+        print('budget {} {} -> {}, repointing {} requests'.format(budget['rangeKey'], budget['partitionKey'], target, len(repoints)))
+        if len(repoints) > max_repointed_requests:
+            print('  skipped, too many requests waiting on the budget for one transaction')
+            skipped = skipped + 1
+            continue
+        if dry_run:
+            continue
+        if transact(table, budget_move_actions(table.name, budget, target) + repoints):
+            moved = moved + 1
+        else:
+            skipped = skipped + 1
+    return moved, skipped
+
+
+def migrate_requests(table, shard_count, dry_run=False):
+    moved = 0
+    skipped = 0
+    for request, target in unsharded_items(table, request_partition, shard_count):
+        print('request {} {} -> {}'.format(request['rangeKey'], request['partitionKey'], target))
+        if dry_run:
+            continue
+        if transact(table, request_move_actions(table.name, request, target)):
+            moved = moved + 1
+        else:
+            skipped = skipped + 1
+    return moved, skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move requests and budgets to their sharded partition keys')
+    parser.add_argument('--table', required=True, help='name of the budgets table')
+    parser.add_argument('--region', required=True, help='region the stack is deployed to')
+    parser.add_argument('--request-shards', type=int, default=8, help='RequestShards of the deployed stack')
+    parser.add_argument('--budget-shards', type=int, default=4, help='BudgetShards of the deployed stack')
+    parser.add_argument('--dry-run', action='store_true', help='only print the items that would be moved')
+    args = parser.parse_args()
+    budgets_table = boto3.resource('dynamodb', region_name=args.region).Table(args.table)
+    print('Moved {} budgets and accrual counters, skipped {} that changed meanwhile'.format(
+        *migrate_budgets(budgets_table, args.budget_shards, args.dry_run)))
+    print('Moved {} requests, skipped {} requests that changed meanwhile'.format(
+        *migrate_requests(budgets_table, args.request_shards, args.dry_run)))
@@ -0,0 +1,113 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Admission rule of process-requests. A request is admitted when the budget left
+# after the forecast and the blocked and approved accruals still covers its 31 day
+# price, otherwise it waits on the admin (PENDING) or behind the request that
+# already does (BLOCKED). The functions here only work on the budget dict and
+# never touch AWS, so offline tools such as benchmark/what_if.py evaluate exactly
+# the same rule as the Lambda.
+saved_req_status = 'SAVED'
+pending_req_status = 'PENDING'
+blocked_req_status = 'BLOCKED'
+approved_req_status = 'APPROVED_SYSTEM'
+
+
+# Prepare a budget as read from the table for a sweep, a new forecast from AWS Budgets
+# replaces the accrued forecast
+def start_sweep(budget, pending_request_exists=False):
+    if not budget['budgetForecastProcessed']:
+        budget['accruedForecastedSpend'] = budget['forecastedSpend']
+    if pending_request_exists:
+        budget['pendingRequestExists'] = True
+    return budget
+
+
+# Budget left after the forecast and the blocked and approved accruals. Admitting a pending or
+# blocked request moves its amount from blocked to forecasted and approved, which leaves the
+# headroom unchanged, while admitting or blocking a saved request lowers it
+def headroom(budget):
+    forecast_spend = budget['accruedForecastedSpend'] if budget['accruedForecastedSpend'] > 0 else budget['forecastedSpend']
+    return budget['budgetLimit'] - forecast_spend - budget['accruedBlockedSpend'] - budget['accruedApprovedSpend']
+
+
+# Budget left for a request, negative when the request does not fit
+def remaining_amount(budget, requested_amt_monthly):
+    return headroom(budget) - requested_amt_monthly
+
+
+# Evaluate the blocked requests of a budget that can change state, in the order of process-requests.
+# Admitting a blocked request leaves the headroom unchanged, so the requests that are admitted are
+# exactly fitting_requests, the blocked requests priced at or below the headroom in requestTime order.
+# A blocked request that does not fit only moves, to PENDING, while nobody waits on the admin. That is
+# next_unfitting_request(after_request_time, fitting_ids), the first blocked request after the last
+# admission that is not a fitting one, or from the start when no request was pending. evaluate(request)
+# applies the rule to a request. Returns the number of requests evaluated
+def evaluate_blocked_requests(budget, fitting_requests, next_unfitting_request, evaluate):
+    fitting_ids = {request.rangeKey for request in fitting_requests}
+    request_count = 0
+    last_request_time = None
+    # the first blocked request after the last admission that does not fit, only fitting requests come between
+    unfitting_request = None
+    searched = False
+    for request in list(fitting_requests) + [None]:
+        if not budget.get('pendingRequestExists'):
+            if not searched:
+                unfitting_request = next_unfitting_request(last_request_time, fitting_ids)
+                searched = True
+            if unfitting_request is not None and (request is None or unfitting_request.requestTime < request.requestTime):
+                evaluate(unfitting_request)
+                request_count = request_count + 1
+                unfitting_request = None
+                searched = False
+        if request is None:
+            break
+        evaluate(request)
+        request_count = request_count + 1
+        last_request_time = request.requestTime
+    return request_count
+
+
+# Evaluate a request against the budget of its business entity. The local accruals of the
+# budget are adjusted and the status the request moves to is returned, None when it stays
+def admit(budget, request_status, requested_amt, requested_amt_monthly):
+    blocked_amt = budget['accruedBlockedSpend']
+    approved_amt = budget['accruedApprovedSpend']
+    forecast_spend = budget['accruedForecastedSpend'] if budget['accruedForecastedSpend'] > 0 else budget['forecastedSpend']
+    if remaining_amount(budget, requested_amt_monthly) < 0:
+        if request_status == saved_req_status:
+            budget['accruedBlockedSpend'] = blocked_amt + requested_amt_monthly
+        # the admin is notified when nobody waits on them yet, or again for pending requests on a new forecast
+        if not budget.get('pendingRequestExists') or (
+                not budget['budgetForecastProcessed'] and request_status == pending_req_status):
+            budget['pendingRequestExists'] = True
+            return pending_req_status
+        if request_status == saved_req_status:
+            return blocked_req_status
+        return None
+    budget['accruedForecastedSpend'] = forecast_spend + requested_amt
+    budget['accruedApprovedSpend'] = approved_amt + (requested_amt_monthly - requested_amt)
+    # if request is in blocked state, it means that a blocked request is rejected, we must
+    # deduct the blocked amount and add it forecast amount since we would added to blocked amt
+    # when we marked this request as blocked
+    if request_status in (pending_req_status, blocked_req_status):
+        budget['accruedBlockedSpend'] = blocked_amt - requested_amt_monthly
+        budget['pendingRequestExists'] = False
+    return approved_req_status
@@ -24,134 +24,232 @@ import logging
 import os
 from datetime import datetime
 
-import boto3
-import requests
-from boto3.dynamodb.conditions import Key
+from accruals import (accrual_attributes, accrual_update, budget_check, budget_update, counter_update,
+                      fold_accrual_counters, last_headroom)
+from admission import (admit, approved_req_status, blocked_req_status, evaluate_blocked_requests, headroom,
+                       pending_req_status, remaining_amount, saved_req_status, start_sweep)
+from clients import dynamodb_client, http_session, query_items, query_partitions, sns_client
+from keys import (blocked_cost_attributes, blocked_cost_index, budget_partition_keys, callback_pending_status,
+                  entity_status_attribute, entity_status_attributes, entity_status_index, entity_status_key)
+from metrics import Metrics
+from money import to_item, to_number
+from dispatcher import SideEffectDispatcher
+from partitions import EntityLanes
+from records import Request, decode_budget_item
+from write_buffer import WriteBuffer
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get('LogLevel', 'INFO'))
+metrics = Metrics('process-requests')
 region = os.environ['AWS_REGION']
 budgets_table_name = os.environ['BudgetsTable']
-dynamodb = boto3.resource('dynamodb', region_name=region)
-budgets_table = dynamodb.Table(budgets_table_name)
-sns = boto3.resource('sns')
-budgets_partition_key = 'BUDGET'
-requests_partition_key = 'REQUEST'
-saved_req_status = 'SAVED'
-pending_req_status = 'PENDING'
-blocked_req_status = 'BLOCKED'
+# clients are shared by the dispatcher threads, pools are sized to the concurrency limit
+side_effect_concurrency = int(os.environ.get('SideEffectConcurrency', '16'))
+dispatcher = SideEffectDispatcher(side_effect_concurrency, max_attempts=int(os.environ.get('SideEffectMaxAttempts', '3')))
+entity_workers = int(os.environ.get('EntityWorkers', '8'))
+# status transitions and accrual updates of a sweep, flushed together by update_accrued_amt
+write_buffer = WriteBuffer(budgets_table_name)
 
 
+@metrics.handler
 def lambda_handler(event, context):
-    logger.info(json.dumps(event))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(event))
+    # DynamoDB stream records only trigger the evaluation of the business entities they touch,
+    # the scheduled sweep reconciles every business entity
+    if 'Records' in event:
+        business_entities = get_business_entities_from_stream(event['Records'])
+        if not business_entities:
+            logger.info("No business entity affected by the stream records, skipping")
+            return
+        logger.info("Incremental evaluation for business entities {}".format(business_entities))
+    else:
+        business_entities = None
+    process_business_entities(business_entities)
+
+
+# Evaluate the requests of the given business entities, all business entities when None
+def process_business_entities(business_entities=None):
+    # drop anything left behind by a previous invocation that failed midway
+    write_buffer.clear()
+    dispatcher.clear()
     # Get Budget Info
-    budget_info = get_budget_info()
+    with metrics.timer('FetchBudgets'):
+        budget_info = get_budget_info()
     # convert List to Dict for easier lookup
     budget_dict = {}
+    # accruals as read, a new forecast only replaces the accrued forecast it was computed from
+    loaded_accruals = {}
     update_budget_accruals = False
     for budget in budget_info:
         business_entity = budget['businessEntity']
+        if business_entities is not None and business_entity not in business_entities:
+            continue
+        loaded_accruals[business_entity] = {name: budget[name] for name in accrual_attributes}
         if not budget['budgetForecastProcessed']:
             logger.info("New Forecast Available for {}, replacing the accruedForecast with forecast from AWS budgets".format(business_entity))
-            budget['accruedForecastedSpend'] = budget['forecastedSpend']
+            update_budget_accruals = True
+        elif not budget.get('accrualsResetProcessed', True):
+            logger.info("Approved accruals of {} were reset".format(business_entity))
             update_budget_accruals = True
         else:
             logger.info("No Budget updated available for {} ".format(business_entity))
         budget_dict[business_entity] = budget
-    logger.info("Local Dictionary for Budgets: {}".format(budget_dict))
-    # Get Request that are in pending state
-    pending_requests = get_requests(pending_req_status)
-
-    for pending_request in pending_requests:
-        business_entity = pending_request['businessEntity']
-        if 'pendingRequestExists' in budget_dict[business_entity]:
-            # there could be multiple requests for same business Entity, just skips those
-            continue
-        else:
-            budget_dict[business_entity]['pendingRequestExists'] = True
+    logger.debug("Local Dictionary for Budgets: %s", budget_dict)
+    metrics.add('BusinessEntities', len(budget_dict))
 
-    pending_request_count = len(pending_requests)
-    if pending_request_count > 0:
-        # recompute blocked requests to see if there is a change in forecast
-        process_requests(pending_requests, budget_dict)
-        update_budget_accruals = True
-
-    # Get if there are any blocked requests
-    blocked_requests = get_requests(blocked_req_status)
-
-    blocked_request_count = len(blocked_requests)
-    if blocked_request_count > 0:
-        # Process blocked requests for each Business Entity
-        process_requests(blocked_requests, budget_dict)
-        update_budget_accruals = True
-
-    # Get requests in SAVED state
-    saved_requests = get_requests(saved_req_status)
-
-    saved_request_count = len(saved_requests)
-    if saved_request_count > 0:
-        # process requests that are in saved state
-        process_requests(saved_requests, budget_dict)
+    # Business entities are independent, each one is evaluated in a worker lane which reads
+    # just the active requests of the entity from the sparse index. Incremental evaluations
+    # trust the cached headroom of a budget, the scheduled sweep checks the blocked requests again
+    use_cached_headroom = business_entities is not None
+    lanes = EntityLanes(entity_workers, lambda business_entity: process_entity(business_entity, budget_dict, use_cached_headroom))
+    for business_entity in budget_dict:
+        lanes.submit(business_entity, business_entity)
+    failed_entities = lanes.join()
+    for business_entity in failed_entities:
+        logger.error("Discarding staged writes for business entity {}".format(business_entity))
+        write_buffer.discard(budget_dict[business_entity]['rangeKey'])
+        del budget_dict[business_entity]
+    if any(write_buffer.has_updates(budget['rangeKey']) for budget in budget_dict.values()):
         update_budget_accruals = True
 
+    committed = set()
     if update_budget_accruals:
         logger.info("Updating Budgets Accruals")
         # update the budgets with newly calculated accrued amts
-        update_accrued_amt(budget_dict)
+        with metrics.timer('Write'):
+            committed = update_accrued_amt(budget_dict, loaded_accruals)
+
+    # the callbacks and notifications of a request are only sent once its transition committed,
+    # a request whose transaction failed is evaluated again by the next sweep
+    with metrics.timer('DrainSideEffects'):
+        metrics.add('SideEffectsDropped', dispatcher.release(committed))
+        failed_requests = dispatcher.drain()
+    if failed_requests:
+        logger.error("Side effects failed for requests {}".format(sorted(key[1] for key in failed_requests)))
+        metrics.add('SideEffectFailures', len(failed_requests))
 
 
+# Get the business entities of the requests and budgets in a batch of DynamoDB stream records,
+# the event source mapping only delivers new SAVED requests, pending and blocked requests approved
+# or rejected by the admin or by a termination, and budgets with a new forecast or reset accruals
+def get_business_entities_from_stream(records):
+    business_entities = set()
+    for record in records:
+        new_image = record.get('dynamodb', {}).get('NewImage', {})
+        if 'businessEntity' in new_image:
+            business_entities.add(new_image['businessEntity']['S'])
+    return business_entities
+
+
+# Evaluates a stream of requests against the local budgets, returns the number of requests processed
 def process_requests(requests, budget_dict):
+    request_count = 0
     for request in requests:
-        request_id = request['rangeKey']
-        budget = budget_dict[request['businessEntity']]
-        logger.info("Available Budget while processing request {} is {}".format(request_id, budget))
-        budget_amt = budget['budgetLimit']
-        curr_req_status = request['requestStatus']
-        requested_amt = request['pricingInfoAtRequest']['EstCurrMonthPrice']  # EstCurrMonthPrice
-        requested_amt_monthly = request['pricingInfoAtRequest']['31DayPrice']  # EstCurrMonthPrice
-        logger.info("Pricing info for request {} is {}".format(request_id, request['pricingInfoAtRequest']))
-        blocked_amt = budget['accruedBlockedSpend']
-        approved_amt = budget['accruedApprovedSpend']
-        forecast_spend = budget['accruedForecastedSpend'] if budget['accruedForecastedSpend'] > 0 else budget['forecastedSpend']
-        remaining_amt = budget_amt - forecast_spend - requested_amt_monthly - blocked_amt - approved_amt
-        logger.info("Remaining Amount for request {} after calculation is {}".format(request_id, remaining_amt))
-        if remaining_amt < 0:
-            logger.info("No Enough budget left for request {}".format(request_id))
-            if curr_req_status == saved_req_status:
-                logger.info("Request is in SAVED state, adjusting the local accruals before further processing... Request Id : {}".format(request_id))
-                budget['accruedBlockedSpend'] = blocked_amt + requested_amt_monthly
-            if not 'pendingRequestExists' in budget or not budget['pendingRequestExists'] or (
-                    not budget['budgetForecastProcessed'] and curr_req_status == pending_req_status):
-                logger.info("There is no pending request exist for business entity or there is a pricing rebase.. update the status and notify admin. Request Id: {}".format(request_id))
-                # mark the status of the request denoting waiting for approval
-                update_request_status(request_id, pending_req_status, budget['rangeKey'])
-                # send approval to admin
-                notify_admin(request, budget)
-                budget['pendingRequestExists'] = True
-            elif curr_req_status == saved_req_status:
-                logger.info('Pending request exists for business entity, keeping the request in blocked state {}'.format(request_id))
-                # mark rest of the requests denoting blocked by a existing request
-                update_request_status(request_id, blocked_req_status, budget['rangeKey'])
-        else:
-            logger.info('Request is within the budget, prepping to auto approve the request {}'.format(request_id))
-            budget['accruedForecastedSpend'] = forecast_spend + requested_amt
-            budget['accruedApprovedSpend'] = approved_amt + (requested_amt_monthly - requested_amt)
-            # if request is in blocked state, it means that a blocked request is rejected, we must
-            # deduct the blocked amount and add it forecast amount since we would added to blocked amt
-            # when we marked this request as blocked
-            if curr_req_status in (pending_req_status, blocked_req_status):
-                budget['accruedBlockedSpend'] = blocked_amt - requested_amt_monthly
-                budget['pendingRequestExists'] = False
-
-            # approve the request
-            approve_request(request_id, request['stackWaitUrl'])
-            # mark the request status as auto approved by the system
-            update_request_status(request_id, 'APPROVED_SYSTEM', budget['rangeKey'])
-            # logger.info("Auto approve requests if there is any't blocked amt") 
-
-
-# Approve a request id since it falls within budget
-def approve_request(request_id, approval_url):
+        request_count = request_count + 1
+        process_request(request, budget_dict)
+    return request_count
+
+
+# Evaluates the active requests of a business entity. Pending requests are evaluated first to
+# recompute them on a forecast change, then the blocked requests that can change state and
+# the saved requests, each in requestTime order. Approval callbacks that failed in an earlier
+# sweep are sent again
+def process_entity(business_entity, budget_dict, use_cached_headroom=False):
+    budget = budget_dict[business_entity]
+    resend_approval_callbacks(business_entity)
+    pending_requests = list(metrics.timed_iter('FetchPending', get_entity_requests(business_entity, pending_req_status)))
+    # Apply a new forecast and mark the business entity if a request is already waiting on the admin
+    start_sweep(budget, pending_request_exists=bool(pending_requests))
+    request_count = process_requests(pending_requests, budget_dict)
+    metrics.add('QueueDepthPending', request_count)
+    blocked_count = process_blocked_requests(business_entity, budget_dict, use_cached_headroom)
+    metrics.add('QueueDepthBlocked', blocked_count)
+    saved_count = process_requests(metrics.timed_iter('FetchSaved', get_entity_requests(business_entity, saved_req_status)), budget_dict)
+    metrics.add('QueueDepthSaved', saved_count)
+    request_count = request_count + blocked_count + saved_count
+    # every blocked request is priced above the headroom left at the end of the sweep
+    budget['sweepHeadroom'] = headroom(budget)
+    logger.info("Evaluated {} requests for business entity {}".format(request_count, business_entity))
+    return request_count
+
+
+# Evaluates the blocked requests of a business entity that can change state, returns the number
+# of requests evaluated. The requests priced at or below the headroom are read from the blocked
+# cost index, the first blocked request after an admission from the entity status index, see
+# evaluate_blocked_requests. Every other blocked request is left alone
+def process_blocked_requests(business_entity, budget_dict, use_cached_headroom=False):
+    budget = budget_dict[business_entity]
+    budget_headroom = headroom(budget)
+    # no blocked request is priced at or below the headroom cached by the last sweep
+    cached_headroom = last_headroom(budget)
+    if (use_cached_headroom and budget.get('pendingRequestExists') and cached_headroom is not None
+            and budget_headroom <= cached_headroom):
+        metrics.add('BlockedEvaluationsSkipped')
+        return 0
+    fitting_requests = sorted(
+        metrics.timed_iter('FetchBlocked', get_fitting_blocked_requests(business_entity, budget_headroom)),
+        key=lambda request: (request.requestTime, request.rangeKey))
+    return evaluate_blocked_requests(
+        budget, fitting_requests,
+        lambda after_request_time, fitting_ids: next_unfitting_blocked_request(business_entity, after_request_time, fitting_ids),
+        lambda request: process_request(request, budget_dict))
+
+
+# Evaluates a request against the budget of its business entity
+def process_request(request, budget_dict):
+    request_id = request.rangeKey
+    budget = budget_dict[request.businessEntity]
+    logger.debug("Available Budget while processing request %s is %s", request_id, budget)
+    curr_req_status = request.requestStatus
+    requested_amt = request.requestedAmount  # EstCurrMonthPrice
+    requested_amt_monthly = request.requestedMonthlyAmount  # 31DayPrice
+    logger.debug("Requested amounts for request %s are %s and %s monthly", request_id, requested_amt, requested_amt_monthly)
+    # the remaining amount is only computed when debug logging is on
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Remaining Amount for request %s after calculation is %s", request_id, remaining_amount(budget, requested_amt_monthly))
+    accruals = {name: budget[name] for name in accrual_attributes}
+    with metrics.timer('Decide'):
+        new_status = admit(budget, curr_req_status, requested_amt, requested_amt_monthly)
+    # the accrual deltas of the decision are committed with the status transition
+    for name in accrual_attributes:
+        accruals[name] = budget[name] - accruals[name]
+    metrics.add('Decisions' + (new_status or 'UNCHANGED').title().replace('_', ''))
+    if new_status == pending_req_status:
+        logger.info("There is no pending request exist for business entity or there is a pricing rebase.. update the status and notify admin. Request Id: {}".format(request_id))
+        # mark the status of the request denoting waiting for approval
+        update_request_status(request, pending_req_status, budget, curr_req_status, accruals)
+        # send approval to admin
+        notify_admin(request, budget)
+    elif new_status == blocked_req_status:
+        logger.info('Pending request exists for business entity, keeping the request in blocked state {}'.format(request_id))
+        # mark rest of the requests denoting blocked by a existing request
+        update_request_status(request, blocked_req_status, budget, curr_req_status, accruals)
+    elif new_status == approved_req_status:
+        logger.info('Request is within the budget, prepping to auto approve the request {}'.format(request_id))
+        # approve the request once the transition committed
+        dispatcher.defer((request.partitionKey, request_id), 'approval of request {}'.format(request_id),
+                         approve_request, request, request.stackWaitUrl)
+        # mark the request status as auto approved by the system
+        update_request_status(request, approved_req_status, budget, curr_req_status, accruals)
+    else:
+        logger.info("No Enough budget left for request {}, request stays {}".format(request_id, curr_req_status))
+
+
+# Send the approval callbacks of the system approved requests of a business entity that are still marked,
+# the wait handle keeps the first callback of a UniqueId so sending one twice is harmless
+def resend_approval_callbacks(business_entity):
+    for request in get_entity_requests(business_entity, callback_pending_status):
+        logger.info("Approval callback of request {} is still pending, sending it again".format(request.rangeKey))
+        metrics.add('CallbacksResent')
+        dispatcher.submit((request.partitionKey, request.rangeKey), 'approval of request {}'.format(request.rangeKey),
+                          approve_request, request, request.stackWaitUrl)
+
+
+# Approve a request since it falls within budget. The request was marked as waiting on the callback
+# with its approval, the mark is removed once the callback went through
+def approve_request(request, approval_url):
+    request_id = request.rangeKey
     logger.info("Request received to auto approval a product with request Id: {}".format(request_id))
     success_response_data = {
         "Status": "SUCCESS",
@@ -159,115 +257,254 @@ def approve_request(request_id, approval_url):
         "UniqueId": request_id,
         "Data": "System approved the stack creation"
     }
-    response = requests.put(approval_url, data=json.dumps(success_response_data))
+    with metrics.timer('Callback'):
+        response = http_session(side_effect_concurrency).put(approval_url, data=json.dumps(success_response_data), timeout=10)
+    response.raise_for_status()
     logger.info("Successfully auto approved a request with request id: {} with response {}".format(request_id, response))
+    clear_callback_pending(request)
+
+
+# Remove the callback mark of a system approved request, a request terminated meanwhile has none left
+def clear_callback_pending(request):
+    client = dynamodb_client(side_effect_concurrency)
+    try:
+        client.update_item(
+            TableName=budgets_table_name,
+            Key=to_item({'partitionKey': request.partitionKey, 'rangeKey': request.rangeKey}),
+            UpdateExpression='remove #e',
+            ConditionExpression='requestStatus = :s and #e = :e',
+            ExpressionAttributeNames={'#e': entity_status_attribute},
+            ExpressionAttributeValues=to_item({
+                ':s': approved_req_status,
+                ':e': entity_status_key(request.businessEntity, callback_pending_status)
+            })
+        )
+    except client.exceptions.ConditionalCheckFailedException:
+        logger.info("Request {} is no longer waiting on its approval callback".format(request.rangeKey))
 
 
-# Notify an admin over a SNS topic
+# Notify an admin over a SNS topic, the message is built from the budget as it is now
+# and published by the dispatcher once the transition of the request committed
 def notify_admin(request, budget):
-    logger.info("Request received to notify admin for requestid : {}".format(request['rangeKey']))
+    logger.info("Request received to notify admin for requestid : {}".format(request.rangeKey))
     now = datetime.now()
     month = now.month
     year = now.year
     curr_month_name = calendar.month_name[month] + ', ' + str(year)
 
     topic_arn = budget['notifySNSTopic']
-    topic = sns.Topic(topic_arn)
-    email_id = request['requestorEmail']
-    instance_type = request['requestPayload']['InstanceType']
-    approval_url = request['requestApprovalUrl']
-    rejection_url = request['requestRejectionUrl']
+    email_id = request.requestorEmail
+    instance_type = request.instanceType
+    approval_url = request.requestApprovalUrl
+    rejection_url = request.requestRejectionUrl
     budget_limit = budget['budgetLimit']
     accrued_blocked = budget['accruedBlockedSpend']
-    requested_amt_31days = request['pricingInfoAtRequest']['31DayPrice']
+    requested_amt_31days = request.requestedMonthlyAmount
     forecasted_spend = budget['accruedForecastedSpend'] + budget['accruedApprovedSpend']
-    actual_spend = budget['actualSpend']
-    response = topic.publish(
-        Subject='Request for approval to launch a Linux EC2 Instance',
-        Message='\
+    actual_spend = month_to_date_spend(budget, now)
+    message = ('\
         Dear Admin,\n\
-        An user (' + email_id + ') has requested to launch a Linux EC2 instance (' + instance_type + ').\n\n\
-        Monthly Budget Limit : ' + str(budget_limit) + '\n\
-        Forecasted spend for month of ' + curr_month_name + ': ' + str(forecasted_spend)+'\n\
-        Actual spend for month of ' + curr_month_name + ' (MTD): ' + str(actual_spend)+'\n\
-        Total spend of pending requests in pipeline (exclusive of current request): ' + str(accrued_blocked - requested_amt_31days) + '\n\
-        Exception requested amount (Monthly Recurring): ' + str(requested_amt_31days) + '\n\
+        An user (' + email_id + ') has requested to launch ' + describe_instances(request, instance_type) + '.\n\n\
+        Monthly Budget Limit : ' + to_number(budget_limit) + '\n\
+        Forecasted spend for month of ' + curr_month_name + ': ' + to_number(forecasted_spend)+'\n\
+        Actual spend for month of ' + curr_month_name + ' (MTD): ' + to_number(actual_spend)+'\n\
+        Total spend of pending requests in pipeline (exclusive of current request): ' + to_number(accrued_blocked - requested_amt_31days) + '\n\
+        Exception requested amount (Monthly Recurring): ' + to_number(requested_amt_31days) + '\n\
         \n\nKindly act by clicking the below URLs.\n\n' +
         'Approval Url (click to approve) ' + approval_url +
         '\n\nRejection Url (click to reject) ' + rejection_url +
         '\n\nPlease note that request will be auto rejected in 12 hrs if no action is taken\n\n\
         Thanks,\n\
         Product Approval Team\n')
-    logger.info("Status of email notification: {}".format(response))
+    dispatcher.defer((request.partitionKey, request.rangeKey), 'notification of request {}'.format(request.rangeKey),
+                     publish_notification, topic_arn, notification_subject(request), message)
     return True
 
 
-# update accruals in the database
-def update_accrued_amt(budget_dict):
-    logger.info("Updated Dict Object before updating the accrued spends: {}".format(budget_dict))
+# The month to date spend summed from the CUR is fresher than the one of AWS Budgets, it is used once
+# the CUR of the current billing period was ingested
+def month_to_date_spend(budget, now):
+    if 'curActualSpend' in budget and budget.get('curBillingPeriod', '').startswith(now.strftime('%Y%m')):
+        return budget['curActualSpend']
+    return budget['actualSpend']
+
+
+# Describe the instances of a request, fleet requests launch several instances with one approval
+def describe_instances(request, instance_type):
+    instance_count = request.instanceCount
+    if instance_count > 1:
+        return '{} Linux EC2 instances ({})'.format(instance_count, instance_type)
+    return 'a Linux EC2 instance ({})'.format(instance_type)
+
+
+# SNS subjects are limited to 100 characters, the instance types are only listed in the message
+def notification_subject(request):
+    instance_count = request.instanceCount
+    if instance_count > 1:
+        return 'Request for approval to launch {} Linux EC2 Instances'.format(instance_count)
+    return 'Request for approval to launch a Linux EC2 Instance'
+
+
+# Publish a notification to a SNS topic
+def publish_notification(topic_arn, subject, message):
+    with metrics.timer('Notify'):
+        response = sns_client(side_effect_concurrency).publish(TopicArn=topic_arn, Subject=subject, Message=message)
+    logger.info("Status of email notification: {}".format(response))
+    return response
+
+
+# update accruals in the database. Every transaction of a business entity adds the accrual deltas
+# of the status transitions it commits to an accrual counter, so that approvals and terminations
+# done meanwhile are kept and a sweep that stops midway leaves accruals matching the requests.
+# A new forecast is applied first, in a transaction of its own. Returns the keys of the requests
+# whose status transition committed
+def update_accrued_amt(budget_dict, loaded_accruals):
+    logger.debug("Updated Dict Object before updating the accrued spends: %s", budget_dict)
+    budgets = {}
+    # the version the budget rows are at once the leading transaction of their group committed
+    versions = {}
     for key, value in budget_dict.items():
+        reset_processed = value.get('accrualsResetProcessed', True)
+        if value['budgetForecastProcessed'] and reset_processed and not write_buffer.has_updates(value['rangeKey']):
+            logger.info("No accrual change for key {}, skipping".format(key))
+            continue
         logger.info("Updating accrued Amt for key {}".format(key))
-        update_expression = "set accruedForecastedSpend=:a, accruedBlockedSpend=:b, accruedApprovedSpend=:c"
-        expression_attributes = {
-            ':b': value['accruedBlockedSpend'],
-            ':a': value['accruedForecastedSpend'],
-            ':c': value['accruedApprovedSpend']
-        }
-        if not value['budgetForecastProcessed']:
-            logger.info("Set budgetForcast Processed to True for business entity {}".format(key))
-            update_expression = update_expression + ', budgetForecastProcessed=:e, budgetForecastProcessedAt=:d'
-            expression_attributes[':e'] = True
-            expression_attributes[':d'] = str(datetime.utcnow())
-
-        response = budgets_table.update_item(
-            Key={'partitionKey': budgets_partition_key, 'rangeKey': value['rangeKey']},
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=expression_attributes,
-            ReturnValues="UPDATED_NEW"
-        )
-        logger.info('Successfully Updated accrued Amt for Key: {} with response {}'.format(key, response))
-    return True
+        budgets[value['rangeKey']] = value
+        versions[value['rangeKey']] = value.get('budgetVersion', 0)
+        budget_key = {'partitionKey': value['partitionKey'], 'rangeKey': value['rangeKey']}
+        # the reset was picked up, later writes of the row no longer trigger a sweep
+        reset_attributes = {} if reset_processed else {'accrualsResetProcessed': True}
+        if value['budgetForecastProcessed']:
+            if reset_attributes:
+                write_buffer.stage(value['rangeKey'], budget_key, budget_update(
+                    budgets_table_name, value['partitionKey'], value['rangeKey'], set_attributes=reset_attributes), leading=True)
+                versions[value['rangeKey']] += 1
+            continue
+        logger.info("Set budgetForcast Processed to True for business entity {}".format(key))
+        # the forecast replaces the accrued forecast of the row and of the counters, as long as
+        # neither the forecast nor the accrued forecast moved since the read
+        counter_forecast = sum(counter.get('accruedForecastedSpend', 0) for counter in value['accrualCounters'])
+        write_buffer.stage(value['rangeKey'], budget_key, budget_update(
+            budgets_table_name, value['partitionKey'], value['rangeKey'],
+            set_attributes=dict(reset_attributes, **{
+                'accruedForecastedSpend': value['forecastedSpend'],
+                'budgetForecastProcessed': True,
+                'budgetForecastProcessedAt': str(datetime.utcnow())
+            }),
+            expected_attributes={
+                'forecastedSpend': value['forecastedSpend'],
+                'accruedForecastedSpend': loaded_accruals[key]['accruedForecastedSpend'] - counter_forecast
+            }
+        ), leading=True)
+        versions[value['rangeKey']] += 1
+        for counter in value['accrualCounters']:
+            write_buffer.stage(value['rangeKey'], counter, counter_update(
+                budgets_table_name, counter, {'accruedForecastedSpend': 0}), leading=True)
+
+    # the deltas of a transaction are added to a counter picked at random, while the budget row is at the version
+    # the sweep evaluated. The headroom the next incremental sweep compares with is set on the first counter
+    # with the last transaction, when it changed
+    def accrual_actions(group, accruals, last):
+        budget = budgets[group]
+        shard = None
+        set_attributes = None
+        if last and 'sweepHeadroom' in budget and budget['sweepHeadroom'] != last_headroom(budget):
+            shard = 0
+            set_attributes = {'lastHeadroom': budget['sweepHeadroom']}
+        return [budget_check(budgets_table_name, budget['partitionKey'], budget['rangeKey'], versions[group]),
+                accrual_update(budgets_table_name, budget['partitionKey'], budget['rangeKey'],
+                               forecasted=accruals['accruedForecastedSpend'],
+                               blocked=accruals['accruedBlockedSpend'],
+                               approved=accruals['accruedApprovedSpend'],
+                               shard=shard, set_attributes=set_attributes)]
 
+    committed = write_buffer.flush(entity_workers, accrual_actions)
+    logger.info('Successfully Updated accrued Amt, {} status transitions committed'.format(len(committed)))
+    return committed
 
-# get budgets for all business entities
+
+# get budgets for all business entities, the budget shards are read in parallel. The accrual
+# counters stored next to the budgets are read with them and summed into their budget.
+# Budgets are read as records, see records.py
 def get_budget_info():
-    response = budgets_table.query(
-        KeyConditionExpression=Key('partitionKey').eq(budgets_partition_key),
-        ProjectionExpression='notifySNSTopic,accruedApprovedSpend,businessEntity,rangeKey,accruedBlockedSpend,actualSpend,approverEmail,budgetLimit,forecastedSpend,accruedForecastedSpend,budgetForecastProcessed'
+    items = query_partitions(
+        budget_partition_keys(),
+        decode_item=decode_budget_item,
+        TableName=budgets_table_name,
+        ProjectionExpression='partitionKey,lastHeadroom,notifySNSTopic,accruedApprovedSpend,businessEntity,rangeKey,accruedBlockedSpend,actualSpend,approverEmail,budgetLimit,forecastedSpend,accruedForecastedSpend,budgetForecastProcessed,accrualsResetProcessed,budgetVersion,curActualSpend,curBillingPeriod'
     )
+    budgets = fold_accrual_counters(items)
     logger.info("Budget Info fetched from database")
-    return response['Items']
+    return budgets
 
 
-# Get requests by state
-def get_requests(request_state):
-    response = budgets_table.query(
-        IndexName='query-by-request-status',
-        KeyConditionExpression=Key('requestStatus').eq(request_state),
-        ScanIndexForward=True,
-        ProjectionExpression='stackWaitUrl,rangeKey,requestorEmail,requestApprovalUrl,pricingInfoAtRequest,requestPayload,businessEntity,requestStatus,requestRejectionUrl'
-    )
-    logger.info("Requests fetched from DB for state: {}, request count {}".format(request_state, len(response['Items'])))
-    return response['Items']
+# Get the blocked requests of a business entity priced at or below the headroom from the sparse
+# blocked cost index, cheapest first
+def get_fitting_blocked_requests(business_entity, budget_headroom):
+    if budget_headroom < 0:
+        return
+    yield from query_items(
+        Request,
+        TableName=budgets_table_name,
+        IndexName=blocked_cost_index,
+        KeyConditionExpression='blockedEntity = :e and blockedCost <= :h',
+        ExpressionAttributeValues=to_item({':e': business_entity, ':h': budget_headroom}, (':h',)))
+
+
+# Get the first blocked request of a business entity after a requestTime that is not one of the
+# fitting requests. Only the fitting requests in between are read
+def next_unfitting_blocked_request(business_entity, after_request_time, fitting_ids):
+    key_condition = 'entityStatus = :e'
+    values = {':e': entity_status_key(business_entity, blocked_req_status)}
+    if after_request_time is not None:
+        key_condition = key_condition + ' and requestTime > :t'
+        values[':t'] = after_request_time
+    for item in query_items(
+            Request,
+            TableName=budgets_table_name,
+            IndexName=entity_status_index,
+            KeyConditionExpression=key_condition,
+            ExpressionAttributeValues=to_item(values),
+            ScanIndexForward=True):
+        if item.rangeKey not in fitting_ids:
+            return item
+    return None
+
+
+# Get the active requests of a business entity by state from the sparse index, pages are
+# fetched lazily following LastEvaluatedKey and requests are yielded as records in requestTime order
+def get_entity_requests(business_entity, request_state):
+    request_count = 0
+    for item in query_items(
+            Request,
+            TableName=budgets_table_name,
+            IndexName=entity_status_index,
+            KeyConditionExpression='entityStatus = :e',
+            ExpressionAttributeValues={':e': {'S': entity_status_key(business_entity, request_state)}},
+            ScanIndexForward=True):
+        request_count = request_count + 1
+        yield item
+    logger.debug("Requests fetched from DB for %s in state: %s, request count %s", business_entity, request_state, request_count)
 
 
-# Update the status of the request in dynamo-db
-def update_request_status(request_id, request_status, busines_entity_id):
-    update_expression = "set requestStatus = :s, businessEntityId=:b"
-    expression_attributes = {
-        ':s': request_status,
-        ':b': busines_entity_id,
-        # ':r': 'Active'
+# Stage the status update of the request, written with the accruals of its budget by update_accrued_amt.
+# The update only applies if the request is still in the state it was read in. The request keeps
+# the partition key of its budget, the approval and termination update the accruals through it
+def update_request_status(request, request_status, budget, current_status=None, accruals=None):
+    request_id = request.rangeKey
+    busines_entity_id = budget['rangeKey']
+    attributes = {
+        'requestStatus': request_status,
+        'businessEntityId': busines_entity_id,
+        'budgetPartitionKey': budget['partitionKey']
     }
+    attributes.update(entity_status_attributes(budget['businessEntity'], request_status))
+    attributes.update(blocked_cost_attributes(budget['businessEntity'], request_status, request.requestedMonthlyAmount))
     if request_status == "APPROVED_SYSTEM":
-        update_expression = update_expression + ", requestApprovalTime=:c, resourceStatus=:d"
-        expression_attributes[':c'] = str(datetime.utcnow())
-        expression_attributes[':d'] = 'ACTIVE'
-
-    response = budgets_table.update_item(
-        Key={'partitionKey': requests_partition_key, 'rangeKey': request_id},
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_attributes,
-        ReturnValues="UPDATED_NEW")
-    logger.debug("UpdateItem succeeded:")
-    logger.debug(json.dumps(response))
+        attributes['requestApprovalTime'] = str(datetime.utcnow())
+        attributes['resourceStatus'] = 'ACTIVE'
+        # the sweeps send the approval callback again until it went through, see resend_approval_callbacks
+        attributes[entity_status_attribute] = entity_status_key(budget['businessEntity'], callback_pending_status)
+    write_buffer.update(busines_entity_id, {'partitionKey': request.partitionKey, 'rangeKey': request_id}, attributes,
+                        [current_status] if current_status else None, accruals)
+    logger.debug("Staged status %s for request %s", request_status, request_id)
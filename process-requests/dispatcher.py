@@ -0,0 +1,100 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Bounded thread pool for the side effects of a sweep (wait handle callbacks and
+# SNS notifications). The budget math stays on the calling thread, only the
+# network calls run concurrently, each one retried with exponential backoff.
+# Calls can be deferred until the write they depend on committed.
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger()
+
+
+class SideEffectDispatcher:
+
+    def __init__(self, max_workers, max_attempts=3, backoff_seconds=0.2):
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='side-effect')
+        self._futures = []
+        self._deferred = []
+        self._lock = threading.Lock()
+
+    # Schedule a call, group identifies the call in the failed groups drain returns
+    def submit(self, group, description, fn, *args):
+        future = self._executor.submit(self._call_with_retry, description, fn, *args)
+        with self._lock:
+            self._futures.append((group, description, future))
+        return future
+
+    # Hold a call until the key it depends on is released
+    def defer(self, key, description, fn, *args):
+        with self._lock:
+            self._deferred.append((key, description, fn, args))
+
+    # Schedule the deferred calls of the released keys, the calls of every other key are dropped
+    def release(self, keys):
+        with self._lock:
+            deferred = self._deferred
+            self._deferred = []
+        dropped = 0
+        for key, description, fn, args in deferred:
+            if key in keys:
+                self.submit(key, description, fn, *args)
+            else:
+                logger.info("Dropping {}, its write did not commit".format(description))
+                dropped = dropped + 1
+        return dropped
+
+    def clear(self):
+        with self._lock:
+            self._deferred = []
+
+    # Wait for every scheduled call and return the groups that had a failed call
+    def drain(self):
+        with self._lock:
+            futures = self._futures
+            self._futures = []
+        wait([future for _, _, future in futures])
+        failed_groups = set()
+        for group, description, future in futures:
+            if future.exception() is not None:
+                logger.error("Giving up on {}: {}".format(description, future.exception()))
+                failed_groups.add(group)
+        logger.info("Dispatched {} side effects, {} groups failed".format(len(futures), len(failed_groups)))
+        return failed_groups
+
+    def _call_with_retry(self, description, fn, *args):
+        attempt = 1
+        while True:
+            try:
+                return fn(*args)
+            except Exception as e:
+                if attempt >= self.max_attempts:
+                    raise
+                delay = self.backoff_seconds * (2 ** (attempt - 1)) * (1 + random.random())
+                logger.info("Attempt {} of {} failed: {}, retrying in {:.2f}s".format(attempt, description, e, delay))
+                time.sleep(delay)
+                attempt = attempt + 1
@@ -0,0 +1,74 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Routes requests to worker lanes by business entity. Every business entity is
+# pinned to one lane and a lane handles its items first in first out, so the
+# requests of an entity keep their order while entities run in parallel.
+import logging
+import queue
+import threading
+import zlib
+
+logger = logging.getLogger()
+_end_of_stream = object()
+
+
+class EntityLanes:
+
+    def __init__(self, lane_count, handler, queue_size=1000):
+        self.handler = handler
+        self.failed_entities = set()
+        self._lock = threading.Lock()
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(lane_count)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(lane_queue,), name='entity-lane-{}'.format(index), daemon=True)
+            for index, lane_queue in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    # Queue an item for its business entity, blocks while the lane is full
+    def submit(self, business_entity, item):
+        lane = zlib.crc32(business_entity.encode('utf-8')) % len(self._queues)
+        self._queues[lane].put((business_entity, item))
+
+    # Wait for every lane to finish and return the business entities that failed
+    def join(self):
+        for lane_queue in self._queues:
+            lane_queue.put(_end_of_stream)
+        for thread in self._threads:
+            thread.join()
+        return self.failed_entities
+
+    def _run(self, lane_queue):
+        while True:
+            entry = lane_queue.get()
+            if entry is _end_of_stream:
+                return
+            business_entity, item = entry
+            if business_entity in self.failed_entities:
+                continue
+            try:
+                self.handler(item)
+            except Exception as e:
+                # later requests of the entity depend on this one, stop processing the entity
+                logger.error("Failed processing business entity {}: {}".format(business_entity, e))
+                with self._lock:
+                    self.failed_entities.add(business_entity)
@@ -0,0 +1,148 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Compact records for the requests and budgets evaluated by a sweep. A record
+# keeps the item in the DynamoDB wire format as returned by the low-level client
+# and decodes an attribute the first time it is read, into a slot. Attributes the
+# sweep never reads, such as most of the pricing, are never decoded. Records can
+# be read like the dicts of from_item (record['rangeKey'], .get, in), so the
+# admission rule and the accrual helpers work on records and dicts alike.
+from keys import split_accrual_counter_key
+from money import from_item, to_micros
+
+
+def _string(name):
+    return lambda item: item[name]['S']
+
+
+def _boolean(name):
+    return lambda item: item[name]['BOOL']
+
+
+def _money(name):
+    return lambda item: to_micros(item[name]['N'])
+
+
+def _pricing_money(name):
+    return lambda item: to_micros(item['pricingInfoAtRequest']['M'][name]['N'])
+
+
+def _pricing_count(item):
+    count = item['pricingInfoAtRequest']['M'].get('InstanceCount')
+    return int(count['N']) if count else 1
+
+
+class Record:
+    __slots__ = ('_item',)
+    # attribute name -> function decoding it from the wire item, raises KeyError when the item does not have it
+    _decoders = {}
+
+    def __init__(self, item):
+        self._item = item
+
+    # only called for slots that are not set yet, the decoded value is kept in the slot
+    def __getattr__(self, name):
+        decoder = self._decoders.get(name)
+        if decoder is None:
+            raise AttributeError(name)
+        try:
+            value = decoder(self._item)
+        except KeyError:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    # only the slots of the record can be set, other names raise KeyError
+    def __setitem__(self, name, value):
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        try:
+            getattr(self, name)
+        except AttributeError:
+            return False
+        return True
+
+    def get(self, name, default=None):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            return default
+
+    # only the attributes decoded so far are shown, building the repr never decodes
+    def __repr__(self):
+        values = {}
+        for name in self.__slots__:
+            try:
+                values[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        return '{}({})'.format(type(self).__name__, values)
+
+
+# An active request as read from the entity status or blocked cost index. requestedAmount (EstCurrMonthPrice)
+# and requestedMonthlyAmount (31DayPrice) are read from the pricing without decoding the rest of it
+class Request(Record):
+    __slots__ = ('partitionKey', 'rangeKey', 'requestStatus', 'requestTime', 'businessEntity', 'stackWaitUrl',
+                 'requestorEmail', 'requestApprovalUrl', 'requestRejectionUrl', 'instanceType', 'requestedAmount',
+                 'requestedMonthlyAmount', 'instanceCount', 'pricingInfoAtRequest')
+    _decoders = dict(
+        {name: _string(name) for name in ('partitionKey', 'rangeKey', 'requestStatus', 'requestTime', 'businessEntity',
+                                          'stackWaitUrl', 'requestorEmail', 'requestApprovalUrl', 'requestRejectionUrl',
+                                          'instanceType')},
+        requestedAmount=_pricing_money('EstCurrMonthPrice'),
+        requestedMonthlyAmount=_pricing_money('31DayPrice'),
+        instanceCount=_pricing_count,
+        pricingInfoAtRequest=lambda item: from_item({'pricingInfoAtRequest': item['pricingInfoAtRequest']})['pricingInfoAtRequest']
+    )
+
+
+# A budget row. Besides the stored attributes it carries the state of the sweep: the accrual counters
+# folded into it, whether a request waits on the admin and the headroom left at the end of the sweep
+class Budget(Record):
+    __slots__ = ('partitionKey', 'rangeKey', 'businessEntity', 'notifySNSTopic', 'approverEmail', 'curBillingPeriod',
+                 'budgetLimit', 'actualSpend', 'forecastedSpend', 'accruedForecastedSpend', 'accruedBlockedSpend',
+                 'accruedApprovedSpend', 'curActualSpend', 'budgetForecastProcessed',
+                 'accrualsResetProcessed', 'budgetVersion', 'accrualCounters', 'pendingRequestExists', 'sweepHeadroom')
+    _decoders = dict(
+        {name: _string(name) for name in ('partitionKey', 'rangeKey', 'businessEntity', 'notifySNSTopic', 'approverEmail',
+                                          'curBillingPeriod')},
+        **{name: _money(name) for name in ('budgetLimit', 'actualSpend', 'forecastedSpend', 'accruedForecastedSpend',
+                                           'accruedBlockedSpend', 'accruedApprovedSpend', 'curActualSpend')},
+        budgetForecastProcessed=_boolean('budgetForecastProcessed'),
+        accrualsResetProcessed=_boolean('accrualsResetProcessed'),
+        budgetVersion=lambda item: int(item['budgetVersion']['N'])
+    )
+
+
+# Decode an item read from the budget partitions, accrual counters stay dicts as the accrual helpers read them
+def decode_budget_item(item):
+    if split_accrual_counter_key(item['rangeKey']['S'])[1] is None:
+        return Budget(item)
+    return from_item(item)
@@ -0,0 +1,144 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Coalesces the DynamoDB updates of a sweep and flushes them as TransactWriteItems.
+# Updates are grouped per budget. A group larger than one transaction commits in
+# several, so every status transition carries the accrual deltas it caused and
+# each transaction adds the deltas of just its own transitions: whatever part of
+# a group commits, the accruals match the requests that moved.
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from accruals import accrual_attributes, request_update, transact
+from clients import dynamodb_client
+
+logger = logging.getLogger()
+# TransactWriteItems accepts up to 100 actions per call
+max_transaction_items = 100
+# actions the accrual_actions of a flush may add to every transaction of a group
+max_accrual_items = 2
+
+
+class WriteBuffer:
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self._groups = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Stage a set of attributes on an item, later updates to the same item are merged and
+    # the update only applies while the item is in one of the expected states of the first one.
+    # accruals are the forecasted, blocked and approved deltas the update causes on the group budget
+    def update(self, group, key, attributes, expected_statuses=None, accruals=None):
+        item_key = (key['partitionKey'], key['rangeKey'])
+        accruals = accruals or {}
+        with self._lock:
+            updates = self._groups.setdefault(group, OrderedDict())
+            if item_key in updates and 'attributes' in updates[item_key]:
+                updates[item_key]['attributes'].update(attributes)
+                for name, delta in accruals.items():
+                    updates[item_key]['accruals'][name] = updates[item_key]['accruals'].get(name, 0) + delta
+            else:
+                updates[item_key] = {'key': key, 'attributes': dict(attributes), 'expected': expected_statuses,
+                                     'accruals': dict(accruals)}
+
+    # Stage a prebuilt TransactWriteItems action, replacing anything staged for the item at the same
+    # place. Leading actions commit in a transaction of their own before the updates of the group,
+    # the others land in its last transaction
+    def stage(self, group, key, action, leading=False):
+        item_key = (key['partitionKey'], key['rangeKey'], leading)
+        with self._lock:
+            updates = self._groups.setdefault(group, OrderedDict())
+            updates.pop(item_key, None)
+            updates[item_key] = {'key': key, 'action': action, 'leading': leading}
+
+    def has_updates(self, group):
+        return bool(self._groups.get(group))
+
+    def discard(self, group):
+        with self._lock:
+            self._groups.pop(group, None)
+
+    def clear(self):
+        with self._lock:
+            self._groups.clear()
+
+    # Flush every group and return the (partitionKey, rangeKey) of the status updates that committed.
+    # accrual_actions(group, accruals, last) builds the actions that add the summed accrual deltas of the
+    # updates in a transaction, at most max_accrual_items of them, last is set for the last transaction
+    # of the group. Groups are independent and are
+    # flushed by up to max_workers threads
+    def flush(self, max_workers=1, accrual_actions=None):
+        with self._lock:
+            groups = list(self._groups.items())
+            self._groups.clear()
+        committed = set()
+        if max_workers > 1 and len(groups) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='flush') as executor:
+                for keys in executor.map(lambda group: self._flush_group(*group, accrual_actions), groups):
+                    committed.update(keys)
+            return committed
+        for group, updates in groups:
+            committed.update(self._flush_group(group, updates, accrual_actions))
+        return committed
+
+    # Commit the transactions of a group in order, the first failed one stops the group
+    def _flush_group(self, group, updates, accrual_actions=None):
+        transactions = self._transactions(group, updates, accrual_actions)
+        committed = []
+        transaction_count = 0
+        for actions, keys in transactions:
+            if not transact(dynamodb_client(), actions):
+                # an item changed since it was read, the next sweep evaluates the group again
+                logger.error("Stopped flushing group {} after a failed condition check".format(group))
+                break
+            committed.extend(keys)
+            transaction_count = transaction_count + 1
+        logger.info("Flushed {} updates for group {} in {} of {} transactions".format(
+            len(updates), group, transaction_count, len(transactions)))
+        return committed
+
+    # Split a group into transactions and the keys of the status updates in each: the leading actions,
+    # then the status updates in chunks that each add their own accrual deltas, the other staged
+    # actions join the last chunk
+    def _transactions(self, group, updates, accrual_actions=None):
+        leading = [update['action'] for update in updates.values() if update.get('leading')]
+        trailing = [update['action'] for update in updates.values() if 'action' in update and not update['leading']]
+        status_updates = [update for update in updates.values() if 'attributes' in update]
+        transactions = [(leading, [])] if leading else []
+        chunk_size = max_transaction_items - max_accrual_items - len(trailing)
+        for start in range(0, max(len(status_updates), 1), chunk_size):
+            chunk = status_updates[start:start + chunk_size]
+            actions = [self._action(update) for update in chunk]
+            if accrual_actions:
+                accruals = {name: sum(update['accruals'].get(name, 0) for update in chunk) for name in accrual_attributes}
+                last = start + chunk_size >= len(status_updates)
+                actions.extend(action for action in accrual_actions(group, accruals, last) if action)
+            if start + chunk_size >= len(status_updates):
+                actions.extend(trailing)
+            if actions:
+                transactions.append((actions, [(update['key']['partitionKey'], update['key']['rangeKey']) for update in chunk]))
+        return transactions
+
+    def _action(self, update):
+        key = update['key']
+        return request_update(self.table_name, key['partitionKey'], key['rangeKey'], update['attributes'], update['expected'])
@@ -21,117 +21,389 @@
 import json
 import logging
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from decimal import Decimal
+from urllib.parse import unquote_plus
 
-import boto3
-from boto3.dynamodb.conditions import Key
+from clients import budgets_client, dynamodb_client, get_client, query_items, query_partitions, to_item
+from accruals import accrual_attributes, budget_update, counter_update, fold_accrual_counters, transact
+from cur_ingest import NoProgress, OutOfTime, ingest_manifest
+from keys import budget_partition_key, budget_partition_keys, split_accrual_counter_key
+from metrics import Metrics
+from money import from_item, to_item as to_money_item, to_micros
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get('LogLevel', 'INFO'))
+metrics = Metrics('rebase-budgets')
 region = os.environ['AWS_REGION']
 budgets_table_name = os.environ['BudgetsTable']
-dynamodb = boto3.resource('dynamodb', region_name=region)
-budgets_table = dynamodb.Table(budgets_table_name)
-partition_key = 'BUDGET'
-req_partition_key = 'REQUEST'
-client = boto3.client('budgets')
+# budget rows are written in parallel, the table client pool is sized to match
+rebase_concurrency = int(os.environ.get('RebaseConcurrency', '8'))
+# a CUR delivery uploads several manifests, one rebase per billing period is done within the debounce window
+rebase_partition_key = 'REBASE'
+rebase_debounce_seconds = int(os.environ.get('RebaseDebounceSeconds', '900'))
+rebase_claim_ttl_seconds = 40 * 24 * 3600
+billing_period_pattern = re.compile(r'^\d{8}-\d{8}$')
+# CUR ingestion checkpoints and hands over to a new invocation when less time than this is left
+cur_ingestion_reserve_millis = 60 * 1000
 
 
+@metrics.handler
 def lambda_handler(event, context):
     logger.info(json.dumps(event))
     account_id = os.environ['AccountId']
     try:
-        # Fetch available business units from database
-        business_entities = get_business_entities()
         # Check for request from S3
         if 'Records' in event:
-            for record in event['Records']:
-                key = record['s3']['object']['key']
-                # Look for manifest file only, it may be the case that there are multiple files uploaded by CUR
-                # we do not want to rebase multiple times
-                if key.split(".")[-1] == "json":
-                    # fetch pricing and save the data to ddb
-                    logger.info("Pricing Manifest file found at {}".format(key))
-                    for entity in business_entities:
-                        logger.info("Processing Budget for Entity {}".format(entity))
-                        budget_name = entity['budgetName']
-                        range_key = entity['rangeKey']
-                        budget_info = get_budget_details(account_id, budget_name)
-                        budget_amt = Decimal(budget_info['Budget']['BudgetLimit']['Amount'])
-                        actual_spend = Decimal(budget_info['Budget']['CalculatedSpend']['ActualSpend']['Amount'])
-                        forecast_spend = Decimal(budget_info['Budget']['CalculatedSpend']['ForecastedSpend']['Amount'])
-                        # Reset accrued_forcasted_spend whenever there is a budget update from AWS
-                        update_pricing_info(range_key, budget_name, budget_amt, actual_spend, forecast_spend)
+            # Look for manifest files only, it may be the case that there are multiple files uploaded by CUR
+            # we do not want to rebase multiple times
+            manifests = get_manifests(event['Records'])
+            if not manifests:
+                return {'statusCode': '200', 'body': 'No manifest file in the event, skip the event'}
+            claimed = {period: manifest for period, manifest in manifests.items() if claim_rebase(period, *manifest)}
+            if not claimed:
+                logger.info("Manifests {} were already rebased, skip the event".format(list(manifests.values())))
+                return {'statusCode': '200', 'body': 'Rebase already done for the billing period'}
+            rebase_claimed(account_id, claimed, context)
             return {'statusCode': '200', 'body': 'Successfully rebased accruedForecastSpend'}
+        # Manifests that arrived within the debounce window of their billing period
+        elif 'deferredRebases' in event:
+            claimed = claim_deferred_rebases()
+            if claimed:
+                rebase_claimed(account_id, claimed, context)
+            return {'statusCode': '200', 'body': 'Rebased {} deferred billing periods'.format(len(claimed))}
         # Monthly rebase of accruedApprovalSpend
         elif 'source' in event and event['source'] == 'aws.events':
             logger.info("Event received from CloudWatchRule")
-            for entity in business_entities:
+            for entity in get_business_entities():
                 logger.info("Reset accruedApprovedSpend for business entity {}".format(entity))
                 budget_name = entity['budgetName']
-                range_key = entity['rangeKey']
-                reset_accrued_approved_amt(range_key, budget_name)
+                reset_accrued_approved_amt(entity['partitionKey'], entity['rangeKey'], budget_name)
             return {'statusCode': '200', 'body': 'Successfully rebased AccruedApproval Amount'}
+        # Continuation of a CUR ingestion that ran out of time
+        elif 'curIngestion' in event:
+            ingestion = event['curIngestion']
+            ingest_cur_spend(ingestion['bucket'], ingestion['manifestKey'], ingestion['billingPeriod'], context)
+            return {'statusCode': '200', 'body': 'Successfully ingested CUR spend'}
     except Exception as e:
         logger.error(e)
         return {'statusCode': '500', 'body': e}
 
 
-# Reset Accruals in database
-def reset_accrued_approved_amt(range_key, budget_name):
-    logger.info("Resetting the accruedApprovedSpent at beginning of the month for business entity id {}".format(range_key))
-    response = budgets_table.update_item(
-        Key={'partitionKey': partition_key, 'rangeKey': range_key},
-        UpdateExpression="set accruedApprovedSpend=:a",
-        ExpressionAttributeValues={':a': Decimal(0.0)},
-        ReturnValues="UPDATED_NEW"
-    )
-    logger.info('Updated Pricing Info for Budget: {} with response {}'.format(budget_name, response))
+# Get the manifest files of a batch of S3 records keyed by CUR billing period, the last manifest of a period wins.
+# Manifests are returned as (bucket, key, etag)
+def get_manifests(records):
+    manifests = {}
+    for record in records:
+        key = unquote_plus(record['s3']['object']['key'])
+        if key.split(".")[-1] != "json":
+            continue
+        logger.info("Pricing Manifest file found at {}".format(key))
+        manifests[get_billing_period(key)] = (record['s3']['bucket']['name'], key, record['s3']['object'].get('eTag', ''))
+    return manifests
+
+
+# CUR writes manifests under <prefix>/<report>/<yyyymmdd-yyyymmdd>/, keys outside that layout are their own period
+def get_billing_period(key):
+    for part in key.split('/'):
+        if billing_period_pattern.match(part):
+            return part
+    return key
+
+
+# Rebase the budgets for the claimed manifests, keyed by billing period, and ingest their CUR spend.
+# The claims are released when the rebase fails
+def rebase_claimed(account_id, claimed, context):
+    # fetch pricing and save the data to ddb, budgets are per account so one rebase covers every period
+    try:
+        rebase_budgets(account_id, get_business_entities())
+    except Exception:
+        for period, manifest in claimed.items():
+            release_rebase_claim(period, *manifest)
+        raise
+    # the month to date spend of the current billing period is summed from the report itself
+    for period, (bucket, key, etag) in claimed.items():
+        ingest_cur_spend(bucket, key, period, context)
+
+
+# Claim the rebase of a billing period with a conditional write. The claim fails when the
+# same manifest was already rebased or when the period was rebased within the debounce window,
+# a new manifest is then deferred until the window expired
+def claim_rebase(billing_period, bucket, manifest_key, manifest_etag):
+    now = int(time.time())
+    client = dynamodb_client(rebase_concurrency)
+    try:
+        client.put_item(
+            TableName=budgets_table_name,
+            Item=to_item({
+                'partitionKey': rebase_partition_key,
+                'rangeKey': billing_period,
+                'manifestKey': manifest_key,
+                'manifestETag': manifest_etag,
+                'rebasedAt': now,
+                'expiresAt': now + rebase_claim_ttl_seconds,
+            }),
+            ConditionExpression='attribute_not_exists(rangeKey) OR (manifestETag <> :e AND rebasedAt <= :c) OR '
+                                '(pendingManifestETag = :e AND rebasedAt <= :c)',
+            ExpressionAttributeValues=to_item({':e': manifest_etag, ':c': now - rebase_debounce_seconds})
+        )
+    except client.exceptions.ConditionalCheckFailedException:
+        metrics.add('RebasesCoalesced')
+        logger.info("Rebase of billing period {} already claimed, skip manifest {}".format(billing_period, manifest_key))
+        defer_rebase(billing_period, bucket, manifest_key, manifest_etag)
+        return False
+    return True
+
+
+# Keep the latest manifest of a billing period that was rebased within the debounce window on its
+# claim, claim_deferred_rebases rebases it once the window expired. Manifests already rebased are not kept
+def defer_rebase(billing_period, bucket, manifest_key, manifest_etag):
+    client = dynamodb_client(rebase_concurrency)
+    try:
+        client.update_item(
+            TableName=budgets_table_name,
+            Key=to_item({'partitionKey': rebase_partition_key, 'rangeKey': billing_period}),
+            UpdateExpression='set pendingBucket=:b, pendingManifestKey=:k, pendingManifestETag=:e',
+            ConditionExpression='attribute_exists(rangeKey) AND manifestETag <> :e',
+            ExpressionAttributeValues=to_item({':b': bucket, ':k': manifest_key, ':e': manifest_etag})
+        )
+    except client.exceptions.ConditionalCheckFailedException:
+        logger.info("Manifest {} of billing period {} was already rebased".format(manifest_key, billing_period))
+        return False
+    metrics.add('RebasesDeferred')
+    logger.info("Deferred the rebase of billing period {} for manifest {}".format(billing_period, manifest_key))
+    return True
+
+
+# Claim the deferred rebases whose debounce window expired. Returns the manifests claimed as
+# (bucket, key, etag) keyed by billing period
+def claim_deferred_rebases():
+    now = int(time.time())
+    client = dynamodb_client(rebase_concurrency)
+    claimed = {}
+    for claim in query_items(
+            from_item,
+            TableName=budgets_table_name,
+            KeyConditionExpression='partitionKey = :p',
+            FilterExpression='attribute_exists(pendingManifestETag) AND rebasedAt <= :c',
+            ExpressionAttributeValues=to_item({':p': rebase_partition_key, ':c': now - rebase_debounce_seconds})):
+        manifest = (claim['pendingBucket'], claim['pendingManifestKey'], claim['pendingManifestETag'])
+        try:
+            client.update_item(
+                TableName=budgets_table_name,
+                Key=to_item({'partitionKey': rebase_partition_key, 'rangeKey': claim['rangeKey']}),
+                UpdateExpression='set manifestKey=:k, manifestETag=:e, rebasedAt=:n, expiresAt=:x '
+                                 'remove pendingBucket, pendingManifestKey, pendingManifestETag',
+                ConditionExpression='pendingManifestETag = :e AND rebasedAt <= :c',
+                ExpressionAttributeValues=to_item({
+                    ':k': manifest[1],
+                    ':e': manifest[2],
+                    ':n': now,
+                    ':x': now + rebase_claim_ttl_seconds,
+                    ':c': now - rebase_debounce_seconds
+                })
+            )
+        except client.exceptions.ConditionalCheckFailedException:
+            logger.info("Deferred rebase of billing period {} was claimed meanwhile".format(claim['rangeKey']))
+            continue
+        logger.info("Claimed deferred rebase of billing period {} for manifest {}".format(claim['rangeKey'], manifest[1]))
+        claimed[claim['rangeKey']] = manifest
+    return claimed
+
+
+# Release a claim after a failed rebase. The manifest is deferred again and can be claimed right away,
+# by a retried event or by the next check of the deferred rebases
+def release_rebase_claim(billing_period, bucket, manifest_key, manifest_etag):
+    client = dynamodb_client(rebase_concurrency)
+    try:
+        client.update_item(
+            TableName=budgets_table_name,
+            Key=to_item({'partitionKey': rebase_partition_key, 'rangeKey': billing_period}),
+            UpdateExpression='set rebasedAt=:z, pendingBucket=:b, pendingManifestKey=:k, pendingManifestETag=:e',
+            ConditionExpression='manifestETag = :e',
+            ExpressionAttributeValues=to_item({':z': 0, ':b': bucket, ':k': manifest_key, ':e': manifest_etag})
+        )
+    except client.exceptions.ConditionalCheckFailedException:
+        logger.info("Rebase claim of billing period {} was taken over, nothing to release".format(billing_period))
+
+
+# Refresh the budget rows of all business entities, the budgets of the account are
+# fetched in pages and joined to the entities by budget name, rows are then updated in parallel
+def rebase_budgets(account_id, business_entities):
+    with metrics.timer('FetchBudgets'):
+        budgets = get_budgets(account_id)
+    updates = []
+    for entity in business_entities:
+        budget_name = entity['budgetName']
+        budget_info = budgets.get(budget_name)
+        if budget_info is None:
+            logger.error("Budget {} of business entity {} not found".format(budget_name, entity['rangeKey']))
+            continue
+        budget_amt = to_micros(budget_info['BudgetLimit']['Amount'])
+        actual_spend = to_micros(budget_info['CalculatedSpend']['ActualSpend']['Amount'])
+        forecast_spend = to_micros(budget_info['CalculatedSpend']['ForecastedSpend']['Amount'])
+        updates.append((entity['partitionKey'], entity['rangeKey'], budget_name, budget_amt, actual_spend, forecast_spend))
+    # Reset accrued_forcasted_spend whenever there is a budget update from AWS
+    with metrics.timer('Write'), ThreadPoolExecutor(max_workers=rebase_concurrency) as executor:
+        results = list(executor.map(lambda update: update_pricing_info(*update), updates))
+    metrics.add('BudgetsRebased', len(results))
+    logger.info("Rebased {} of {} business entities".format(len(results), len(business_entities)))
+    return len(results)
+
+
+# Sum the month to date spend per business entity from the report parts of a CUR manifest and store it on
+# the budget rows. Only the current billing period is ingested. When the invocation runs out of time the
+# ingestion is checkpointed and continued by an asynchronous invocation of this function
+def ingest_cur_spend(bucket, manifest_key, billing_period, context):
+    if not billing_period.startswith(datetime.utcnow().strftime('%Y%m')):
+        logger.info("Billing period {} is not the current month, skip CUR ingestion".format(billing_period))
+        return False
+    try:
+        with metrics.timer('IngestCur'):
+            totals = ingest_manifest(
+                get_client('s3'), budgets_table_name, bucket, manifest_key, billing_period,
+                lambda: context.get_remaining_time_in_millis() < cur_ingestion_reserve_millis
+            )
+    except OutOfTime as e:
+        logger.info("{}, continuing in a new invocation".format(e))
+        metrics.add('CurIngestionContinued')
+        get_client('lambda').invoke(
+            FunctionName=context.function_name,
+            InvocationType='Event',
+            Payload=json.dumps({'curIngestion': {'bucket': bucket, 'manifestKey': manifest_key, 'billingPeriod': billing_period}})
+        )
+        return False
+    except NoProgress as e:
+        # the next delivery of the report starts the billing period over
+        logger.error("{}, stopping the CUR ingestion of {}".format(e, manifest_key))
+        metrics.add('CurIngestionStalled')
+        return False
+    updated_at = str(datetime.utcnow())
+    # the report costs are summed exactly and rounded to the micro-dollar once
+    updates = [
+        (entity['partitionKey'], entity['rangeKey'], to_micros(totals.get(entity.get('businessEntity'), 0)), billing_period, updated_at)
+        for entity in get_business_entities()
+    ]
+    with metrics.timer('Write'), ThreadPoolExecutor(max_workers=rebase_concurrency) as executor:
+        list(executor.map(lambda update: update_cur_spend(*update), updates))
+    metrics.add('CurSpendUpdated', len(updates))
+    logger.info("Updated the CUR spend of {} business entities for billing period {}".format(len(updates), billing_period))
     return True
 
 
+# Update the month to date spend summed from the CUR for a given business entity
+def update_cur_spend(partition_key, range_key, cur_actual_spend, billing_period, updated_at):
+    return update_budget(
+        partition_key, range_key,
+        UpdateExpression="set curActualSpend=:a, curBillingPeriod=:b, curSpendUpdatedAt=:c add budgetVersion :v",
+        ExpressionAttributeValues=to_money_item({
+            ':a': cur_actual_spend,
+            ':b': billing_period,
+            ':c': updated_at,
+            ':v': 1,
+        }, (':a',))
+    )
+
+
+# Reset Accruals in database. The accrual counters of the budget are compacted into its row in the
+# same transaction, their forecasted and blocked accruals are added to the row and they are deleted.
+# The transaction only commits while the counters hold what was read, the budget is read again otherwise.
+# accrualsResetProcessed triggers process-requests through the table stream, the freed budget may admit
+# blocked requests
+def reset_accrued_approved_amt(partition_key, range_key, budget_name, max_attempts=3):
+    logger.info("Resetting the accruedApprovedSpent at beginning of the month for business entity id {}".format(range_key))
+    for attempt in range(max_attempts):
+        budget = get_budget_accruals(partition_key, range_key)
+        counters = budget['accrualCounters']
+        actions = [budget_update(
+            budgets_table_name, budget['partitionKey'], range_key,
+            forecasted=sum(counter.get('accruedForecastedSpend', 0) for counter in counters),
+            blocked=sum(counter.get('accruedBlockedSpend', 0) for counter in counters),
+            set_attributes={'accruedApprovedSpend': 0, 'accrualsResetProcessed': False}
+        )]
+        actions.extend(counter_update(budgets_table_name, counter) for counter in counters)
+        if transact(dynamodb_client(rebase_concurrency), actions):
+            metrics.add('AccrualCountersCompacted', len(counters))
+            logger.info('Reset Budget: {} and compacted {} accrual counters'.format(budget_name, len(counters)))
+            return True
+        logger.info('Accruals of Budget {} changed while compacting, attempt {} of {}'.format(budget_name, attempt + 1, max_attempts))
+    raise Exception('Accruals of Budget {} kept changing while compacting'.format(budget_name))
+
+
+# Get the row of a budget with its accrual counters, from the partition key it was read from or
+# from its shard if the key migration moved it since
+def get_budget_accruals(partition_key, range_key):
+    for key in dict.fromkeys((partition_key, budget_partition_key(range_key))):
+        budgets = fold_accrual_counters(query_items(
+            from_item,
+            TableName=budgets_table_name,
+            KeyConditionExpression='partitionKey = :p and begins_with(rangeKey, :r)',
+            ExpressionAttributeValues=to_item({':p': key, ':r': range_key}),
+            ProjectionExpression='partitionKey,rangeKey,' + ','.join(accrual_attributes)
+        ))
+        if budgets:
+            return budgets[0]
+    raise Exception('Budget {} not found'.format(range_key))
+
+
 # Update pricing information for given business entity
-def update_pricing_info(range_key, budget_name, budget_limit, actual_spend, forcasted_spend):
-    response = budgets_table.update_item(
-        Key={'partitionKey': partition_key, 'rangeKey': range_key},
-        UpdateExpression="set budgetLimit=:a, actualSpend=:b, forecastedSpend=:c, budgetUpdatedAt=:d, budgetForecastProcessed=:e",
-        ExpressionAttributeValues={
+def update_pricing_info(partition_key, range_key, budget_name, budget_limit, actual_spend, forcasted_spend):
+    response = update_budget(
+        partition_key, range_key,
+        UpdateExpression="set budgetLimit=:a, actualSpend=:b, forecastedSpend=:c, budgetUpdatedAt=:d, budgetForecastProcessed=:e add budgetVersion :v",
+        ExpressionAttributeValues=to_money_item({
             ':a': budget_limit,
             ':b': actual_spend,
             ':c': forcasted_spend,
             ':d': str(datetime.utcnow()),
             ':e': False,
-        },
+            ':v': 1,
+        }, (':a', ':b', ':c')),
         ReturnValues="UPDATED_NEW"
     )
     logger.info('Updated Pricing Info for Budget: {} with response {}'.format(budget_name, response))
     return True
 
 
-# Get all budget information for all business entities
+# Update a budget row under the partition key it was read from. The update never creates a row,
+# a row moved to its shard by the key migration since it was read is updated there instead
+def update_budget(partition_key, range_key, **update_args):
+    client = dynamodb_client(rebase_concurrency)
+    for key in dict.fromkeys((partition_key, budget_partition_key(range_key))):
+        try:
+            return client.update_item(
+                TableName=budgets_table_name,
+                Key=to_item({'partitionKey': key, 'rangeKey': range_key}),
+                ConditionExpression='attribute_exists(rangeKey)',
+                **update_args
+            )
+        except client.exceptions.ConditionalCheckFailedException:
+            logger.info("Budget {} not found under partition key {}".format(range_key, key))
+    raise Exception('Budget {} not found'.format(range_key))
+
+
+# Get all budget information for all business entities, the budget shards are read in parallel
 def get_business_entities():
-    response = budgets_table.query(
-        KeyConditionExpression=Key('partitionKey').eq(partition_key),
-        ProjectionExpression='rangeKey,budgetName'
+    entities = query_partitions(
+        budget_partition_keys(),
+        TableName=budgets_table_name,
+        ProjectionExpression='partitionKey,rangeKey,budgetName,businessEntity'
     )
+    # the accrual counters stored next to the budgets are not business entities
+    entities = [entity for entity in entities if split_accrual_counter_key(entity['rangeKey'])[1] is None]
     logger.info("Business Entities fetched from DB")
-    return response['Items']
-
+    return entities
 
-# Get budget details for a given account and budget name
-def get_budget_details(account_id, budget_name):
-    response = client.describe_budget(AccountId=account_id, BudgetName=budget_name)
-    return response
 
+# Get all budgets of the account keyed by budget name, describe_budgets returns up to 100 budgets per page
+def get_budgets(account_id):
+    budgets = {}
+    paginator = budgets_client().get_paginator('describe_budgets')
+    for page in paginator.paginate(AccountId=account_id, PaginationConfig={'PageSize': 100}):
+        for budget in page.get('Budgets', []):
+            budgets[budget['BudgetName']] = budget
+    logger.info("Fetched {} budgets for account {}".format(len(budgets), account_id))
+    return budgets
 
-# Get requests by state
-def get_requests(request_state):
-    response = budgets_table.query(
-        IndexName='query-by-request-status',
-        KeyConditionExpression=Key('requestStatus').eq(request_state),
-        ScanIndexForward=True,
-        ProjectionExpression='rangeKey,requestorEmail,requestApprovalUrl,pricingInfoAtRequest,accuredForcastedSpend, businessEntity'
-    )
-    logger.info("Business Entities fetched from DB")
-    return response['Items']
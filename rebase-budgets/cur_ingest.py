@@ -0,0 +1,242 @@
+################################################################################
+#
+# MIT No Attribution
+#
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+################################################################################
+# Streaming ingestion of the Cost & Usage Report parts. A part is read in chunks,
+# gzipped CSV through a streaming decompressor and Parquet one row group at a
+# time, and its unblended cost is summed per value of the business entity cost
+# allocation tag. Memory stays bounded by the number of business entities
+# whatever the size of the report. Progress is checkpointed to the budgets table
+# per billing period: the keys of the parts already read with their running
+# totals, and the offset reached in the part being read, the decompressed byte
+# offset of a CSV part or the row group of a Parquet part. Every CUR delivery
+# rewrites the report of the billing period as a new assembly, under new keys
+# and with the month to date usage of every part, so each delivery is read in
+# full: parts are only skipped within an assembly, when an ingestion continues
+# in a new invocation or the same manifest is delivered again, never across
+# deliveries. A part cut short is resumed from its offset. A CSV part is decompressed again up to the offset
+# without parsing it, a resume that cannot get past its offset in one
+# invocation stops the ingestion instead of continuing it over and over.
+#
+# Parquet reports need pyarrow, which is not part of the function package.
+#
+# Usage (local report parts): python rebase-budgets/cur_ingest.py <part.csv.gz|part.parquet> [...]
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import re
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+from clients import dynamodb_client, from_item, to_item
+
+logger = logging.getLogger()
+cur_partition_key = 'CUR'
+cost_column = os.environ.get('CurCostColumn', 'lineItem/UnblendedCost')
+business_entity_column = 'resourceTags/' + os.environ.get('BusinessEntityTag', 'user:BusinessEntity')
+checkpoint_rows = int(os.environ.get('CurCheckpointRows', '100000'))
+checkpoint_ttl_seconds = 40 * 24 * 3600
+# decompressed bytes read at a time while skipping to the offset of a CSV part
+skip_chunk_bytes = 1024 * 1024
+
+
+class OutOfTime(Exception):
+    pass
+
+
+# Raised when a resumed part runs out of time before it gets past its checkpoint
+class NoProgress(Exception):
+    pass
+
+
+# CUR Parquet columns are the CSV columns in snake case, e.g. line_item_unblended_cost
+def parquet_column(column):
+    column = re.sub(r'[/:]', '_', column)
+    return re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', column).lower()
+
+
+# Sum the cost per business entity of a gzipped CSV report part read from a binary stream. The part up to
+# the decompressed byte offset skip_bytes was read before and is skipped without parsing it, out_of_time()
+# is checked while skipping. checkpoint(offset, totals) is called every checkpoint_rows rows with the
+# offset of the next row. Returns the totals and the decompressed size of the part
+def aggregate_csv(stream, totals=None, skip_bytes=0, checkpoint=None, out_of_time=lambda: False):
+    totals = defaultdict(Decimal, totals or {})
+    part = gzip.GzipFile(fileobj=stream)
+    offset = 0
+
+    # lines are counted as the reader pulls them, a row quoting line breaks spans several
+    def lines():
+        nonlocal offset
+        for line in part:
+            offset = offset + len(line)
+            yield line.decode('utf-8')
+
+    reader = csv.reader(lines())
+    header = next(reader, None)
+    if header is None or business_entity_column not in header:
+        logger.info("Report part has no {} column, nothing to aggregate".format(business_entity_column))
+        return totals, offset
+    if cost_column not in header:
+        logger.error("Report part has no {} column, skipping it".format(cost_column))
+        return totals, offset
+    entity_index = header.index(business_entity_column)
+    cost_index = header.index(cost_column)
+    while offset < skip_bytes:
+        if out_of_time():
+            raise NoProgress('Skipping to offset {} stopped at {}'.format(skip_bytes, offset))
+        skipped = part.read(min(skip_chunk_bytes, skip_bytes - offset))
+        if not skipped:
+            break
+        offset = offset + len(skipped)
+    rows = 0
+    for row in reader:
+        rows = rows + 1
+        if row[entity_index] and row[cost_index]:
+            totals[row[entity_index]] += Decimal(row[cost_index])
+        if checkpoint and rows % checkpoint_rows == 0:
+            checkpoint(offset, totals)
+    return totals, offset
+
+
+# Sum the cost per business entity of a Parquet report part, one row group at a time. The first
+# skip_row_groups row groups were read before, checkpoint(row_groups, totals) is called after every
+# row group. Returns the totals and the number of row groups of the part
+def aggregate_parquet(source, totals=None, skip_row_groups=0, checkpoint=None):
+    import pyarrow.parquet as pq
+
+    totals = defaultdict(Decimal, totals or {})
+    parquet_file = pq.ParquetFile(source)
+    entity_name = parquet_column(business_entity_column)
+    cost_name = parquet_column(cost_column)
+    if entity_name not in parquet_file.schema_arrow.names:
+        logger.info("Report part has no {} column, nothing to aggregate".format(entity_name))
+        return totals, parquet_file.num_row_groups
+    if cost_name not in parquet_file.schema_arrow.names:
+        logger.error("Report part has no {} column, skipping it".format(cost_name))
+        return totals, parquet_file.num_row_groups
+    for index in range(skip_row_groups, parquet_file.num_row_groups):
+        row_group = parquet_file.read_row_group(index, columns=[entity_name, cost_name])
+        sums = row_group.group_by(entity_name).aggregate([(cost_name, 'sum')])
+        for entity, cost in zip(sums.column(entity_name).to_pylist(), sums.column(cost_name + '_sum').to_pylist()):
+            if entity and cost:
+                totals[entity] += Decimal(str(cost))
+        if checkpoint:
+            checkpoint(index + 1, totals)
+    return totals, parquet_file.num_row_groups
+
+
+# Aggregate a report part stored in S3. CSV parts are streamed from the object body, Parquet
+# parts are opened through ranged reads so only the footer and the row groups read are fetched
+def aggregate_part(s3, bucket, key, totals=None, offset=0, checkpoint=None, out_of_time=lambda: False):
+    if key.endswith('.parquet'):
+        from pyarrow import fs
+        s3_filesystem = fs.S3FileSystem(region=os.environ.get('AWS_REGION'))
+        with s3_filesystem.open_input_file('{}/{}'.format(bucket, key)) as source:
+            return aggregate_parquet(source, totals, offset, checkpoint)
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        return aggregate_csv(body, totals, offset, checkpoint, out_of_time)
+    finally:
+        body.close()
+
+
+# Get the checkpoint of a billing period, a checkpoint of another assembly is started over. A checkpoint
+# written with the totals of every part is folded into running totals, the part it was reading is read again
+def load_checkpoint(table_name, billing_period, assembly_id):
+    response = dynamodb_client().get_item(
+        TableName=table_name,
+        Key=to_item({'partitionKey': cur_partition_key, 'rangeKey': billing_period}),
+        ConsistentRead=True
+    )
+    checkpoint = from_item(response['Item']) if 'Item' in response else {}
+    if checkpoint.get('assemblyId') != assembly_id:
+        checkpoint = {'partitionKey': cur_partition_key, 'rangeKey': billing_period, 'assemblyId': assembly_id,
+                      'totals': {}, 'completedParts': []}
+    elif 'parts' in checkpoint:
+        parts = checkpoint.pop('parts')
+        for name in ('partKey', 'offset', 'partial'):
+            checkpoint.pop(name, None)
+        checkpoint.update(totals=sum_parts(parts.values()), completedParts=list(parts))
+    return checkpoint
+
+
+def save_checkpoint(table_name, checkpoint):
+    now = int(time.time())
+    checkpoint['updatedAt'] = now
+    checkpoint['expiresAt'] = now + checkpoint_ttl_seconds
+    dynamodb_client().put_item(TableName=table_name, Item=to_item(checkpoint))
+
+
+# Ingest the report parts of a CUR manifest and return the cost per business entity of the billing
+# period. When out_of_time() is true at a checkpoint the progress is saved and OutOfTime is raised,
+# ingesting the manifest again resumes from there
+def ingest_manifest(s3, table_name, bucket, manifest_key, billing_period, out_of_time=lambda: False):
+    manifest = json.loads(s3.get_object(Bucket=bucket, Key=manifest_key)['Body'].read())
+    checkpoint = load_checkpoint(table_name, billing_period, manifest['assemblyId'])
+    completed_parts = set(checkpoint['completedParts'])
+    for part_key in manifest['reportKeys']:
+        if part_key in completed_parts:
+            logger.info("Report part {} was ingested before, skipping".format(part_key))
+            continue
+        resume = checkpoint.get('partKey') == part_key
+
+        def save_progress(offset, totals, part_key=part_key):
+            checkpoint.update(partKey=part_key, offset=offset, partial=dict(totals))
+            save_checkpoint(table_name, checkpoint)
+            if out_of_time():
+                raise OutOfTime('Ingestion of {} stopped at offset {}'.format(part_key, offset))
+
+        totals, offset = aggregate_part(
+            s3, bucket, part_key, checkpoint['partial'] if resume else None, int(checkpoint['offset']) if resume else 0,
+            save_progress, out_of_time)
+        logger.info("Ingested report part {} up to offset {}".format(part_key, offset))
+        checkpoint['totals'] = sum_parts([checkpoint['totals'], totals])
+        checkpoint['completedParts'].append(part_key)
+        completed_parts.add(part_key)
+        for name in ('partKey', 'offset', 'partial'):
+            checkpoint.pop(name, None)
+        save_checkpoint(table_name, checkpoint)
+    return dict(checkpoint['totals'])
+
+
+def sum_parts(parts):
+    totals = defaultdict(Decimal)
+    for part in parts:
+        for entity, cost in part.items():
+            totals[entity] += cost
+    return dict(totals)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sum the cost per business entity of local CUR report parts')
+    parser.add_argument('parts', nargs='+', help='gzipped CSV or Parquet report parts')
+    args = parser.parse_args()
+    part_totals = []
+    for path in args.parts:
+        if path.endswith('.parquet'):
+            part_totals.append(aggregate_parquet(path)[0])
+        else:
+            with open(path, 'rb') as part_file:
+                part_totals.append(aggregate_csv(part_file)[0])
+    for business_entity, cost in sorted(sum_parts(part_totals).items()):
+        print('{:<40} {:>16}'.format(business_entity, cost))
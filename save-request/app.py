@@ -24,26 +24,30 @@ import os
 from datetime import datetime
 from decimal import Decimal
 
-import boto3
-import requests
+from accruals import accrual_update, budget_check, request_update, transact
+from clients import dynamodb_client, http_session
+from keys import (blocked_cost_attribute, blocked_entity_attribute, budget_partition, entity_status_attribute, entity_status_key,
+                  request_partition, request_partition_key)
+from lifecycle import expiry_attributes
+from metrics import Metrics
+from money import from_data, from_item, to_item
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-partition_key = 'REQUEST'
-budget_partition_key = 'BUDGET'
+logger.setLevel(os.environ.get('LogLevel', 'INFO'))
+metrics = Metrics('save-request')
 api_gw_url = os.environ['ApprovalUrl']
 region = os.environ['AWS_REGION']
 budgets_table_name = os.environ['BudgetsTable']
-dynamodb = boto3.resource('dynamodb', region_name=region)
-budgets_table = dynamodb.Table(budgets_table_name)
 
 
+@metrics.handler
 def lambda_handler(event, context):
     response_data = {'Status': 'Request successfully saved to Dynamo DB'}
     logger.info(json.dumps(event))
     try:
         if event['RequestType'] == 'Delete':
-            update_termination_request_status(event['StackId'].split("/")[-1])
+            with metrics.timer('Terminate'):
+                update_termination_request_status(event['StackId'].split("/")[-1])
             response_data = {'Status': 'Request successfully updated as Terminated in Dynamo DB'}
             send_response(event, context, 'SUCCESS', response_data)
             return True
@@ -62,9 +66,11 @@ def lambda_handler(event, context):
         business_entity = event['ResourceProperties']['BusinessEntity']
         event['ResourceProperties'].pop('EC2Pricing')
         event['ResourceProperties'].pop('BusinessEntity')
+        request_id = event['StackId'].split("/")[-1]
         db_item = {
-            'partitionKey': partition_key,
-            'rangeKey': event['StackId'].split("/")[-1],
+            # requests are spread over the write shards by stack id
+            'partitionKey': request_partition_key(request_id),
+            'rangeKey': request_id,
             'requestApprovalUrl': approval_url,
             'requestRejectionUrl': rejection_url,
             'stackWaitUrl': wait_url,
@@ -74,11 +80,16 @@ def lambda_handler(event, context):
             'resourceStatus': 'PENDING',
             'businessEntity': business_entity,
             'businessEntityId': '',
-            'pricingInfoAtRequest': json.loads(pricing_info, parse_float=Decimal),
+            entity_status_attribute: entity_status_key(business_entity, 'SAVED'),
+            # fleet requests describe their instances in the pricing, e.g. 10 x t2.micro
+            'instanceType': event['ResourceProperties'].get('InstanceType') or json.loads(pricing_info)['InstanceType'],
+            # amounts are kept in micro-dollars, stored as dollar numbers rounded to the micro-dollar
+            'pricingInfoAtRequest': from_data(json.loads(pricing_info, parse_float=Decimal)),
             'productName': event['ResourceProperties']['ProductName'],
             'requestPayload': event['ResourceProperties']
         }
-        create_approval_req_item(db_item)
+        with metrics.timer('Write'):
+            create_approval_req_item(db_item)
         send_response(event, context, 'SUCCESS', response_data)
         return True
     except Exception as e:
@@ -87,63 +98,69 @@ def lambda_handler(event, context):
         return False
 
 
-# Update the status of the request in dynamo-db
-def update_termination_request_status(request_id):
+# Update the status of the request in dynamo-db, the blocked amount of a pending or blocked
+# request is released in the same transaction. The released amount is the one of the request,
+# so the budget row is only checked to exist, under the partition key the request points at.
+# The status update is conditional on the status that was read, the request is read again if
+# another function changed it or the key migration moved its budget meanwhile
+def update_termination_request_status(request_id, max_attempts=3):
     logger.info('Received termination request for stack id: {}'.format(request_id))
-    existing_req = budgets_table.get_item(
-        Key={'partitionKey': partition_key, 'rangeKey': request_id},
-        ProjectionExpression='requestStatus, businessEntity, businessEntityId, pricingInfoAtRequest'
-    )
-    if 'Item' not in existing_req:
-        return False
-    logger.info('Fetched Request Item from Database: {}'.format(existing_req['Item']))
-    requested_amt = existing_req['Item']['pricingInfoAtRequest']['EstCurrMonthPrice']
-    requested_amt_monthly = existing_req['Item']['pricingInfoAtRequest']['31DayPrice']
-    business_entity_id = existing_req['Item']['businessEntityId']
-    request_status = existing_req['Item']['requestStatus']
+    for attempt in range(max_attempts):
+        existing_req = get_request_item(request_id)
+        if existing_req is None:
+            return False
+        logger.info('Fetched Request Item from Database: {}'.format(existing_req))
+        requested_amt_monthly = existing_req['pricingInfoAtRequest']['31DayPrice']
+        business_entity_id = existing_req['businessEntityId']
+        request_status = existing_req['requestStatus']
 
-    # if status is pending/rejected/blocked, then deduct from accrued blocked amt
-    if len(business_entity_id) > 0 and request_status in ["PENDING", "BLOCKED"]:
-        logger.info('Adjusting Accruals since request is in {} state'.format(request_status))
-        budget_info = budgets_table.get_item(
-            Key={'partitionKey': budget_partition_key, 'rangeKey': business_entity_id},
-            ProjectionExpression='accruedBlockedSpend'
-        )
-        accrued_blocked_spend = budget_info['Item']['accruedBlockedSpend']
-        accrued_blocked_spend = accrued_blocked_spend - requested_amt_monthly
-        logger.info("Clear the blocked amt if exists")
-        response = budgets_table.update_item(
-            Key={'partitionKey': budget_partition_key, 'rangeKey': business_entity_id},
-            UpdateExpression="set accruedBlockedSpend=:b",
-            ExpressionAttributeValues={':b': accrued_blocked_spend},
-            ReturnValues="UPDATED_NEW"
+        attributes = {
+            'resourceTerminationTime': str(datetime.utcnow()),
+            'resourceStatus': 'TERMINATED',
+            entity_status_attribute: None,
+            blocked_entity_attribute: None,
+            blocked_cost_attribute: None
+        }
+        if request_status in ['PENDING', 'BLOCKED', 'SAVED']:
+            attributes['requestStatus'] = 'REJECTED_SYSTEM'
+        elif request_status != 'REJECTED_ADMIN':
+            attributes['requestStatus'] = request_status + '_TERMINATED'
+        # the request is final once its stack is gone, it expires after the retention window
+        attributes.update(expiry_attributes(attributes.get('requestStatus', request_status)))
+        actions = [request_update(budgets_table_name, existing_req['partitionKey'], request_id, attributes, [request_status])]
+        # if status is pending/rejected/blocked, then deduct from accrued blocked amt
+        if len(business_entity_id) > 0 and request_status in ["PENDING", "BLOCKED"]:
+            logger.info('Adjusting Accruals since request is in {} state'.format(request_status))
+            # requests evaluated before the budgets were sharded point at the unsharded budget
+            budget_partition_key = existing_req.get('budgetPartitionKey', budget_partition)
+            actions.append(budget_check(budgets_table_name, budget_partition_key, business_entity_id))
+            actions.append(accrual_update(budgets_table_name, budget_partition_key, business_entity_id,
+                                          blocked=-requested_amt_monthly))
+        if transact(dynamodb_client(), actions):
+            logger.debug("Termination of request {} succeeded".format(request_id))
+            return True
+        metrics.add('ConditionCheckFailures')
+        logger.info('Request {} changed while terminating, attempt {} of {}'.format(request_id, attempt + 1, max_attempts))
+    raise Exception('Request {} kept changing while terminating'.format(request_id))
+
+
+# Get a request from the shard of its stack id, requests saved before the shards existed are
+# read from the unsharded partition until they are migrated. Returns None for an unknown request
+def get_request_item(request_id):
+    for partition_key in (request_partition_key(request_id), request_partition):
+        response = dynamodb_client().get_item(
+            TableName=budgets_table_name,
+            Key={'partitionKey': {'S': partition_key}, 'rangeKey': {'S': request_id}},
+            ProjectionExpression='partitionKey, requestStatus, businessEntity, businessEntityId, budgetPartitionKey, pricingInfoAtRequest'
         )
-        logger.info("Blocked amount cleared successfully: {}".format(response))
-    update_expression = "set resourceTerminationTime=:a, resourceStatus=:r"
-    expression_attributes = {
-        ':a': str(datetime.utcnow()),
-        ':r': 'TERMINATED'
-    }
-    if request_status in ['PENDING', 'BLOCKED', 'SAVED']:
-        update_expression = update_expression + ", requestStatus=:c"
-        expression_attributes[':c'] = 'REJECTED_SYSTEM'
-    elif request_status != 'REJECTED_ADMIN':
-        update_expression = update_expression + ", requestStatus=:c"
-        expression_attributes[':c'] = request_status + '_TERMINATED'
-    response = budgets_table.update_item(
-        Key={'partitionKey': partition_key, 'rangeKey': request_id},
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_attributes,
-        ReturnValues="UPDATED_NEW"
-    )
-    logger.debug("UpdateItem succeeded:")
-    logger.debug(json.dumps(response))
-    return True
+        if 'Item' in response:
+            return from_item(response['Item'])
+    return None
 
 
 # Create a request in database
 def create_approval_req_item(db_item):
-    response = budgets_table.put_item(Item=db_item)
+    response = dynamodb_client().put_item(TableName=budgets_table_name, Item=to_item(db_item))
     logger.debug("CreateItem succeeded:")
     logger.debug(json.dumps(response))
 
@@ -160,7 +177,8 @@ def send_response(event, context, response_status, response_data):
         'Data': response_data,
     }
     try:
-        response = requests.put(event['ResponseURL'], data=json.dumps(response_body))
+        with metrics.timer('Callback'):
+            response = http_session().put(event['ResponseURL'], data=json.dumps(response_body))
         return True
     except Exception as e:
         logger.info("Failed executing HTTP request: {}".format(e))